@@ -1,4 +1,5 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.utils.translation import gettext_lazy as _
 
 from .settings import stream_settings
 
@@ -6,11 +7,33 @@ if stream_settings.VIDEO_STREAM_MODEL in ['wagtailstreaming.VideoStream', '']:
     from .models import VideoStream
 
     class VideoStreamAdmin(admin.ModelAdmin):
-        list_display = ['title', 'raw_ready', 'hls_ready', 'dash_ready', 'uploaded_by']
-        list_filter = ['hls_ready', 'dash_ready']
+        list_display = ['title', 'raw_ready', 'hls_ready', 'dash_ready', 'rendition_health', 'dead_lettered', 'eta', 'uploaded_by']
+        list_filter = ['hls_ready', 'dash_ready', 'rendition_health', 'dead_lettered', 'last_failure']
+        actions = ['requeue']
 
         def raw_ready(self, obj):
             return bool(obj.file)
         raw_ready.boolean = True
 
+        @admin.display(description = _('ETA'))
+        def eta(self, obj):
+            eta = obj.eta
+            return eta.humanized if eta else '-'
+
+        @admin.action(description = _('Requeue selected videos for conversion'))
+        def requeue(self, request, queryset):
+            from .task_utils import requeue
+
+            count = 0
+            for instance in queryset:
+                if requeue(instance):
+                    count += 1
+            self.message_user(request, _('%(count)d video(s) requeued for conversion.') % {'count': count})
+            if count < len(queryset):
+                self.message_user(
+                    request, 
+                    _('%(count)d video(s) could not be scheduled, they are converted on the next queue check.') % {'count': len(queryset) - count}, 
+                    level = messages.WARNING
+                )
+
     admin.site.register(VideoStream, VideoStreamAdmin)
\ No newline at end of file
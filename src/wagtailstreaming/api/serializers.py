@@ -63,6 +63,15 @@ class StreamURLField(ReadOnlyField):
         return urls
 
 
+class ETAField(ReadOnlyField):
+    def get_attribute(self, instance):
+        return instance
+
+    def to_representation(self, instance):
+        eta = instance.eta
+        return eta.duration if eta else None
+
+
 class StreamModesField(ReadOnlyField):
     def get_attribute(self, instance):
         return instance
@@ -76,6 +85,7 @@ class VideoStreamSerializer(BaseSerializer):
     stream_urls = StreamURLField()
     embed_url = EmbedURLField()
     modes = StreamModesField()
+    eta = ETAField()
 
 
 class StreamHTMLSerializer(serializers.ModelSerializer):
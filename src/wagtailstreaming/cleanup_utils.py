@@ -0,0 +1,136 @@
+from django.utils import timezone
+
+from datetime import timedelta
+import logging
+import typing
+
+from .models import CleanupJob, CleanupKind, VideoStream, get_stream_model
+from .rendition_utils import remove_version
+from .settings import stream_settings
+from .http_utils import TokenBucket
+from .source_utils import (
+    effective_rendition_key,
+    get_source_storage,
+    source_referenced,
+    rendition_sharers,
+    delete_source,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+LEASE_SECONDS = 15 * 60 # a worker that died mid-job releases it after this long
+
+
+def record_cleanup(
+        kind: str,
+        name: str,
+        version: str = '',
+        layout: int = 0,
+        delay: int = 0
+    ) -> typing.Optional[CleanupJob]:
+    """Records files to delete in the background, after `delay` seconds"""
+    if not name:
+        return None
+    return CleanupJob.objects.create(
+        kind = kind,
+        name = name,
+        version = version,
+        layout = layout,
+        run_after = timezone.now() + timedelta(seconds = delay)
+    )
+
+
+def record_instance_cleanup(instance: VideoStream) -> typing.List[CleanupJob]:
+    """Records the files of an instance, other instances are checked again when the jobs run"""
+    jobs = []
+    if not rendition_sharers(instance).exists():
+        key = effective_rendition_key(instance)
+        jobs.append(record_cleanup(CleanupKind.RENDITIONS, key, instance.rendition_version, instance.rendition_layout))
+        if instance.pending_version:
+            jobs.append(record_cleanup(
+                CleanupKind.RENDITIONS, key, instance.pending_version, stream_settings.RENDITION_SHARD_DEPTH
+            ))
+
+    if instance.file:
+        jobs.append(record_cleanup(CleanupKind.SOURCE, instance.file.name))
+    if instance.faststart_name:
+        jobs.append(record_cleanup(CleanupKind.SOURCE, instance.faststart_name))
+    if instance.thumbnail:
+        jobs.append(record_cleanup(CleanupKind.THUMBNAIL, instance.thumbnail.name))
+    return [job for job in jobs if job]
+
+
+def version_readers(key: str, version: str, layout: int = 0):
+    """Instances that still serve a rendition version"""
+    readers = get_stream_model().objects.filter(rendition_version = version, rendition_layout = layout)
+    if not version:
+        # instances without a rendition key never share their directory, the one that moved on was its only reader
+        readers = readers.filter(rendition_key = key)
+    return readers
+
+
+def due_jobs():
+    return CleanupJob.objects.filter(run_after__lte = timezone.now())
+
+
+def _claim(job: CleanupJob) -> bool:
+    """Leases a job with a conditional update, so two workers never run the same job"""
+    return bool(CleanupJob.objects.filter(
+        pk = job.pk,
+        run_after = job.run_after
+    ).update(run_after = timezone.now() + timedelta(seconds = LEASE_SECONDS)))
+
+
+def run_job(job: CleanupJob, throttle: typing.Optional[TokenBucket] = None):
+    """Deletes the files of a job unless an instance references them again"""
+    if job.kind == CleanupKind.RENDITIONS:
+        if version_readers(job.name, job.version, job.layout).exists():
+            LOGGER.info(f'Rendition version {job.version or "unversioned"} of {job.name} is published again, keeping it')
+            return
+        remove_version(job.name, job.version, job.layout, throttle)
+
+    elif job.kind == CleanupKind.SOURCE:
+        if source_referenced(get_stream_model(), job.name):
+            return
+        if throttle:
+            throttle.consume(1)
+        delete_source(get_source_storage(), job.name)
+
+    elif job.kind == CleanupKind.THUMBNAIL:
+        if get_stream_model().objects.filter(thumbnail = job.name).exists():
+            return
+        if throttle:
+            throttle.consume(1)
+        get_stream_model()._meta.get_field('thumbnail').storage.delete(job.name)
+
+
+def run_cleanup(limit: typing.Optional[int] = None) -> int:
+    """
+    Runs a batch of due jobs, unlinking at most `CLEANUP_UNLINK_RATE` files per second.
+    A job that fails, e.g. while its storage is unavailable, is retried with the conversion backoff.
+    Returns the number of jobs that finished
+    """
+    from .task_utils import backoff_delay
+
+    throttle = TokenBucket(stream_settings.CLEANUP_UNLINK_RATE)
+    done = 0
+    for job in due_jobs().order_by('run_after')[:limit or stream_settings.CLEANUP_BATCH_SIZE]:
+        if not _claim(job):
+            continue
+
+        try:
+            run_job(job, throttle)
+
+        except Exception as e:
+            attempts = job.attempts + 1
+            CleanupJob.objects.filter(pk = job.pk).update(
+                attempts = attempts,
+                last_error = str(e),
+                run_after = timezone.now() + backoff_delay(attempts)
+            )
+            LOGGER.error(f'Cleanup of {job} failed (attempt {attempts}): {e}')
+            continue
+
+        job.delete()
+        done += 1
+    return done
@@ -0,0 +1,88 @@
+from dataclasses import dataclass, field
+from typing import Iterator, Tuple
+
+import struct
+
+MP4 = 'mp4'
+MATROSKA = 'matroska'
+MPEGTS = 'mpegts'
+
+MATROSKA_MAGIC = b'\x1a\x45\xdf\xa3'
+TS_SYNC_BYTE = 0x47
+TS_PACKET_SIZE = 188
+TS_PACKETS_CHECKED = 5
+LAYOUT_BYTES = 64 * 1024
+
+Box = Tuple[bytes, int, int]
+
+
+@dataclass
+class ContainerInfo:
+    kind: str = field(default = '')
+    streamable: bool = field(default = False)
+    header_size: int = field(default = 0) # bytes a reader needs before it can start decoding
+    complete: bool = field(default = True) # False when more bytes are needed to decide
+
+
+def iter_boxes(data: bytes, offset: int = 0) -> Iterator[Box]:
+    """
+    Walks the top level MP4 boxes found in `data` as (type, offset, size).
+    Stops at the first box whose header does not fit, the size of the last box may reach past the data
+    """
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        if size == 1:
+            if offset + 16 > len(data):
+                return
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+
+        elif size == 0: # box runs until the end of the file
+            yield kind, offset, 0
+            return
+
+        if size < 8:
+            return
+
+        yield kind, offset, size
+        offset += size
+
+
+def _sniff_mp4(header: bytes) -> ContainerInfo:
+    """An MP4 can be decoded progressively when its moov box comes before the mdat box (faststart)"""
+    for kind, offset, size in iter_boxes(header):
+        if kind == b'moov':
+            end = offset + size
+            return ContainerInfo(MP4, True, end, end <= len(header))
+
+        if kind == b'mdat':
+            return ContainerInfo(MP4, False, 0)
+    return ContainerInfo(MP4, False, 0, False)
+
+
+def _is_mpegts(header: bytes) -> bool:
+    if len(header) < TS_PACKET_SIZE * TS_PACKETS_CHECKED:
+        return False
+    return all(
+        header[i * TS_PACKET_SIZE] == TS_SYNC_BYTE
+        for i in range(TS_PACKETS_CHECKED)
+    )
+
+
+def sniff(header: bytes) -> ContainerInfo:
+    """Identifies the container from the first bytes of a file and tells if it can be decoded while it is still arriving"""
+    if header[:4] == MATROSKA_MAGIC:
+        return ContainerInfo(MATROSKA, True, 0)
+
+    if _is_mpegts(header):
+        return ContainerInfo(MPEGTS, True, 0)
+
+    if header[4:8] == b'ftyp':
+        return _sniff_mp4(header)
+    return ContainerInfo()
+
+
+def needs_faststart(path: str) -> bool:
+    """True for an MP4 whose moov box comes after the media data, browsers have to fetch its end before playing"""
+    with open(path, 'rb') as f:
+        info = sniff(f.read(LAYOUT_BYTES))
+    return info.kind == MP4 and info.complete and not info.streamable
@@ -1,6 +1,8 @@
 from django.core.exceptions import ObjectDoesNotExist
 
+from contextlib import nullcontext
 import subprocess
+import hashlib
 import logging
 import typing
 import shutil
@@ -10,11 +12,27 @@ import time
 import os
 
 from .settings import stream_settings
+from . import metrics
 
 LOGGER = logging.getLogger(__name__)
 
 LOOKAHEAD_FRAMES = 40
 OVERHEAD_MB = 256
+OOM_RETURN_CODES = (-9, 137) # SIGKILL, usually sent by the OOM killer
+HLS_SEGMENT_NAME = 'seg_%06d.ts' # six digits last 46 days at 4 second segments, playlists name their own segments
+DASH_MEDIA_NAME = 'media_$RepresentationID$.mp4'
+
+# anything that changes the encoded output belongs here, it is part of each rung's signature
+ENCODER = {
+    'video_codec': 'h264', 
+    'profile': 'main', 
+    'crf': '20', 
+    'gop': '48', 
+    'audio_codec': 'aac', 
+    'audio_bitrate': '128k', 
+    'sample_rate': '48000', 
+    'segment_seconds': '4', 
+}
 
 
 # dependency checker
@@ -85,6 +103,51 @@ def _estimate_memory_mb(
     )
 
 
+# scheduling utils
+REFERENCE_PIXELS = 1920 * 1080
+
+
+def predict_cost(
+        duration: float, 
+        resolutions: typing.List[typing.Tuple[str, str]]
+    ) -> float:
+    """Predicted encode cost of a ladder in 1080p-equivalent seconds"""
+    if not duration or not resolutions:
+        return 0.0
+
+    pixels = 0
+    for res, _ in resolutions:
+        w, h = _res_str_to_values(res)
+        pixels += w * h
+    return round(duration * pixels / REFERENCE_PIXELS, 2)
+
+
+def _encoder_params() -> typing.Dict[str, str]:
+    # single-file packaging changes the files of every rung, segmented output keeps its existing signatures
+    if stream_settings.SINGLE_FILE_SEGMENTS:
+        return {**ENCODER, 'packaging': 'single_file'}
+    return ENCODER
+
+
+def rung_signature(res: str, bitrate: str) -> str:
+    """Fingerprint of the parameters a rung is encoded with"""
+    params = json.dumps({'resolution': res, 'bitrate': bitrate, **_encoder_params()}, sort_keys = True)
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()[:16]
+
+
+def encoder_signature() -> str:
+    """Fingerprint of the encoder parameters shared by every rung"""
+    params = json.dumps(_encoder_params(), sort_keys = True)
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()[:16]
+
+
+def ladder_entries(resolutions: typing.List[typing.Tuple[str, str]]) -> typing.List[typing.Dict[str, str]]:
+    return [
+        {'resolution': res, 'bitrate': bitrate, 'signature': rung_signature(res, bitrate)}
+        for res, bitrate in resolutions
+    ]
+
+
 # ffmpeg invokations 
 def create_thumbnail(
         source_path: str, 
@@ -116,21 +179,53 @@ def create_thumbnail(
         return False
     
 
-def check_attributes(source_path: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
-    """Checks the attributes of a video."""
+def remux_faststart(
+        source_path: str, 
+        output_path: str
+    ) -> bool:
+    """Copies the streams of an MP4 into a new file whose moov box comes first, without re-encoding"""
+    if not ffmpeg_installed():
+        return False
+
+    temp_path = f'{output_path}.{os.getpid()}.tmp'
+    try:
+        with metrics.timed('remux_seconds'):
+            subprocess.run([
+                'ffmpeg', '-y', '-v', 'error', '-i', source_path,
+                '-map', '0', '-c', 'copy', '-ignore_unknown', 
+                '-movflags', '+faststart', 
+                '-f', 'mp4', temp_path
+            ], check = True)
+
+        os.replace(temp_path, output_path)
+        return True
+
+    except Exception as e:
+        LOGGER.error(f'Failed to remux video {source_path} for progressive playback: {e}')
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+
+def check_attributes(
+        source_path: str, 
+        timed: bool = True
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """Checks the attributes of a video. Probes of rendition segments pass `timed = False`, they are not source probes"""
     if not ffmpeg_installed():
         return None
     
     try:
-        result = subprocess.run(
-            [
-                'ffprobe', '-v', 'error',
-                '-show_format', '-show_streams',
-                '-of', 'json', source_path
-            ],
-            capture_output = True,
-            text = True
-        )
+        with metrics.timed('probe_seconds') if timed else nullcontext():
+            result = subprocess.run(
+                [
+                    'ffprobe', '-v', 'error',
+                    '-show_format', '-show_streams',
+                    '-of', 'json', source_path
+                ],
+                capture_output = True,
+                text = True
+            )
 
         return json.loads(result.stdout)
 
@@ -139,6 +234,30 @@ def check_attributes(source_path: str) -> typing.Optional[typing.Dict[str, typin
         return None
 
 
+def check_header_attributes(header: bytes) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """Checks the attributes of a video from its first bytes, for sources that have not fully arrived yet"""
+    if not ffmpeg_installed():
+        return None
+
+    try:
+        with metrics.timed('probe_seconds'):
+            result = subprocess.run(
+                [
+                    'ffprobe', '-v', 'error',
+                    '-show_format', '-show_streams',
+                    '-of', 'json', 'pipe:0'
+                ],
+                input = header,
+                capture_output = True,
+            )
+
+        return json.loads(result.stdout.decode('utf-8', 'replace'))
+
+    except Exception as e:
+        LOGGER.error(f'Failed to determine the attributes of a partial video: {e}')
+        return None
+
+
 def _listen_to_process(command: typing.List[str]) -> typing.Optional[subprocess.Popen]:
     try:
         process = subprocess.Popen(command, text = True)
@@ -204,11 +323,36 @@ def _start_process(
         if err_message == 'Deleted':
             return None
 
+        if process.returncode in OOM_RETURN_CODES:
+            from .models import FailureKind
+
+            stream_instance.encode_failure = FailureKind.MEMORY
+            stream_instance.save(update_fields = ['encode_failure'])
+
         stream_instance.add_remark(f'Error upon segmenting video at resolution {resolution}, error: {err_message}')
         return False
     return True
 
 
+def _timed_process(
+        stream_instance, 
+        fmt: str, 
+        rung: str, 
+        command: typing.List[str]
+    ) -> typing.Optional[bool]:
+    """Runs `_start_process` and records how long and how fast the encode went"""
+    start = time.monotonic()
+    success = _start_process(stream_instance, rung, command)
+    elapsed = time.monotonic() - start
+
+    if success:
+        metrics.observe('encode_seconds', elapsed, format = fmt, rung = rung)
+        duration = stream_instance.source_duration
+        if duration and elapsed > 0:
+            metrics.observe('encode_speed_ratio', duration / elapsed, format = fmt, rung = rung)
+    return success
+
+
 def _stop_segmentation(
         stream_instance, 
         err_message: str = None
@@ -224,9 +368,103 @@ def _stop_segmentation(
         return False
 
 
+def _hls_packaging(res_subdir: str, res: str) -> typing.List[str]:
+    """Playlist options of an HLS rung, with SINGLE_FILE_SEGMENTS the segments are byte ranges of one file"""
+    options = ['-hls_playlist_type', 'vod']
+    if stream_settings.SINGLE_FILE_SEGMENTS:
+        return options + ['-hls_flags', 'single_file', '-hls_segment_filename', os.path.join(res_subdir, f'{res}.ts')]
+    return options + ['-hls_segment_filename', os.path.join(res_subdir, HLS_SEGMENT_NAME)]
+
+
+def _dash_packaging() -> typing.List[str]:
+    """Segment options of a DASH manifest, with SINGLE_FILE_SEGMENTS each representation is one file"""
+    if stream_settings.SINGLE_FILE_SEGMENTS:
+        # templates can not address byte ranges, the manifest lists the range of every segment
+        return ['-use_template', '0', '-single_file', '1', '-single_file_name', DASH_MEDIA_NAME]
+    return [
+        '-use_template', '1',
+        '-use_timeline', '1',
+        '-init_seg_name', 'init_$RepresentationID$.m4s',
+        '-media_seg_name', 'chunk_$RepresentationID$_$Number$.m4s',
+    ]
+
+
+def _hls_rung_command(
+        rawfile_path: str, 
+        hls_dir: str, 
+        res: str, 
+        bitrate: str
+    ) -> typing.Tuple[str, typing.List[str]]:
+    """Builds the command that encodes a single HLS rung, returns the playlist path and the command"""
+    res_subdir = os.path.join(hls_dir, res)
+    os.makedirs(res_subdir, exist_ok = True)
+
+    playlist_path = os.path.join(res_subdir, f'{res}.m3u8')
+    command = [
+        'ffmpeg', '-y', '-i', rawfile_path,
+        '-vf', f'scale={res}',
+        '-c:a', ENCODER['audio_codec'], '-ar', ENCODER['sample_rate'], '-c:v', ENCODER['video_codec'],
+        '-profile:v', ENCODER['profile'], '-crf', ENCODER['crf'], '-sc_threshold', '0',
+        '-g', ENCODER['gop'], '-keyint_min', ENCODER['gop'],
+        '-hls_time', ENCODER['segment_seconds'],
+        '-b:v', bitrate, '-maxrate', bitrate,
+        '-bufsize', f'{int(int(bitrate[:-1]) * 2)}k',
+        '-b:a', ENCODER['audio_bitrate'],
+        *_hls_packaging(res_subdir, res),
+        '-progress', os.path.join(hls_dir, f'{res}.txt'),
+        playlist_path
+    ]
+    return playlist_path, command
+
+
+def _dash_rung_command(
+        rawfile_path: str, 
+        dash_dir: str, 
+        res: str, 
+        bitrate: str
+    ) -> typing.Tuple[str, typing.List[str]]:
+    """Builds the command that encodes a single video-only MPEG-DASH rung into its own sub-directory"""
+    res_subdir = os.path.join(dash_dir, res)
+    os.makedirs(res_subdir, exist_ok = True)
+
+    manifest_path = os.path.join(res_subdir, 'manifest.mpd')
+    command = [
+        'ffmpeg', '-y', '-i', rawfile_path,
+        '-map', '0:v:0', '-an',
+        '-vf', f'scale={res}',
+        '-c:v', ENCODER['video_codec'], '-profile:v', ENCODER['profile'], '-crf', ENCODER['crf'], '-sc_threshold', '0',
+        # the same keyframe interval as the kept rungs, so segments line up for switching
+        '-g', ENCODER['gop'], '-keyint_min', ENCODER['gop'],
+        '-b:v', bitrate, '-maxrate', bitrate,
+        '-bufsize', f'{int(int(bitrate[:-1]) * 2)}k',
+        '-f', 'dash',
+        '-seg_duration', ENCODER['segment_seconds'],
+        *_dash_packaging(),
+        '-progress', os.path.join(dash_dir, f'{res}.txt'),
+        manifest_path
+    ]
+    return manifest_path, command
+
+
+def write_master_playlist(
+        hls_dir: str, 
+        variants: typing.List[typing.Tuple[str, str, str]]
+    ):
+    """Writes master.m3u8 from (playlist path, bitrate, resolution) variants, readers never see a partial file"""
+    master_playlist = os.path.join(hls_dir, 'master.m3u8')
+    temp_playlist = f'{master_playlist}.tmp'
+    with open(temp_playlist, 'w') as f:
+        f.write('#EXTM3U\n')
+        for playlist, bitrate, res in variants:
+            relative_playlist = os.path.relpath(playlist, hls_dir)
+            f.write(f'#EXT-X-STREAM-INF:BANDWIDTH={bitrate[:-1]}000,RESOLUTION={res}\n')
+            f.write(f'{relative_playlist}\n')
+    os.replace(temp_playlist, master_playlist)
+
+
 def _seq_hls(stream_instance) -> bool:
     rawfile_path = stream_instance.raw.path
-    hls_dir = stream_instance.hls.root
+    hls_dir = stream_instance.scratch_root('hls')
     resolutions = stream_instance.supported_resolutions
     if not hls_dir:
         return _stop_segmentation(
@@ -235,43 +473,19 @@ def _seq_hls(stream_instance) -> bool:
         )
 
     try:
-        master_playlist = os.path.join(hls_dir, 'master.m3u8')
         variants = []
 
         for res, bitrate in resolutions:
-            res_subdir = os.path.join(hls_dir, res)
-            os.makedirs(res_subdir, exist_ok = True)
-
-            playlist_path = os.path.join(res_subdir, f'{res}.m3u8')
-            command = [
-                'ffmpeg', '-y', '-i', rawfile_path,
-                '-vf', f'scale={res}',
-                '-c:a', 'aac', '-ar', '48000', '-c:v', 'h264',
-                '-profile:v', 'main', '-crf', '20', '-sc_threshold', '0',
-                '-g', '48', '-keyint_min', '48',
-                '-hls_time', '4',
-                '-hls_playlist_type', 'event',
-                '-b:v', bitrate, '-maxrate', bitrate,
-                '-bufsize', f'{int(int(bitrate[:-1]) * 2)}k',
-                '-b:a', '128k',
-                '-hls_segment_filename', os.path.join(res_subdir, 'seg_%03d.ts'),
-                '-progress', os.path.join(hls_dir, f'{res}.txt'),
-                playlist_path
-            ]
-
-            success = _start_process(stream_instance, res, command)
+            playlist_path, command = _hls_rung_command(rawfile_path, hls_dir, res, bitrate)
+
+            success = _timed_process(stream_instance, 'hls', res, command)
             if success is None:
                 return False
 
             if success:
                 variants.append((playlist_path, bitrate, res))
 
-        with open(master_playlist, 'w') as f:
-            f.write('#EXTM3U\n')
-            for playlist, bitrate, res in variants:
-                relative_playlist = os.path.relpath(playlist, hls_dir)
-                f.write(f'#EXT-X-STREAM-INF:BANDWIDTH={bitrate[:-1]}000,RESOLUTION={res}\n')
-                f.write(f'{relative_playlist}\n')
+        write_master_playlist(hls_dir, variants)
         return True
 
     except Exception as e:
@@ -287,12 +501,103 @@ def create_segments_seq(stream_instance) -> typing.Tuple[bool, bool]:
     dash_success = False
 
     if ffmpeg_installed():
-        if stream_settings.ALLOW_HLS:
+        if 'hls' in stream_instance.ladder_formats:
             hls_success = _seq_hls(stream_instance)
 
     return hls_success, dash_success
 
 
+def segmenter_formats(
+        segment: typing.Callable[[typing.Any], typing.Tuple[bool, bool]], 
+        formats: typing.List[str]
+    ) -> typing.List[str]:
+    """The formats of `formats` that a segmenter produces, the sequential one only encodes HLS"""
+    if segment is create_segments_seq:
+        return [fmt for fmt in formats if fmt == 'hls']
+    return list(formats)
+
+
+def _split_filter(resolutions: typing.List[typing.Tuple[str, str]]) -> typing.Tuple[str, typing.List[str]]:
+    """Builds the filter graph that scales the source video once per rung, returns the graph and its output labels"""
+    split_count = len(resolutions)
+    split_labels = [f"[v{i+1}]" for i in range(split_count)]
+    filter_parts = [f"[v:0]split={split_count}{''.join(split_labels)}"]
+
+    scale_labels = []
+    for i, (res, _) in enumerate(resolutions):
+        label = f"[v{i+1}]scale={res}[v{i+1}out]"
+        filter_parts.append(label)
+        scale_labels.append(f"[v{i+1}out]")
+    return "; ".join(filter_parts), scale_labels
+
+
+def _bulk_hls_command(
+        input_path: str, 
+        hls_dir: str, 
+        resolutions: typing.List[typing.Tuple[str, str]]
+    ) -> typing.Tuple[typing.List[typing.Tuple[str, str, str]], typing.List[str]]:
+    """Builds the command that encodes every HLS rung in one process, returns the variants and the command"""
+    filter_complex, scale_labels = _split_filter(resolutions)
+    command = [
+        "ffmpeg", "-y", "-i", input_path, 
+        "-filter_complex", filter_complex, 
+        "-progress", os.path.join(hls_dir, 'all.txt')
+    ]
+
+    hls_variants = []
+    for i, ((res, bitrate), scale_label) in enumerate(zip(resolutions, scale_labels)):
+        res_hls_subdir = os.path.join(hls_dir, res)
+        os.makedirs(res_hls_subdir, exist_ok=True)
+        hls_playlist = os.path.join(res_hls_subdir, f"{res}.m3u8")
+        hls_variants.append((hls_playlist, bitrate, res))
+
+        command += [
+            "-map", scale_label,
+            f"-c:v:{i}", ENCODER['video_codec'], "-profile:v", ENCODER['profile'], "-crf", ENCODER['crf'],
+            f"-b:v:{i}", bitrate,
+            f"-maxrate:v:{i}", bitrate,
+            f"-bufsize:v:{i}", f"{int(int(bitrate[:-1])*2)}k",
+            "-g", ENCODER['gop'], "-keyint_min", ENCODER['gop'],
+            "-map", "a:0?", f"-c:a:{i}", ENCODER['audio_codec'], "-b:a", ENCODER['audio_bitrate'], "-ar", ENCODER['sample_rate'],
+            "-hls_time", ENCODER['segment_seconds'],
+            *_hls_packaging(res_hls_subdir, res),
+            hls_playlist
+        ]
+    return hls_variants, command
+
+
+def _bulk_dash_command(
+        input_path: str, 
+        dash_dir: str, 
+        resolutions: typing.List[typing.Tuple[str, str]]
+    ) -> typing.List[str]:
+    """Builds the command that encodes every MPEG-DASH representation in one process"""
+    filter_complex, scale_labels = _split_filter(resolutions)
+    command = [
+        "ffmpeg", "-y", "-i", input_path, 
+        "-filter_complex", filter_complex, 
+        "-progress", os.path.join(dash_dir, 'all.txt')
+    ]
+
+    for i, ((res, bitrate), scale_label) in enumerate(zip(resolutions, scale_labels)):
+        command += [
+            "-map", scale_label,
+            f"-c:v:{i}", ENCODER['video_codec'], "-profile:v", ENCODER['profile'], "-crf", ENCODER['crf'],
+            f"-b:v:{i}", bitrate,
+            f"-maxrate:v:{i}", bitrate,
+            f"-bufsize:v:{i}", f"{int(int(bitrate[:-1])*2)}k",
+        ]
+
+    command += [
+        "-map", "a:0?", "-c:a", ENCODER['audio_codec'], "-b:a", ENCODER['audio_bitrate'], "-ar", ENCODER['sample_rate'],
+        "-f", "dash",
+        "-seg_duration", ENCODER['segment_seconds'],
+        *_dash_packaging(),
+        os.path.join(dash_dir, "manifest.mpd")
+    ]
+    return command
+
+
 def _bulk_hls(stream_instance) -> bool:
     """Bulk segmenter for HLS format"""
     if not stream_instance.file:
@@ -302,7 +607,7 @@ def _bulk_hls(stream_instance) -> bool:
         )
 
     rawfile_path = stream_instance.raw.path
-    hls_dir = stream_instance.hls.root
+    hls_dir = stream_instance.scratch_root('hls')
     resolutions = stream_instance.supported_resolutions
 
     if not hls_dir:
@@ -319,57 +624,16 @@ def _bulk_hls(stream_instance) -> bool:
         )
 
     try:
-        split_labels = [f"[v{i+1}]" for i in range(split_count)]
-        filter_parts = [f"[v:0]split={split_count}{''.join(split_labels)}"]
-
-        scale_labels = []
-        for i, (res, _) in enumerate(resolutions):
-            label = f"[v{i+1}]scale={res}[v{i+1}out]"
-            filter_parts.append(label)
-            scale_labels.append(f"[v{i+1}out]")
-
-        filter_complex = "; ".join(filter_parts)
-        command = [
-            "ffmpeg", "-y", "-i", rawfile_path, 
-            "-filter_complex", filter_complex, 
-            "-progress", os.path.join(hls_dir, 'all.txt')
-        ]
+        hls_variants, command = _bulk_hls_command(rawfile_path, hls_dir, resolutions)
 
-        hls_variants = []
-        for i, ((res, bitrate), scale_label) in enumerate(zip(resolutions, scale_labels)):
-            res_hls_subdir = os.path.join(hls_dir, res)
-            os.makedirs(res_hls_subdir, exist_ok=True)
-            hls_playlist = os.path.join(res_hls_subdir, f"{res}.m3u8")
-            hls_seg = os.path.join(res_hls_subdir, "seg_%03d.ts")
-            hls_variants.append((hls_playlist, bitrate, res))
-
-            command += [
-                "-map", scale_label,
-                f"-c:v:{i}", "h264", "-profile:v", "main", "-crf", "20",
-                f"-b:v:{i}", bitrate,
-                f"-maxrate:v:{i}", bitrate,
-                f"-bufsize:v:{i}", f"{int(int(bitrate[:-1])*2)}k",
-                "-g", "48", "-keyint_min", "48",
-                "-map", "a:0?", f"-c:a:{i}", "aac", "-b:a", "128k", "-ar", "48000",
-                "-hls_time", "4", "-hls_playlist_type", "event",
-                "-hls_segment_filename", hls_seg,
-                hls_playlist
-            ]
-
-        success = bool(_start_process(stream_instance, 'HLS Bulk', command))
+        success = bool(_timed_process(stream_instance, 'hls', 'ladder', command))
         if not success:
             return _stop_segmentation(
                 stream_instance, 
                 f'Bulk HLS segmentation error: Process resulted to failure!'
             )
 
-        master_playlist = os.path.join(hls_dir, "master.m3u8")
-        with open(master_playlist, "w") as f:
-            f.write("#EXTM3U\n")
-            for playlist, bitrate, res in hls_variants:
-                relative_playlist = os.path.relpath(playlist, hls_dir)
-                f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={bitrate[:-1]}000,RESOLUTION={res}\n")
-                f.write(f"{relative_playlist}\n")
+        write_master_playlist(hls_dir, hls_variants)
 
         return _stop_segmentation(stream_instance)
     
@@ -389,7 +653,7 @@ def _bulk_dash(stream_instance) -> bool:
         )
 
     rawfile_path = stream_instance.raw.path
-    dash_dir = stream_instance.dash.root
+    dash_dir = stream_instance.scratch_root('dash')
     resolutions = stream_instance.supported_resolutions
 
     if not dash_dir:
@@ -406,43 +670,8 @@ def _bulk_dash(stream_instance) -> bool:
         )
 
     try:
-        split_labels = [f"[v{i+1}]" for i in range(split_count)]
-        filter_parts = [f"[v:0]split={split_count}{''.join(split_labels)}"]
-
-        scale_labels = []
-        for i, (res, _) in enumerate(resolutions):
-            label = f"[v{i+1}]scale={res}[v{i+1}out]"
-            filter_parts.append(label)
-            scale_labels.append(f"[v{i+1}out]")
-
-        filter_complex = "; ".join(filter_parts)
-        command = [
-            "ffmpeg", "-y", "-i", rawfile_path, 
-            "-filter_complex", filter_complex, 
-            "-progress", os.path.join(dash_dir, 'all.txt')
-        ]
-
-        for i, ((res, bitrate), scale_label) in enumerate(zip(resolutions, scale_labels)):
-            command += [
-                "-map", scale_label,
-                f"-c:v:{i}", "h264", "-profile:v", "main", "-crf", "20",
-                f"-b:v:{i}", bitrate,
-                f"-maxrate:v:{i}", bitrate,
-                f"-bufsize:v:{i}", f"{int(int(bitrate[:-1])*2)}k",
-            ]
-
-        command += [
-            "-map", "a:0?", "-c:a", "aac", "-b:a", "128k", "-ar", "48000",
-            "-f", "dash",
-            "-use_template", "1",
-            "-use_timeline", "1",
-            "-seg_duration", "4",
-            "-init_seg_name", "init_$RepresentationID$.m4s",
-            "-media_seg_name", "chunk_$RepresentationID$_$Number$.m4s",
-            os.path.join(dash_dir, "manifest.mpd")
-        ]
-
-        return bool(_start_process(stream_instance, 'MPEG-DASH Bulk', command))
+        command = _bulk_dash_command(rawfile_path, dash_dir, resolutions)
+        return bool(_timed_process(stream_instance, 'dash', 'ladder', command))
 
     except Exception as e:
         return _stop_segmentation(
@@ -457,15 +686,34 @@ def create_segments_bulk(stream_instance) -> typing.Tuple[bool, bool]:
     dash_success = False
 
     if ffmpeg_installed():
-        if stream_settings.ALLOW_HLS:
+        formats = stream_instance.ladder_formats
+        if 'hls' in formats:
             hls_success = _bulk_hls(stream_instance)
 
-        if stream_settings.ALLOW_DASH:
+        if 'dash' in formats:
             dash_success = _bulk_dash(stream_instance)
     return hls_success, dash_success
 
 
 # utils
+def can_run_bulk(
+        w: int, h: int, 
+        resolutions: typing.List[typing.Tuple[str, str]], 
+        processes: int = 1
+    ) -> bool:
+    """Checks if the machine has the memory for `processes` bulk segmenters running side by side"""
+    if not ffmpeg_installed():
+        return False
+
+    raw_mbpfr = _compute_mbpfr(w * h * 3)
+    _, bulk_mem = _estimate_memory_mb(raw_mbpfr, resolutions)
+    if bulk_mem <= 0.0:
+        return False
+
+    available = psutil.virtual_memory().available / (1024 ** 2)
+    return available >= bulk_mem * processes
+
+
 def get_segmenter(
         w: int, h: int, 
         resolutions: typing.List[typing.Tuple[str, str]]
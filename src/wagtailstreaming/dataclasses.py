@@ -2,7 +2,9 @@ from django.core.files import File
 
 from pathlib import Path
 import mimetypes
+import posixpath
 import logging
+import json
 import math
 import os
 
@@ -11,6 +13,7 @@ from dataclasses import (
     field
 )
 from typing import (
+    ClassVar, 
     Optional, 
     Tuple, 
     Dict, 
@@ -41,26 +44,23 @@ class Stream:
     _base_dir: str = field(default = '', init = False)
     _base_url: str = field(default = '', init = False)
 
+    # published to the rendition storage, `_name` is the directory of the manifest in it
+    _storage: Optional[Any] = field(default = None, repr = False)
+    _name: str = field(default = '', repr = False)
+
     mime: str = field(default = '', init = False)
 
     def __post_init__(self):
-        if not self.root:
-            return
+        # the caller only passes a root or a storage for streams the database marks as published,
+        # so resolving them never touches the files
+        if self._storage:
+            self.url = self._storage.url(posixpath.join(self._name, self._manifest))
 
-        if not (
-            os.path.exists(self.root) and 
-            os.path.isdir(self.root)
-        ):
-            self.root = ''
+        if not self.root:
             return
         
         self.path = os.path.join(self.root, self._manifest)
-        
-        if not (
-            os.path.exists(self.path) and 
-            os.path.isfile(self.path)
-        ):
-            self.path = ''
+        if self.url:
             return
 
         relative = os.path.relpath(self.path, self._base_dir)
@@ -106,6 +106,7 @@ class RAW(Stream):
     url: str = field(default = '')
 
     _file: Optional[File] = field(default = None, repr = False)
+    _playback: Optional[File] = field(default = None, repr = False) # faststart copy of the file, served instead of it
 
     def __post_init__(self):
         if not self._file:
@@ -120,17 +121,13 @@ class RAW(Stream):
 
         self.mime = self.check_mime()
 
-        if hasattr(self._file, 'url'):
-            if self.url != self._file.url:
-                self.url = self._file.url
+        # resolved from the stored names, callers that read the file check that it exists
+        source = self._playback or self._file
+        if hasattr(source, 'url'):
+            self.url = source.url
 
-        if hasattr(self._file, 'path'):
-            if self.path != self._file.path:
-                self.path = self._file.path
-
-        if not (os.path.exists(self.path) and os.path.isfile(self.path)):
-            self.path = ''
-            self.url = ''
+        if hasattr(source, 'path'):
+            self.path = source.path
 
     def check_mime(self):
         if not self._file:
@@ -269,6 +266,47 @@ class Duration:
         return f'{self.min:02}:{self.sec:02}'
     
 
+@dataclass
+class DownloadProgress:
+    filename: ClassVar[str] = 'progress.json'
+
+    root: str = field(default = '')
+    bytes_done: int = field(default = 0, init = False)
+    total_bytes: Optional[int] = field(default = None, init = False)
+    rate: float = field(default = 0.0, init = False)
+
+    def __post_init__(self):
+        path = os.path.join(self.root, self.filename) if self.root else ''
+        if not (path and os.path.isfile(path)):
+            return
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+
+        except (OSError, ValueError):
+            return
+
+        self.bytes_done = parse_or_default(data.get('bytes_done'), int, 0)
+        self.total_bytes = data.get('total_bytes')
+        self.rate = parse_or_default(data.get('rate'), float, 0.0)
+
+    @property
+    def percentage(self) -> float:
+        if not self.total_bytes:
+            return 0.0
+        return round((self.bytes_done / self.total_bytes) * 100, 2)
+
+    @property
+    def humanized_rate(self) -> str:
+        rate = self.rate
+        for unit in ('B', 'KB', 'MB', 'GB'):
+            if rate < 1024:
+                return f'{rate:.1f} {unit}/s'
+            rate /= 1024
+        return f'{rate:.1f} TB/s'
+
+
 @dataclass
 class Progress:
     formats: int = field(default = 2, init = False)
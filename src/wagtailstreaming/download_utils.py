@@ -1,18 +1,39 @@
-from django.core.files import File
+from django.utils import timezone
+from django.db import connection
 
-import subprocess
+import threading
 import logging
 import typing
 import shutil
+import json
+import time
 import os
 import re
 
 from .validators import VideoFileValidator
+from .dataclasses import DownloadProgress
 from .settings import stream_settings
 from .models import VideoStream
+from .rendition_utils import delete_renditions, local_rendition_dir
+from .source_utils import store_source
+from .task_utils import DOWNLOADING, download_queue, backoff_delay, sched_download
+from .ingest_utils import IngestPipeline
+from .http_utils import (
+    HTTPDownloader, 
+    ConnectionPool, 
+    DownloadError, 
+    TokenBucket, 
+    RemoteFile, 
+    resolve_gdrive, 
+    probe, 
+)
+from . import metrics
 
 LOGGER = logging.getLogger(__name__)
 
+BANDWIDTH_REFRESH_SECONDS = 5
+HEARTBEAT_SECONDS = 60 # well under `DOWNLOAD_STALE_SECONDS`, a few missed beats are not taken for a crash
+
 
 def extract_file_id(gdrive_link: str) -> typing.Optional[str]:
     """
@@ -32,38 +53,170 @@ def extract_file_id(gdrive_link: str) -> typing.Optional[str]:
     return None
 
 
-def _start_download(
-        command: typing.List[str], 
-        target_dir: str
-    ) -> typing.Optional[str]:
-    try:
-        subprocess.run(
-            command, cwd = target_dir,
-            capture_output = True, 
-            text = True, check = True, 
-        )
-        return None
-    
-    except subprocess.CalledProcessError as e:
-        return str(e)
-
-
 def _stop_download(
         stream_instance: VideoStream, 
         err_message: str = ''
     ) -> bool:
+    delay = None
     if err_message:
         stream_instance.add_remark(err_message)
+        metrics.inc('failures_total', kind = 'download')
         LOGGER.error(err_message)
 
-    stream_instance.file_url = stream_instance.file_url.replace('[DOWNLOADING] ', '')
+        # failed downloads are backed off like conversions, the retry resumes the partial download
+        stream_instance.download_attempts += 1
+        delay = backoff_delay(stream_instance.download_attempts)
+        stream_instance.download_retry_at = timezone.now() + delay
+    else:
+        stream_instance.download_attempts = 0
+        stream_instance.download_retry_at = None
+
+    stream_instance.file_url = (stream_instance.file_url or '').replace(DOWNLOADING, '') or None
+    stream_instance.download_heartbeat = None
     stream_instance.save()
+    if delay and stream_instance.file_url and not stream_instance.file:
+        sched_download(stream_instance, delay)
     return not err_message
 
 
+def claim(stream_instance: VideoStream) -> bool:
+    """
+    Marks the instance as downloading if a download slot and a connection to its host are free.
+    The conditional update keeps two workers from downloading the same instance
+    """
+    if not download_queue.can_start(stream_instance):
+        return False
+
+    file_url = stream_instance.file_url
+    now = timezone.now()
+    claimed = type(stream_instance).objects.filter(
+        id = stream_instance.id, 
+        file_url = file_url
+    ).update(file_url = f'{DOWNLOADING}{file_url}', download_heartbeat = now)
+
+    if claimed:
+        stream_instance.file_url = f'{DOWNLOADING}{file_url}'
+        stream_instance.download_heartbeat = now
+    return bool(claimed)
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Reports that the worker holding a download is alive, for as long as the download and its encode run.
+    A claim whose heartbeat stops is released by `DownloadQueueManager.release_stale`
+    """
+
+    def __init__(self, stream_instance: VideoStream):
+        super().__init__(daemon = True)
+        self.stream_class = type(stream_instance)
+        self.stream_id = stream_instance.id
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.wait(HEARTBEAT_SECONDS):
+                self.stream_class.objects.filter(
+                    id = self.stream_id, 
+                    file_url__startswith = DOWNLOADING
+                ).update(download_heartbeat = timezone.now())
+        finally:
+            # the thread has its own database connection
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class _Rebalancer:
+    """Writes the download progress and re-splits the bandwidth limit whenever downloads start or finish"""
+
+    def __init__(self, target_dir: str, throttle: TokenBucket):
+        self.target_dir = target_dir
+        self.throttle = throttle
+        self._checked_at = time.monotonic()
+
+    def __call__(self, bytes_done: int, total_bytes: typing.Optional[int], rate: float):
+        write_progress(self.target_dir, bytes_done, total_bytes, rate)
+        if time.monotonic() - self._checked_at < BANDWIDTH_REFRESH_SECONDS:
+            return
+
+        self._checked_at = time.monotonic()
+        self.throttle.set_rate(download_queue.bandwidth_share())
+
+
+def expected_checksum(file_url: str) -> str:
+    """Reads an optional `#sha256=<hex>` fragment from the file URL"""
+    match = re.search(r'#sha256=([0-9a-fA-F]{64})$', file_url or '')
+    return match.group(1).lower() if match else ''
+
+
+def resolve(
+        file_url: str,
+        pool: ConnectionPool
+    ) -> RemoteFile:
+    """Resolves Google Drive links to their direct download, other links are fetched as they are"""
+    file_id = extract_file_id(file_url)
+    if file_id:
+        return resolve_gdrive(file_id, pool)
+    return probe(file_url.split('#', 1)[0], pool)
+
+
+def _target_name(remote: RemoteFile) -> str:
+    name = re.sub(r'[^\w.\-]+', '_', os.path.basename(remote.filename or '')).strip('._')
+    return name or 'video.mp4'
+
+
+def write_progress(
+        target_dir: str,
+        bytes_done: int,
+        total_bytes: typing.Optional[int],
+        rate: float
+    ):
+    temp_path = os.path.join(target_dir, f'{DownloadProgress.filename}.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump({
+            'bytes_done': bytes_done,
+            'total_bytes': total_bytes,
+            'rate': round(rate, 2),
+        }, f)
+    os.replace(temp_path, os.path.join(target_dir, DownloadProgress.filename))
+
+
+def _apply_pipelined(
+        stream_instance: VideoStream, 
+        hls_okay: bool, 
+        dash_okay: bool
+    ):
+    """Records the streams that were encoded while the video was downloading"""
+    stream_instance.probe(save = False)
+    if stream_instance.rendition_key:
+        # an identical source was already converted, its streams were adopted when the file was stored
+        for fmt, base in (('hls', stream_settings.HLS_ROOT), ('dash', stream_settings.DASH_ROOT)):
+            for layout in {0, stream_settings.RENDITION_SHARD_DEPTH}:
+                shutil.rmtree(local_rendition_dir(base, stream_instance.hashed_id, layout = layout), ignore_errors = True)
+            delete_renditions(fmt, stream_instance.hashed_id)
+        return
+
+    if not any((hls_okay, dash_okay)):
+        stream_instance.add_remark('Encoding while downloading failed, the video is queued for conversion')
+        return
+
+    stream_instance.hls_ready = hls_okay
+    stream_instance.dash_ready = dash_okay
+    stream_instance.date_finished = timezone.now()
+    stream_instance.encoded_ladder = {
+        fmt: stream_instance.target_ladder
+        for fmt, okay in (('hls', hls_okay), ('dash', dash_okay)) if okay
+    }
+
+
 def download(stream_instance: VideoStream) -> bool:
     """
-    Assumes that stream_instance fields has been validated
+    Assumes that stream_instance fields has been validated.
+    Returns False without downloading when no download slot is free.
+    Streamable sources are encoded while they download, see `IngestPipeline`.
+    Partial downloads are kept in the download directory so a later attempt resumes them
     """
     target_dir = stream_instance.download_root
     if not target_dir:
@@ -74,42 +227,83 @@ def download(stream_instance: VideoStream) -> bool:
             )
         return False
 
-    command = ['gdown', stream_instance.file_url]
-    stream_instance.file_url = f'[DOWNLOADING] {stream_instance.file_url}'
-    stream_instance.save()
+    if not stream_instance.file_url.startswith(DOWNLOADING) and not claim(stream_instance):
+        return False
 
-    err_message = _start_download(command, target_dir)
-    if err_message:
-        return _stop_download(stream_instance, err_message)
+    heartbeat = _Heartbeat(stream_instance)
+    heartbeat.start()
+    try:
+        return _download(stream_instance, target_dir)
+    finally:
+        heartbeat.stop()
 
-    files = os.listdir(target_dir)
-    if len(files) != 1:
-        shutil.rmtree(target_dir)
-        return _stop_download(
-            stream_instance, 
-            f'Expected 1 file, found {len(files)} files in download directory {target_dir}'
+
+def _download(
+        stream_instance: VideoStream, 
+        target_dir: str
+    ) -> bool:
+    file_url = stream_instance.file_url.replace(DOWNLOADING, '')
+    throttle = TokenBucket(download_queue.bandwidth_share())
+    pool = ConnectionPool(stream_settings.DOWNLOAD_TIMEOUT)
+    pipeline = None
+    try:
+        remote = resolve(file_url, pool)
+        downloader = HTTPDownloader(
+            remote, 
+            os.path.join(target_dir, _target_name(remote)), 
+            connections = download_queue.connections_for(stream_instance), 
+            part_size = stream_settings.DOWNLOAD_PART_SIZE, 
+            expected_sha256 = expected_checksum(file_url), 
+            progress = _Rebalancer(target_dir, throttle), 
+            timeout = stream_settings.DOWNLOAD_TIMEOUT, 
+            throttle = throttle, 
         )
+        pipeline = IngestPipeline(stream_instance, downloader)
+        pipeline.start()
+        result = downloader.run()
+
+    except Exception as e:
+        # whatever failed, the instance leaves the download slot and the partial download is kept for a resume
+        if pipeline:
+            try:
+                pipeline.finish()
+            except Exception as finish_error:
+                LOGGER.error(f'Failed to stop encoding {stream_instance} while downloading: {finish_error}')
+        if not isinstance(e, (DownloadError, OSError)):
+            LOGGER.exception(f'Unexpected error while downloading {file_url}')
+        return _stop_download(stream_instance, f'Failed to download {file_url}: {e}')
 
-    file = os.path.join(target_dir, files[0])
-    if os.path.getsize(file) <= 0:
+    finally:
+        pool.close()
+
+    hls_okay, dash_okay = pipeline.finish()
+
+    if result.size <= 0:
         shutil.rmtree(target_dir)
         return _stop_download(
             stream_instance, 
             f'File has been downloaded but file has no contents!'
         )
 
+    metrics.inc('download_bytes_total', result.size)
+    if result.seconds > 0:
+        metrics.observe('download_throughput_bytes', result.size / result.seconds)
+
     try:
-        with open(file, 'rb') as f:
-            file_instance = File(f)
-            validate = VideoFileValidator(stream_settings.VIDEO_EXTENSIONS)
-            validate(file_instance)
-            stream_instance.file.save(os.path.basename(file), file_instance, save = True)
+        # the downloader kept the first bytes and the hash, the file is validated and stored without reading it again
+        filename = os.path.basename(result.path)
+        validate = VideoFileValidator(stream_settings.VIDEO_EXTENSIONS)
+        validate.validate_header(filename, result.header)
+        stream_instance.file = store_source(stream_instance, result.path, filename, result.sha256)
+        stream_instance.save()
 
         shutil.rmtree(target_dir)
+        if pipeline.started:
+            _apply_pipelined(stream_instance, hls_okay, dash_okay)
         return _stop_download(stream_instance)
 
     except Exception as e:
         return _stop_download(
             stream_instance, 
-            f"Failed to save file {file} as raw file: {e}"
+            f"Failed to save file {result.path} as raw file: {e}"
         )
\ No newline at end of file
@@ -1,5 +1,6 @@
 from django.utils.translation import gettext_lazy as _
 from django.utils.module_loading import import_string
+from django.urls import reverse_lazy
 from django.forms.models import modelform_factory
 from django.db import models
 from django import forms
@@ -17,7 +18,9 @@ import logging
  
 from .settings import stream_settings
 from .permissions import perm_policy
+from .dataclasses import VideoAttribute
 from .models import VideoStream
+from . import upload_utils
 from .utils import get_list_fields_or_default
 
 LOGGER = logging.getLogger(__name__)
@@ -26,6 +29,46 @@ LOGGER = logging.getLogger(__name__)
 class BaseStreamForm(BaseCollectionMemberForm):
     permission_policy = perm_policy
 
+    # set by `upload.js` once a chunked upload of the file is complete
+    upload_session = forms.UUIDField(
+        required = False, 
+        widget = forms.HiddenInput(attrs = {'data-upload-session': ''})
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.get('user')
+        self.session = None
+        super().__init__(*args, **kwargs)
+
+        if stream_settings.CHUNKED_UPLOADS and 'file' in self.fields:
+            self.fields['file'].widget.attrs.update({
+                'data-chunked-upload-url': reverse_lazy('wagtailstreaming:upload_create'), 
+                'data-chunk-size': stream_settings.UPLOAD_CHUNK_SIZE, 
+            })
+
+    def clean(self):
+        cleaned_data = super().clean()
+        session_id = cleaned_data.get('upload_session')
+        if session_id and 'file' in self.fields:
+            self.session = upload_utils.claim_session(session_id, self.user)
+            if not self.session:
+                self.add_error('file', _('The uploaded file could not be found, please upload it again.'))
+            else:
+                cleaned_data['file'] = self.session.stored_name
+        return cleaned_data
+
+    def save(self, commit = True):
+        instance = super().save(commit)
+        if commit and self.session:
+            # the file was probed while its chunks arrived, the queue does not need to probe it again
+            if self.session.attributes:
+                instance.probe(attrs = VideoAttribute(raw = self.session.attributes))
+            self.session.delete()
+        return instance
+
+    class Media:
+        js = ['wagtailstreaming/js/upload.js']
+
     class Meta:
         widgets = {
             'file': forms.ClearableFileInput(attrs = {
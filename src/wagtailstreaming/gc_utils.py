@@ -0,0 +1,264 @@
+from django.conf import settings as user_settings
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import typing
+import time
+import os
+import re
+
+from .models import CleanupJob, CleanupKind, UploadSession, get_stream_model
+from .rendition_utils import SHARD_WIDTH, is_version, remove_tree
+from .source_utils import FASTSTART_DIR, HASH_DIR, TEMP_DIR, get_source_storage
+from .settings import stream_settings
+from .http_utils import TokenBucket
+from .utils import hash_this
+
+LOGGER = logging.getLogger(__name__)
+
+STAGING_PATTERN = re.compile(r'\.\d+(?:\.tmp|\.old)$') # left behind by `publish_directory` when a worker died
+QUERY_CHUNK_SIZE = 2000
+
+
+class Orphan(typing.NamedTuple):
+    target: str
+    path: str
+    reason: str
+    size: int
+
+
+class LiveFiles:
+    """Everything the stored instances still reference, collected in one streaming query"""
+
+    def __init__(self):
+        self.keys: typing.Set[str] = set()
+        self.versions: typing.Set[typing.Tuple[str, str, int]] = set()
+        self.pending: typing.Set[typing.Tuple[str, str]] = set()
+        self.downloads: typing.Set[str] = set()
+        self.sources: typing.Set[str] = set()
+        self.sessions: typing.Set[str] = set()
+        self.retiring: typing.Set[typing.Tuple[str, str]] = set()
+
+    @classmethod
+    def collect(cls) -> 'LiveFiles':
+        live = cls()
+        depth = stream_settings.RENDITION_SHARD_DEPTH
+        rows = get_stream_model().objects.values_list(
+            'id', 'rendition_key', 'rendition_version', 'rendition_layout', 'pending_version',
+            'file', 'faststart_name', 'file_url',
+        ).iterator(chunk_size = QUERY_CHUNK_SIZE)
+
+        for pk, key, version, layout, pending, file, faststart, file_url in rows:
+            hashed_id = hash_this(pk)
+            key = key or hashed_id
+            live.keys.add(key)
+            live.versions.add((key, version, layout))
+            if pending:
+                live.versions.add((key, pending, depth))
+                live.pending.add((key, pending))
+            if file_url and not file:
+                live.downloads.add(hashed_id)
+            live.sources.update(filter(None, (file, faststart)))
+
+        # versions in their grace period or waiting for a cleanup job are deleted by that job
+        live.retiring.update(CleanupJob.objects.filter(kind = CleanupKind.RENDITIONS).values_list('name', 'version'))
+        live.sessions.update(str(pk) for pk in UploadSession.objects.values_list('pk', flat = True))
+        return live
+
+    def retired(self, key: str, version: str = '') -> bool:
+        return (key, version) in self.retiring or (not version and any(k == key for k, _ in self.retiring))
+
+
+def tree_size(path: str) -> int:
+    """Bytes freed by deleting `path`, files hardlinked into another version are not counted"""
+    try:
+        stat = os.stat(path, follow_symlinks = False)
+    except FileNotFoundError:
+        return 0
+    if not os.path.isdir(path):
+        return stat.st_size if stat.st_nlink <= 1 else 0
+
+    size = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks = False):
+                        stack.append(entry.path)
+                        continue
+                    stat = entry.stat(follow_symlinks = False)
+                    if stat.st_nlink <= 1:
+                        size += stat.st_size
+        except FileNotFoundError:
+            continue
+    return size
+
+
+def _entries(path: str) -> typing.List[os.DirEntry]:
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _old(entry: os.DirEntry, cutoff: float) -> bool:
+    # new directories may belong to an encode or an upload whose row is not saved yet
+    try:
+        return entry.stat(follow_symlinks = False).st_mtime < cutoff
+    except FileNotFoundError:
+        return False
+
+
+class Collector:
+    """
+    Finds the files below the rendition, scratch, download, thumbnail and source roots that no instance references.
+    Every root is split at its first level and scanned by a pool of `os.scandir` workers
+    """
+
+    def __init__(
+            self,
+            live: LiveFiles,
+            min_age: int,
+            workers: typing.Optional[int] = None
+        ):
+        self.live = live
+        self.cutoff = time.time() - min_age
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+
+    def orphan(self, target: str, entry: os.DirEntry, reason: str) -> typing.List[Orphan]:
+        if not _old(entry, self.cutoff):
+            return []
+        return [Orphan(target, entry.path, reason, tree_size(entry.path))]
+
+    def scan_rendition_entry(self, target: str, entry: os.DirEntry, layout: int = 0) -> typing.List[Orphan]:
+        if STAGING_PATTERN.search(entry.name):
+            return self.orphan(target, entry, 'staging')
+        if not entry.is_dir(follow_symlinks = False):
+            return []
+
+        if len(entry.name) == SHARD_WIDTH:
+            return [
+                orphan
+                for child in _entries(entry.path)
+                for orphan in self.scan_rendition_entry(target, child, layout + 1)
+            ]
+
+        key = entry.name
+        if key not in self.live.keys:
+            return [] if self.live.retired(key) else self.orphan(target, entry, 'key')
+
+        orphans = []
+        legacy = (key, '', layout) in self.live.versions or self.live.retired(key)
+        for child in _entries(entry.path):
+            if STAGING_PATTERN.search(child.name):
+                orphans += self.orphan(target, child, 'staging')
+            elif is_version(child.name):
+                if (key, child.name, layout) not in self.live.versions and not self.live.retired(key, child.name):
+                    orphans += self.orphan(target, child, 'version')
+            elif not legacy:
+                orphans += self.orphan(target, child, 'unversioned')
+        return orphans
+
+    def scan_scratch_entry(self, target: str, entry: os.DirEntry) -> typing.List[Orphan]:
+        """`<scratch>/<format>/<key>/<version>`, encodes of older releases wrote to `<key>` itself"""
+        orphans = []
+        for key in _entries(entry.path):
+            versions = [child for child in _entries(key.path) if is_version(child.name)]
+            if not versions:
+                if (key.name, '') not in self.live.pending:
+                    orphans += self.orphan(target, key, 'scratch')
+                continue
+
+            for version in versions:
+                if (key.name, version.name) not in self.live.pending:
+                    orphans += self.orphan(target, version, 'scratch')
+        return orphans
+
+    def scan_download_entry(self, target: str, entry: os.DirEntry) -> typing.List[Orphan]:
+        if entry.name in self.live.downloads:
+            return []
+        return self.orphan(target, entry, 'download')
+
+    def scan_thumbnail_entry(self, target: str, entry: os.DirEntry) -> typing.List[Orphan]:
+        # thumbnails are only kept here while they are copied into the thumbnail storage
+        return self.orphan(target, entry, 'thumbnail')
+
+    def scan_source_entry(self, target: str, entry: os.DirEntry) -> typing.List[Orphan]:
+        """Content addressed sources and their faststart copies that no instance points at"""
+        storage = get_source_storage()
+        orphans = []
+        stack = [entry]
+        while stack:
+            current = stack.pop()
+            if current.is_dir(follow_symlinks = False):
+                stack.extend(_entries(current.path))
+                continue
+
+            name = os.path.relpath(current.path, storage.path('')).replace(os.sep, '/')
+            if name not in self.live.sources:
+                orphans += self.orphan(target, current, 'source')
+        return orphans
+
+    def scan_incoming_entry(self, target: str, entry: os.DirEntry) -> typing.List[Orphan]:
+        """Parts of resumable uploads without a session and temporary files of interrupted writes"""
+        stem, extension = os.path.splitext(entry.name)
+        if extension == '.part' and stem in self.live.sessions:
+            return []
+        return self.orphan(target, entry, 'incoming')
+
+    def roots(self) -> typing.List[typing.Tuple[str, str, typing.Callable]]:
+        """(target, directory, scanner of its first level entries)"""
+        roots = [
+            ('hls', stream_settings.HLS_ROOT, self.scan_rendition_entry),
+            ('dash', stream_settings.DASH_ROOT, self.scan_rendition_entry),
+            ('downloads', stream_settings.DOWNLOAD_ROOT, self.scan_download_entry),
+            ('thumbnails', os.path.join(user_settings.MEDIA_ROOT, 'temp_thumbnails'), self.scan_thumbnail_entry),
+        ]
+        if stream_settings.ENCODE_SCRATCH_ROOT:
+            roots.append(('scratch', stream_settings.ENCODE_SCRATCH_ROOT, self.scan_scratch_entry))
+
+        if stream_settings.CONTENT_ADDRESSED_SOURCES:
+            storage = get_source_storage()
+            upload_to = get_stream_model()._meta.get_field('file').upload_to
+            roots += [
+                ('sources', storage.path(f'{upload_to}/{HASH_DIR}'), self.scan_source_entry),
+                ('incoming', storage.path(TEMP_DIR), self.scan_incoming_entry),
+                ('faststart', storage.path(FASTSTART_DIR), self.scan_source_entry),
+            ]
+        return roots
+
+    def scan(self, targets: typing.Optional[typing.Iterable[str]] = None) -> typing.List[Orphan]:
+        selected = [root for root in self.roots() if not targets or root[0] in targets]
+        with ThreadPoolExecutor(max_workers = self.workers) as pool:
+            futures = [
+                pool.submit(scanner, target, entry)
+                for target, directory, scanner in selected
+                for entry in _entries(directory)
+            ]
+            return [orphan for future in futures for orphan in future.result()]
+
+
+def remove_orphan(orphan: Orphan, throttle: typing.Optional[TokenBucket] = None):
+    if os.path.isdir(orphan.path) and not os.path.islink(orphan.path):
+        remove_tree(orphan.path, throttle)
+    else:
+        if throttle:
+            throttle.consume(1)
+        try:
+            os.remove(orphan.path)
+        except FileNotFoundError:
+            pass
+
+    if orphan.target not in ('hls', 'dash'):
+        return
+
+    # shard directories that held nothing else
+    parent = os.path.dirname(orphan.path)
+    while len(os.path.basename(parent)) == SHARD_WIDTH:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
@@ -0,0 +1,545 @@
+from urllib.parse import urljoin, urlsplit, urlencode
+from html.parser import HTMLParser
+from email.message import Message
+from http import client
+
+from dataclasses import dataclass, field
+from typing import (
+    Callable,
+    Optional,
+    Tuple,
+    Dict,
+    Set,
+)
+
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+import re
+
+LOGGER = logging.getLogger(__name__)
+
+USER_AGENT = 'wagtailstreaming-downloader'
+CHUNK_SIZE = 256 * 1024
+MAX_REDIRECTS = 8
+PROGRESS_INTERVAL = 1.0
+HEADER_BYTES = 64 * 1024
+
+ProgressCallback = Callable[[int, Optional[int], float], None]
+
+
+class DownloadError(Exception):
+    pass
+
+
+@dataclass
+class RemoteFile:
+    url: str = field(default = '')
+    size: Optional[int] = field(default = None)
+    accepts_ranges: bool = field(default = False)
+    filename: str = field(default = '')
+    etag: str = field(default = '')
+    content_type: str = field(default = '')
+
+
+@dataclass
+class DownloadResult:
+    path: str = field(default = '')
+    size: int = field(default = 0)
+    sha256: str = field(default = '')
+    filename: str = field(default = '')
+    seconds: float = field(default = 0.0)
+    header: bytes = field(default = b'', repr = False) # first bytes, kept while hashing so nobody reads them again
+
+
+class TokenBucket:
+    """
+    Limits the bytes per second passing through `consume`, shared by every thread of a download.
+    Consumers go into debt and sleep it off, so chunks larger than the burst still pass. A rate of 0 disables the limit
+    """
+
+    def __init__(self, rate: float = 0.0, burst_seconds: float = 1.0):
+        self.rate = max(rate, 0.0)
+        self.burst_seconds = burst_seconds
+        self._tokens = self.rate * burst_seconds
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self.rate = max(rate, 0.0)
+            self._tokens = min(self._tokens, self.rate * self.burst_seconds)
+
+    def consume(self, amount: int):
+        with self._lock:
+            if self.rate <= 0:
+                return
+
+            now = time.monotonic()
+            capacity = self.rate * self.burst_seconds
+            self._tokens = min(capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ConnectionPool:
+    """Keeps one persistent connection per host for every thread that uses the pool"""
+
+    def __init__(self, timeout: float = 30.0):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connections(self) -> Dict[Tuple[str, str], client.HTTPConnection]:
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _connection(self, scheme: str, netloc: str) -> client.HTTPConnection:
+        connections = self._connections()
+        key = (scheme, netloc)
+        if key not in connections:
+            klass = client.HTTPSConnection if scheme == 'https' else client.HTTPConnection
+            connections[key] = klass(netloc, timeout = self.timeout)
+        return connections[key]
+
+    def discard(self, url: str):
+        parts = urlsplit(url)
+        connection = self._connections().pop((parts.scheme, parts.netloc), None)
+        if connection:
+            connection.close()
+
+    def close(self):
+        for connection in self._connections().values():
+            connection.close()
+        self._connections().clear()
+
+    def request(
+            self,
+            method: str,
+            url: str,
+            headers: Optional[Dict[str, str]] = None
+        ) -> Tuple[str, client.HTTPResponse]:
+        """Sends a request, following redirects. Returns the final url and the unread response"""
+        headers = {'User-Agent': USER_AGENT, **(headers or {})}
+        for _ in range(MAX_REDIRECTS):
+            parts = urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path = f'{path}?{parts.query}'
+
+            try:
+                connection = self._connection(parts.scheme, parts.netloc)
+                connection.request(method, path, headers = headers)
+                response = connection.getresponse()
+
+            except (OSError, client.HTTPException):
+                # stale keep-alive connection, retry once on a fresh one
+                self.discard(url)
+                connection = self._connection(parts.scheme, parts.netloc)
+                connection.request(method, path, headers = headers)
+                response = connection.getresponse()
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                if not location:
+                    raise DownloadError(f'Redirect without a location from {url}')
+                url = urljoin(url, location)
+                continue
+            return url, response
+        raise DownloadError(f'Too many redirects for {url}')
+
+
+def _filename_from_headers(response: client.HTTPResponse) -> str:
+    disposition = response.getheader('Content-Disposition') or ''
+    if not disposition:
+        return ''
+
+    message = Message()
+    message['Content-Disposition'] = disposition
+    return os.path.basename(message.get_filename() or '')
+
+
+def probe(url: str, pool: ConnectionPool) -> RemoteFile:
+    """Asks for the first byte to learn the final url, size and range support of a remote file"""
+    final_url, response = pool.request('GET', url, {'Range': 'bytes=0-0'})
+    content_type = response.getheader('Content-Type') or ''
+    remote = RemoteFile(
+        url = final_url,
+        filename = _filename_from_headers(response) or os.path.basename(urlsplit(final_url).path),
+        etag = response.getheader('ETag') or '',
+        content_type = content_type,
+    )
+
+    if response.status == 206:
+        match = re.match(r'bytes \d+-\d+/(\d+)', response.getheader('Content-Range') or '')
+        remote.size = int(match.group(1)) if match else None
+        remote.accepts_ranges = remote.size is not None
+        response.read()
+
+    elif response.status == 200:
+        length = response.getheader('Content-Length')
+        remote.size = int(length) if length and length.isdigit() else None
+        # the server ignored the range and started sending the whole body, drop the connection
+        pool.discard(final_url)
+        response.close()
+
+    else:
+        response.read()
+        raise DownloadError(f'Unexpected status {response.status} for {url}')
+    return remote
+
+
+class _FormParser(HTMLParser):
+    """Collects the action and hidden inputs of the first form, which is how Google Drive confirms large downloads"""
+
+    def __init__(self):
+        super().__init__()
+        self.action = ''
+        self.inputs = {}
+        self._in_form = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form' and not self.action:
+            self.action = attrs.get('action') or ''
+            self._in_form = True
+
+        elif tag == 'input' and self._in_form and attrs.get('name'):
+            self.inputs[attrs['name']] = attrs.get('value') or ''
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self._in_form = False
+
+
+def gdrive_direct_url(file_id: str) -> str:
+    return f'https://drive.usercontent.google.com/download?{urlencode({"id": file_id, "export": "download", "confirm": "t"})}'
+
+
+def resolve_gdrive(file_id: str, pool: ConnectionPool) -> RemoteFile:
+    """Resolves a Google Drive file id to a direct download, going through the virus scan warning if needed"""
+    remote = probe(gdrive_direct_url(file_id), pool)
+    if not remote.content_type.startswith('text/html'):
+        return remote
+
+    _, response = pool.request('GET', remote.url)
+    parser = _FormParser()
+    parser.feed(response.read().decode('utf-8', 'replace'))
+    if not parser.action:
+        raise DownloadError(f'Google Drive did not provide a download for file {file_id}, is the file shared publicly?')
+
+    action = urljoin(remote.url, parser.action)
+    remote = probe(f'{action}?{urlencode(parser.inputs)}', pool)
+    if remote.content_type.startswith('text/html'):
+        raise DownloadError(f'Google Drive refused the download of file {file_id}')
+    return remote
+
+
+class HTTPDownloader:
+    """
+    Downloads a remote file with parallel range requests over pooled connections.
+    Finished parts are recorded next to the target so an interrupted download resumes where it stopped,
+    and the file is hashed in order while the parts arrive so it never has to be read again
+    """
+
+    def __init__(
+            self,
+            remote: RemoteFile,
+            target_path: str,
+            connections: int = 4,
+            part_size: int = 8 * 1024 * 1024,
+            expected_sha256: str = '',
+            progress: Optional[ProgressCallback] = None,
+            timeout: float = 30.0,
+            max_retries: int = 3,
+            throttle: Optional[TokenBucket] = None,
+        ):
+        self.remote = remote
+        self.target_path = target_path
+        self.partial_path = f'{target_path}.part'
+        self.state_path = f'{target_path}.state'
+        self.connections = max(1, connections)
+        self.part_size = max(CHUNK_SIZE, part_size)
+        self.expected_sha256 = expected_sha256.lower()
+        self.progress = progress
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.throttle = throttle or TokenBucket()
+
+        self.pool = ConnectionPool(timeout)
+        self._hasher = hashlib.sha256()
+        self._cond = threading.Condition()
+        self._failure: Optional[BaseException] = None
+        self._done: Set[int] = set()
+        self._resumed: Set[int] = set()
+        self._pending: Dict[int, bytes] = {}
+        self._next_hash = 0
+        self._next_part = 0
+        self._bytes = 0
+        self._last_report = (time.monotonic(), 0)
+        self._streamed = 0
+        self._header = bytearray()
+        self.finished = threading.Event()
+        self.succeeded = False
+
+    # bookkeeping
+    @property
+    def parts(self) -> int:
+        return -(-self.remote.size // self.part_size) if self.remote.size else 0
+
+    @property
+    def contiguous_bytes(self) -> int:
+        """Bytes from the start of the file that are written without gaps, the prefix a progressive reader may consume"""
+        if self.remote.accepts_ranges and self.remote.size:
+            return min(self._next_hash * self.part_size, self.remote.size)
+        return self._streamed
+
+    def _part_range(self, index: int) -> Tuple[int, int]:
+        start = index * self.part_size
+        return start, min(start + self.part_size, self.remote.size) - 1
+
+    def _load_state(self) -> Set[int]:
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+
+        except (OSError, ValueError):
+            return set()
+
+        same_file = all((
+            state.get('size') == self.remote.size,
+            state.get('etag') == self.remote.etag,
+            state.get('part_size') == self.part_size,
+            os.path.exists(self.partial_path),
+        ))
+        return set(state.get('done', [])) if same_file else set()
+
+    def _save_state(self):
+        temp_path = f'{self.state_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'url': self.remote.url,
+                'size': self.remote.size,
+                'etag': self.remote.etag,
+                'part_size': self.part_size,
+                'done': sorted(self._done),
+            }, f)
+        os.replace(temp_path, self.state_path)
+
+    def _report(self, force: bool = False):
+        if not self.progress:
+            return
+
+        now = time.monotonic()
+        last_time, last_bytes = self._last_report
+        if not force and now - last_time < PROGRESS_INTERVAL:
+            return
+
+        elapsed = now - last_time
+        rate = (self._bytes - last_bytes) / elapsed if elapsed > 0 else 0.0
+        self._last_report = (now, self._bytes)
+        try:
+            self.progress(self._bytes, self.remote.size, rate)
+        except Exception as e:
+            LOGGER.error(f'Download progress callback failed: {e}')
+
+    def _digest(self, data: bytes):
+        """Hashes the next bytes of the file in order"""
+        if len(self._header) < HEADER_BYTES:
+            self._header += data[:HEADER_BYTES - len(self._header)]
+        self._hasher.update(data)
+
+    # parallel path
+    def _drain(self, fd: int):
+        """Hashes every part that is next in line, called with the condition held"""
+        while self._next_hash < self.parts:
+            index = self._next_hash
+            if index in self._pending:
+                self._digest(self._pending.pop(index))
+
+            elif index in self._resumed:
+                start, end = self._part_range(index)
+                self._digest(os.pread(fd, end - start + 1, start))
+
+            else:
+                break
+            self._next_hash += 1
+        self._cond.notify_all()
+
+    def _claim(self) -> Optional[int]:
+        """Hands out the next missing part, keeping workers close enough to the hasher to bound memory"""
+        window = self.connections * 2
+        with self._cond:
+            while self._next_part < self.parts and self._next_part in self._done:
+                self._next_part += 1
+
+            if self._next_part >= self.parts:
+                return None
+
+            index = self._next_part
+            self._next_part += 1
+            while index - self._next_hash >= window and self._failure is None:
+                self._cond.wait(timeout = 1.0)
+            return index if self._failure is None else None
+
+    def _fetch(self, index: int) -> bytes:
+        start, end = self._part_range(index)
+        for attempt in range(self.max_retries + 1):
+            buffer = bytearray()
+            try:
+                _, response = self.pool.request('GET', self.remote.url, {'Range': f'bytes={start}-{end}'})
+                if response.status != 206:
+                    response.read()
+                    raise DownloadError(f'Expected a partial response for bytes {start}-{end}, got status {response.status}')
+
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    buffer += chunk
+                    self.throttle.consume(len(chunk))
+                    with self._cond:
+                        self._bytes += len(chunk)
+                        self._report()
+
+                if len(buffer) != end - start + 1:
+                    raise DownloadError(f'Received {len(buffer)} bytes for bytes {start}-{end}')
+                return bytes(buffer)
+
+            except (OSError, ValueError, client.HTTPException, DownloadError) as e:
+                # the part is fetched again from its start, its bytes are not counted twice
+                with self._cond:
+                    self._bytes -= len(buffer)
+                self.pool.discard(self.remote.url)
+                if attempt >= self.max_retries:
+                    raise DownloadError(f'Failed to fetch bytes {start}-{end}: {e}')
+                time.sleep(2 ** attempt)
+
+    def _worker(self, fd: int):
+        try:
+            while self._failure is None:
+                index = self._claim()
+                if index is None:
+                    return
+
+                data = self._fetch(index)
+                start, _ = self._part_range(index)
+                os.pwrite(fd, data, start)
+
+                with self._cond:
+                    self._done.add(index)
+                    self._pending[index] = data
+                    self._drain(fd)
+                    self._save_state()
+
+        except BaseException as e:
+            with self._cond:
+                self._failure = self._failure or e
+                self._cond.notify_all()
+
+        finally:
+            self.pool.close()
+
+    def _run_parallel(self):
+        self._resumed = self._load_state()
+        self._done = set(self._resumed)
+
+        mode = 'r+b' if self._resumed else 'w+b'
+        with open(self.partial_path, mode) as f:
+            f.truncate(self.remote.size)
+            fd = f.fileno()
+
+            self._bytes = sum(
+                end - start + 1
+                for start, end in (self._part_range(i) for i in self._resumed)
+            )
+            self._last_report = (time.monotonic(), self._bytes)
+            with self._cond:
+                self._drain(fd)
+
+            workers = [
+                threading.Thread(target = self._worker, args = (fd,), daemon = True)
+                for _ in range(min(self.connections, self.parts - len(self._done)))
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            if self._failure is not None:
+                raise DownloadError(str(self._failure))
+            f.flush()
+            os.fsync(fd)
+
+    # single stream path, for servers without range support
+    def _run_stream(self):
+        self._bytes = 0
+        _, response = self.pool.request('GET', self.remote.url)
+        if response.status != 200:
+            response.read()
+            raise DownloadError(f'Unexpected status {response.status} for {self.remote.url}')
+
+        # unbuffered so progressive readers never see bytes that are counted but not written
+        with open(self.partial_path, 'wb', buffering = 0) as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                self.throttle.consume(len(chunk))
+                self._digest(chunk)
+                self._bytes += len(chunk)
+                self._streamed = self._bytes
+                self._report()
+            f.flush()
+            os.fsync(f.fileno())
+        self.pool.close()
+
+    def run(self) -> DownloadResult:
+        try:
+            result = self._run()
+            self.succeeded = True
+            return result
+
+        finally:
+            self.finished.set()
+
+    def _run(self) -> DownloadResult:
+        start = time.monotonic()
+        if self.remote.accepts_ranges and self.remote.size:
+            self._run_parallel()
+        else:
+            self._run_stream()
+        self._report(force = True)
+
+        size = os.path.getsize(self.partial_path)
+        if self.remote.size is not None and size != self.remote.size:
+            raise DownloadError(f'Expected {self.remote.size} bytes, downloaded {size} bytes')
+
+        sha256 = self._hasher.hexdigest()
+        if self.expected_sha256 and sha256 != self.expected_sha256:
+            os.remove(self.partial_path)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            raise DownloadError(f'Checksum mismatch, expected sha256 {self.expected_sha256}, got {sha256}')
+
+        os.replace(self.partial_path, self.target_path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+        return DownloadResult(
+            path = self.target_path,
+            size = size,
+            sha256 = sha256,
+            filename = self.remote.filename,
+            seconds = time.monotonic() - start,
+            header = bytes(self._header),
+        )
@@ -0,0 +1,328 @@
+from django.db import IntegrityError, transaction
+
+from wagtail.search.backends import get_search_backends
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import mimetypes
+import hashlib
+import logging
+import typing
+import shutil
+import errno
+import os
+
+from .conversion_utils import check_attributes
+from .dataclasses import VideoAttribute
+from .models import get_stream_model
+from .source_utils import ContentAddressedStorage, get_source_storage, source_name, source_referenced
+from .signals import source_link
+from .validators import sniff_mime
+
+LOGGER = logging.getLogger(__name__)
+
+READ_SIZE = 8 * 1024 * 1024
+FICLONE = 0x40049409 # linux ioctl that shares the extents of a file (btrfs, xfs, ...)
+
+AUTO = 'auto'
+LINK = 'link'
+REFLINK = 'reflink'
+MOVE = 'move'
+COPY = 'copy'
+PLACEMENT_MODES = (AUTO, LINK, REFLINK, MOVE, COPY)
+
+
+@dataclass
+class ImportCandidate:
+    path: str
+    title: str
+    digest: str = field(default = '')
+    attributes: typing.Dict[str, typing.Any] = field(default_factory = dict)
+    error: str = field(default = '')
+
+
+@dataclass
+class ImportReport:
+    created: typing.List[typing.Any] = field(default_factory = list)
+    skipped: typing.List[typing.Tuple[str, str]] = field(default_factory = list) # (path, reason)
+
+
+def is_video_name(name: str) -> bool:
+    mime_type, _ = mimetypes.guess_type(name)
+    return bool(mime_type) and mime_type.startswith('video/')
+
+
+def scan(directory: str, recursive: bool = True) -> typing.Iterator[os.DirEntry]:
+    """Yields the video files below `directory`, judged by their extension"""
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks = False):
+                        if recursive and not entry.name.startswith('.'):
+                            stack.append(entry.path)
+                        continue
+
+                    if is_video_name(entry.name) and entry.is_file():
+                        yield entry
+
+        except OSError as e:
+            LOGGER.warning(f'Could not scan a directory below {directory}: {e}')
+
+
+def _reflink(source: str, target: str):
+    import fcntl
+
+    with open(source, 'rb') as src, open(target, 'xb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+
+def _copy(source: str, target: str):
+    # copyfileobj on two real files lets the kernel copy (sendfile / copy_file_range) without passing through Python
+    with open(source, 'rb') as src, open(target, 'xb') as dst:
+        shutil.copyfileobj(src, dst, READ_SIZE)
+
+
+def _move(source: str, target: str):
+    os.link(source, target) # fails instead of replacing a file that is already there
+    os.remove(source)
+
+
+def place_file(source: str, target: str, mode: str = AUTO) -> str:
+    """
+    Puts `source` at `target` without copying its bytes when both are on the same filesystem.
+    `auto` tries a hardlink, then a reflink, then falls back to a copy. Raises FileExistsError if `target` exists.
+    Returns the mode that was used
+    """
+    if mode == LINK:
+        os.link(source, target)
+        return LINK
+
+    if mode == REFLINK:
+        _reflink(source, target)
+        return REFLINK
+
+    if mode == MOVE:
+        try:
+            _move(source, target)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            _copy(source, target)
+            os.remove(source)
+        return MOVE
+
+    if mode == AUTO:
+        for attempt, placer in ((LINK, os.link), (REFLINK, _reflink)):
+            try:
+                placer(source, target)
+                return attempt
+            except FileExistsError:
+                raise
+            except OSError:
+                continue
+
+    _copy(source, target)
+    return COPY
+
+
+class Importer:
+    """
+    Creates stream instances from video files that are already on the server.
+    Files are validated, hashed and probed by a pool of threads (the work happens in hashlib, libmagic and ffprobe,
+    which do not hold the GIL), placed into the source storage without copying where the filesystem allows it,
+    and inserted with `bulk_create`
+    """
+
+    def __init__(
+            self,
+            user = None,
+            collection = None,
+            workers: typing.Optional[int] = None,
+            batch_size: int = 500,
+            mode: str = AUTO,
+            log: typing.Optional[typing.Callable[[str], None]] = None
+        ):
+        self.user = user
+        self.collection = collection
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 2)
+        self.batch_size = batch_size
+        self.mode = mode
+        self.log = log or LOGGER.info
+
+        self.model = get_stream_model()
+        self.storage = get_source_storage()
+        self.upload_to = self.model._meta.get_field('file').upload_to
+        self.content_addressed = isinstance(self.storage, ContentAddressedStorage)
+        self._titles: typing.Set[str] = set()
+
+    # inspection, runs on the pool
+    def inspect(self, candidate: ImportCandidate) -> ImportCandidate:
+        try:
+            hasher = hashlib.sha256() if self.content_addressed else None
+            with open(candidate.path, 'rb') as f:
+                head = f.read(READ_SIZE)
+                mime = sniff_mime(head)
+                if not mime.startswith('video/'):
+                    candidate.error = f'unsupported file type {mime}'
+                    return candidate
+
+                if hasher:
+                    chunk = head
+                    while chunk:
+                        hasher.update(chunk)
+                        chunk = f.read(READ_SIZE)
+                    candidate.digest = hasher.hexdigest()
+
+            candidate.attributes = check_attributes(candidate.path) or {}
+
+        except Exception as e: # e.g. libmagic failing on a file, the other files are still imported
+            candidate.error = str(e)
+        return candidate
+
+    # placement and rows, run on the calling thread
+    def _target_name(self, candidate: ImportCandidate) -> str:
+        name = os.path.join(self.upload_to, os.path.basename(candidate.path))
+        if self.content_addressed:
+            return source_name(self.upload_to, candidate.digest, os.path.splitext(name)[1].lower())
+        return self.storage.get_available_name(name)
+
+    def place(self, candidate: ImportCandidate) -> typing.Tuple[str, str]:
+        """Returns the stored name and the placement mode used, empty if identical contents were stored already"""
+        name = self._target_name(candidate)
+        target = self.storage.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok = True)
+
+        while True:
+            try:
+                used = place_file(candidate.path, target, self.mode)
+                break
+            except FileExistsError:
+                if self.content_addressed: # the same contents are stored already
+                    if self.mode == MOVE:
+                        os.remove(candidate.path)
+                    return name, ''
+                name = self.storage.get_available_name(name)
+                target = self.storage.path(name)
+
+        if self.storage.file_permissions_mode is not None and used in (COPY, REFLINK):
+            os.chmod(target, self.storage.file_permissions_mode)
+        return name, used
+
+    def unplace(self, instance):
+        """Takes back the file of a row that was not created, a moved file goes back where it came from"""
+        path, used = getattr(instance, '_placement', ('', ''))
+        name = instance.file.name
+        if not used or source_referenced(self.model, name):
+            # identical contents that were stored before belong to the instances that use them
+            return
+
+        target = self.storage.path(name)
+        try:
+            if used == MOVE and path and not os.path.exists(path):
+                shutil.move(target, path)
+            else:
+                os.remove(target)
+        except OSError as e:
+            LOGGER.warning(f'Could not remove {target} of a skipped import: {e}')
+
+    def build(self, candidate: ImportCandidate):
+        name, used = self.place(candidate)
+        instance = self.model(
+            title = candidate.title,
+            file = name,
+            uploaded_by = self.user,
+            collection = self.collection,
+            source_hash = candidate.digest,
+        )
+        instance._placement = (candidate.path, used)
+        if candidate.attributes:
+            instance.probe(save = False, attrs = VideoAttribute(raw = candidate.attributes))
+        return instance
+
+    def flush(self, instances: list, report: ImportReport):
+        if not instances:
+            return
+
+        try:
+            with transaction.atomic():
+                created = self.model.objects.bulk_create(instances)
+
+        except IntegrityError: # a title was taken meanwhile, fall back to one row at a time
+            created = []
+            for instance in instances:
+                try:
+                    with transaction.atomic():
+                        instance.save()
+                    created.append(instance)
+                except IntegrityError:
+                    self.unplace(instance)
+                    report.skipped.append((instance.file.name, f'duplicate title {instance.title}'))
+
+        else:
+            # bulk_create does not send post_save, the instances get the hook that saved ones get
+            for instance in created:
+                if instance.pk:
+                    source_link(self.model, instance, created = True)
+
+        for backend in get_search_backends():
+            backend.add_bulk(self.model, created)
+
+        report.created.extend(created)
+        self.log(f'Created {len(report.created)} streams')
+        instances.clear()
+
+    def candidates(self, paths: typing.Iterable[str], report: ImportReport) -> typing.Iterator[ImportCandidate]:
+        for path in paths:
+            title = os.path.splitext(os.path.basename(path))[0][:255]
+            if title in self._titles:
+                report.skipped.append((path, f'duplicate title {title}'))
+                continue
+
+            self._titles.add(title)
+            yield ImportCandidate(path = path, title = title)
+
+    def run(self, paths: typing.Iterable[str]) -> ImportReport:
+        report = ImportReport()
+        self._titles = set(self.model.objects.values_list('title', flat = True))
+        pending = self.candidates(paths, report)
+        batch = []
+
+        with ThreadPoolExecutor(max_workers = self.workers) as pool:
+            in_flight = set()
+            exhausted = False
+            while in_flight or not exhausted:
+                # keep the pool busy without queueing the whole archive in memory
+                while not exhausted and len(in_flight) < self.workers * 4:
+                    candidate = next(pending, None)
+                    if candidate is None:
+                        exhausted = True
+                        break
+                    in_flight.add(pool.submit(self.inspect, candidate))
+
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when = FIRST_COMPLETED)
+                for future in done:
+                    candidate = future.result()
+                    if candidate.error:
+                        report.skipped.append((candidate.path, candidate.error))
+                        continue
+
+                    try:
+                        batch.append(self.build(candidate))
+                    except OSError as e:
+                        report.skipped.append((candidate.path, str(e)))
+
+                    if len(batch) >= self.batch_size:
+                        self.flush(batch, report)
+
+        self.flush(batch, report)
+        return report
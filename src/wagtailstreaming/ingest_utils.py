@@ -0,0 +1,262 @@
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+import subprocess
+import threading
+import logging
+import typing
+import time
+import os
+
+from .conversion_utils import (
+    _bulk_dash_command,
+    _bulk_hls_command,
+    check_header_attributes,
+    write_master_playlist,
+    ffmpeg_installed,
+    can_run_bulk,
+)
+from .container_utils import sniff
+from .dataclasses import VideoAttribute
+from .http_utils import HTTPDownloader
+from .rendition_utils import RenditionPublisher
+from .settings import stream_settings
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+SNIFF_BYTES = 64 * 1024
+MAX_HEADER_BYTES = 64 * 1024 * 1024
+PROBE_BYTES = 4 * 1024 * 1024
+FEED_CHUNK_SIZE = 1024 * 1024
+POLL_SECONDS = 0.2
+
+# fields the encoding thread writes through its own copy of the instance
+WRITTEN_FIELDS = (
+    'date_processed', 
+    'source_duration', 
+    'source_width', 
+    'source_height', 
+    'source_codec', 
+    'encode_cost', 
+    'pending_version', 
+    'rendition_version', 
+    'rendition_layout', 
+    'rendition_health', 
+    'health_report', 
+    'health_checked_at', 
+    'rendition_sizes', 
+    'rendition_bytes', 
+    'remarks', 
+)
+
+
+class IngestPipeline:
+    """
+    Encodes a remote video while it is being downloaded.
+    When the header shows a container that can be decoded progressively (faststart MP4, Matroska, MPEG-TS),
+    the bulk segmenters are started on a pipe that is fed from the contiguous prefix of the download,
+    so the encoders never read a byte that has not been written yet.
+    The encoding thread loads its own copy of the instance and has its own database connection
+    """
+
+    def __init__(self, stream_instance, downloader: HTTPDownloader):
+        self.stream_instance = stream_instance
+        self.stream_class = type(stream_instance)
+        self.stream_id = stream_instance.pk
+        self.downloader = downloader
+        self.started = False
+        self.results: typing.Dict[str, bool] = {}
+
+        self._fd: typing.Optional[int] = None
+        self._thread: typing.Optional[threading.Thread] = None
+        self._processes: typing.Dict[str, subprocess.Popen] = {}
+        self._hls_variants: typing.List[typing.Tuple[str, str, str]] = []
+        self._publisher: typing.Optional[RenditionPublisher] = None
+        self._instance = None
+
+    def start(self):
+        if not (stream_settings.PIPELINED_INGEST and ffmpeg_installed()):
+            return
+
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def finish(self) -> typing.Tuple[bool, bool]:
+        """
+        Waits for the encoders to drain the pipe, returns the HLS and MPEG-DASH results.
+        The instance of the caller is refreshed with what the encoding thread wrote, so saving it does not undo that
+        """
+        if self._thread:
+            self._thread.join()
+            try:
+                self.stream_instance.refresh_from_db(fields = WRITTEN_FIELDS)
+            except self.stream_class.DoesNotExist: # deleted while downloading
+                pass
+        return self.results.get('hls', False), self.results.get('dash', False)
+
+    # download tracking
+    def _wait_for(self, size: int) -> int:
+        """Waits until `size` contiguous bytes or the whole file are available, returns 0 if the download failed"""
+        while True:
+            available = self.downloader.contiguous_bytes
+            total = self.downloader.remote.size
+            if available >= size or (total is not None and available >= total):
+                return available
+
+            if self.downloader.finished.is_set():
+                return self.downloader.contiguous_bytes if self.downloader.succeeded else 0
+            time.sleep(POLL_SECONDS)
+
+    def _open(self) -> int:
+        # the partial file is renamed once complete, an open descriptor survives the rename
+        try:
+            return os.open(self.downloader.partial_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return os.open(self.downloader.target_path, os.O_RDONLY)
+
+    def _read_header(self) -> typing.Optional[bytes]:
+        wanted = SNIFF_BYTES
+        while True:
+            available = self._wait_for(wanted)
+            if not available:
+                return None
+
+            header = os.pread(self._fd, min(available, MAX_HEADER_BYTES), 0)
+            info = sniff(header)
+            at_end = self.downloader.finished.is_set() or available < wanted
+            if info.complete or at_end or wanted >= MAX_HEADER_BYTES:
+                break
+            wanted = min(wanted * 4, MAX_HEADER_BYTES)
+
+        if not (info.streamable and info.complete):
+            LOGGER.info(f'Source of {self._instance} can not be encoded while downloading (container: {info.kind or "unknown"})')
+            return None
+
+        available = self._wait_for(info.header_size + PROBE_BYTES)
+        if not available:
+            return None
+        return os.pread(self._fd, min(available, info.header_size + PROBE_BYTES), 0)
+
+    # encoding
+    def _start_encoders(self, resolutions: typing.List[typing.Tuple[str, str]]):
+        commands = {}
+        if stream_settings.ALLOW_HLS:
+            self._hls_variants, commands['hls'] = _bulk_hls_command(
+                'pipe:0', self._instance.scratch_root('hls'), resolutions
+            )
+
+        if stream_settings.ALLOW_DASH:
+            commands['dash'] = _bulk_dash_command(
+                'pipe:0', self._instance.scratch_root('dash'), resolutions
+            )
+
+        for fmt, command in commands.items():
+            try:
+                self._processes[fmt] = subprocess.Popen(command, stdin = subprocess.PIPE)
+            except Exception as e:
+                LOGGER.error(f'Could not start a pipelined segmentation process: {e}, command: {command}')
+
+    def _feed(self) -> bool:
+        """Pipes the download into every encoder, returns False if the download failed"""
+        offset = 0
+        live = dict(self._processes)
+        while live:
+            available = self.downloader.contiguous_bytes
+            if offset < available:
+                chunk = os.pread(self._fd, min(FEED_CHUNK_SIZE, available - offset), offset)
+                offset += len(chunk)
+                for fmt, process in list(live.items()):
+                    try:
+                        process.stdin.write(chunk)
+                    except (BrokenPipeError, OSError): # encoder exited, its return code tells why
+                        live.pop(fmt)
+                continue
+
+            if self.downloader.finished.is_set():
+                if self.downloader.succeeded and offset >= self.downloader.contiguous_bytes:
+                    break
+
+                if not self.downloader.succeeded:
+                    return False
+            time.sleep(POLL_SECONDS)
+        return True
+
+    def _close(self, download_ok: bool):
+        for fmt, process in self._processes.items():
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+            if not download_ok:
+                process.kill()
+            process.wait()
+            self.results[fmt] = download_ok and process.returncode == 0
+
+    def _publish(self):
+        if not self._publisher:
+            return
+
+        publisher, self._publisher = self._publisher, None
+        hls_okay, dash_okay = publisher.finish(self.results.get('hls', False), self.results.get('dash', False))
+        for fmt, okay in (('hls', hls_okay), ('dash', dash_okay)):
+            if fmt in self.results:
+                self.results[fmt] = okay
+
+    def _run(self):
+        close_old_connections()
+        try:
+            self._instance = self.stream_class.objects.filter(pk = self.stream_id).first()
+            if not self._instance or not self._wait_for(1):
+                return
+
+            self._fd = self._open()
+            header = self._read_header()
+            if not header:
+                return
+
+            attrs = VideoAttribute(raw = check_header_attributes(header) or {})
+            if not self._instance.probe(attrs = attrs):
+                return
+
+            resolutions = self._instance.supported_resolutions
+            processes = int(stream_settings.ALLOW_HLS) + int(stream_settings.ALLOW_DASH)
+            if not resolutions or not can_run_bulk(
+                    self._instance.source_width or 0,
+                    self._instance.source_height or 0,
+                    resolutions, processes
+                ):
+                return
+
+            self._instance.date_processed = timezone.now()
+            self._instance.save(update_fields = ['date_processed'])
+            start = time.monotonic()
+            self._publisher = RenditionPublisher(self._instance)
+            self._start_encoders(resolutions)
+            self.started = bool(self._processes)
+            if not self.started:
+                self._publish()
+                return
+
+            self._publisher.start()
+            download_ok = self._feed()
+            self._close(download_ok)
+            if self.results.get('hls'):
+                write_master_playlist(self._instance.scratch_root('hls'), self._hls_variants)
+            self._publish()
+
+            elapsed = time.monotonic() - start
+            for fmt, okay in self.results.items():
+                if okay:
+                    metrics.observe('encode_seconds', elapsed, format = fmt, rung = 'pipelined')
+
+        except Exception as e:
+            LOGGER.error(f'Pipelined ingest of stream instance {self.stream_id} failed: {e}')
+            self._close(False)
+            self._publish()
+
+        finally:
+            if self._fd is not None:
+                os.close(self._fd)
+            connection.close()
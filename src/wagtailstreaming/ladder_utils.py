@@ -0,0 +1,311 @@
+from xml.etree import ElementTree
+
+import logging
+import typing
+import shutil
+import copy
+import glob
+import os
+
+from .conversion_utils import (
+    _dash_rung_command,
+    _hls_rung_command,
+    _timed_process,
+    write_master_playlist,
+    ffmpeg_installed,
+)
+from .rendition_utils import get_rendition_storage
+
+LOGGER = logging.getLogger(__name__)
+
+MPD_NS = 'urn:mpeg:dash:schema:mpd:2011'
+NAMESPACES = {
+    '': MPD_NS,
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'cenc': 'urn:mpeg:cenc:2013',
+}
+
+Rung = typing.Dict[str, str]
+
+for prefix, uri in NAMESPACES.items():
+    ElementTree.register_namespace(prefix, uri)
+
+
+def _tag(name: str) -> str:
+    return f'{{{MPD_NS}}}{name}'
+
+
+def ladder_diff(
+        encoded: typing.List[Rung],
+        target: typing.List[Rung]
+    ) -> typing.Tuple[typing.List[Rung], typing.List[Rung], typing.List[Rung]]:
+    """
+    Compares the encoded rungs against the target ladder by resolution.
+    Returns the rungs to encode (missing or changed), the encoded rungs to remove and the ones to keep
+    """
+    encoded_by_res = {r['resolution']: r for r in encoded}
+    target_by_res = {r['resolution']: r for r in target}
+
+    to_encode = [
+        r for r in target
+        if encoded_by_res.get(r['resolution'], {}).get('signature') != r['signature']
+    ]
+    to_remove = [
+        r for r in encoded
+        if target_by_res.get(r['resolution'], {}).get('signature') != r['signature']
+    ]
+    to_keep = [
+        r for r in target
+        if encoded_by_res.get(r['resolution'], {}).get('signature') == r['signature']
+    ]
+    return to_encode, to_remove, to_keep
+
+
+def _remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _reconcile_hls(stream_instance, target: typing.List[Rung]) -> typing.Tuple[bool, typing.List[Rung]]:
+    hls_dir = stream_instance.scratch_root('hls')
+    encoded = (stream_instance.encoded_ladder or {}).get('hls', [])
+    if not hls_dir:
+        stream_instance.add_remark(f'HLS ladder reconciliation error: Could not resolve hls dir "{hls_dir}"')
+        return False, encoded
+
+    to_encode, to_remove, to_keep = ladder_diff(encoded, target)
+    present = {r['resolution']: r for r in to_keep}
+    for rung in to_encode:
+        # the seeded files are hardlinks of the published version, ffmpeg must not write through them
+        _remove_path(os.path.join(hls_dir, rung['resolution']))
+        _, command = _hls_rung_command(
+            stream_instance.raw.path, hls_dir,
+            rung['resolution'], rung['bitrate']
+        )
+        success = _timed_process(stream_instance, 'hls', rung['resolution'], command)
+        if success is None:
+            return False, encoded
+
+        if success:
+            present[rung['resolution']] = rung
+
+    # rungs that left the ladder are pruned once the new ones are encoded
+    for rung in to_remove:
+        if rung['resolution'] not in present:
+            _remove_path(os.path.join(hls_dir, rung['resolution']))
+        _remove_path(os.path.join(hls_dir, f"{rung['resolution']}.txt"))
+
+    ladder = [r for r in target if r['resolution'] in present]
+    write_master_playlist(hls_dir, [
+        (
+            os.path.join(hls_dir, r['resolution'], f"{r['resolution']}.m3u8"),
+            r['bitrate'],
+            r['resolution']
+        )
+        for r in ladder
+    ])
+    return len(ladder) == len(target), ladder
+
+
+def _video_adaptation_set(mpd: ElementTree.Element) -> typing.Optional[ElementTree.Element]:
+    for adaptation in mpd.iter(_tag('AdaptationSet')):
+        if adaptation.get('contentType') == 'video':
+            return adaptation
+
+        if (adaptation.get('mimeType') or '').startswith('video'):
+            return adaptation
+
+        for representation in adaptation.findall(_tag('Representation')):
+            if (representation.get('mimeType') or '').startswith('video'):
+                return adaptation
+    return None
+
+
+def _representation_resolution(representation: ElementTree.Element) -> str:
+    return f"{representation.get('width')}x{representation.get('height')}"
+
+
+def _remove_representation_files(
+        dash_dir: str,
+        representation: ElementTree.Element,
+        template: typing.Optional[ElementTree.Element],
+        keep: typing.Collection[str] = ()
+    ):
+    """
+    Deletes the segments of a representation, either its own sub-directory or its files in the bulk layout.
+    Sub-directories in `keep` were just encoded again and hold the new representation
+    """
+    media = template.get('media', '') if template is not None else ''
+    base_url = representation.find(_tag('BaseURL'))
+    if base_url is not None and base_url.text:
+        # single-file representations address byte ranges of one file
+        media = base_url.text.strip()
+
+    if '/' in media:
+        directory = media.split('/', 1)[0]
+        if directory not in keep:
+            _remove_path(os.path.join(dash_dir, directory))
+        return
+
+    rep_id = representation.get('id')
+    for pattern in (f'init_{rep_id}.m4s', f'chunk_{rep_id}_*.m4s', f'media_{rep_id}.mp4'):
+        for path in glob.glob(os.path.join(dash_dir, pattern)):
+            os.remove(path)
+
+
+def _rung_representation(
+        manifest_path: str,
+        res: str
+    ) -> typing.Optional[ElementTree.Element]:
+    """Lifts the video representation out of a rung manifest, with segment paths relative to the master manifest"""
+    mpd = ElementTree.parse(manifest_path).getroot()
+    adaptation = _video_adaptation_set(mpd)
+    if adaptation is None:
+        return None
+
+    representation = adaptation.find(_tag('Representation'))
+    if representation is None:
+        return None
+
+    representation = copy.deepcopy(representation)
+    rep_id = representation.get('id', '0')
+    representation.set('id', res)
+    base_url = representation.find(_tag('BaseURL'))
+    if base_url is not None and base_url.text:
+        # single-file rungs list byte ranges of one file, only its path changes
+        base_url.text = f"{res}/{base_url.text.strip().replace('$RepresentationID$', rep_id)}"
+        return representation
+
+    template = representation.find(_tag('SegmentTemplate'))
+    if template is None:
+        shared = adaptation.find(_tag('SegmentTemplate'))
+        if shared is None:
+            return None
+        template = copy.deepcopy(shared)
+        representation.append(template)
+
+    for attr in ('initialization', 'media'):
+        value = template.get(attr)
+        if value:
+            template.set(attr, f"{res}/{value.replace('$RepresentationID$', rep_id)}")
+    return representation
+
+
+def _reconcile_dash(stream_instance, target: typing.List[Rung]) -> typing.Tuple[bool, typing.List[Rung]]:
+    dash_dir = stream_instance.scratch_root('dash')
+    encoded = (stream_instance.encoded_ladder or {}).get('dash', [])
+    manifest_path = os.path.join(dash_dir, 'manifest.mpd') if dash_dir else ''
+    if not (manifest_path and os.path.isfile(manifest_path)):
+        stream_instance.add_remark(f'MPEG-DASH ladder reconciliation error: Could not find manifest "{manifest_path}"')
+        return False, encoded
+
+    try:
+        tree = ElementTree.parse(manifest_path)
+    except ElementTree.ParseError as e:
+        stream_instance.add_remark(f'MPEG-DASH ladder reconciliation error: Could not parse manifest: {e}')
+        return False, encoded
+
+    adaptation = _video_adaptation_set(tree.getroot())
+    if adaptation is None:
+        stream_instance.add_remark('MPEG-DASH ladder reconciliation error: Manifest has no video adaptation set')
+        return False, encoded
+
+    to_encode, to_remove, to_keep = ladder_diff(encoded, target)
+    present = {r['resolution']: r for r in to_keep}
+    added = []
+    for rung in to_encode:
+        res = rung['resolution']
+        _remove_path(os.path.join(dash_dir, res))
+        rung_manifest, command = _dash_rung_command(
+            stream_instance.raw.path, dash_dir,
+            res, rung['bitrate']
+        )
+        success = _timed_process(stream_instance, 'dash', res, command)
+        if success is None:
+            return False, encoded
+
+        representation = _rung_representation(rung_manifest, res) if success else None
+        if representation is not None:
+            added.append(representation)
+            present[res] = rung
+            os.remove(rung_manifest)
+
+    # rungs that left the ladder are pruned once the new ones are encoded
+    removed = {r['resolution'] for r in to_remove}
+    shared_template = adaptation.find(_tag('SegmentTemplate'))
+    for representation in adaptation.findall(_tag('Representation')):
+        if _representation_resolution(representation) in removed:
+            template = representation.find(_tag('SegmentTemplate'))
+            _remove_representation_files(
+                dash_dir, representation, template if template is not None else shared_template,
+                keep = [r.get('id') for r in added]
+            )
+            adaptation.remove(representation)
+
+    if added:
+        # separately encoded representations do not share one bitstream
+        adaptation.set('bitstreamSwitching', 'false')
+        adaptation.extend(added)
+
+    widths = [int(r.get('width') or 0) for r in adaptation.findall(_tag('Representation'))]
+    heights = [int(r.get('height') or 0) for r in adaptation.findall(_tag('Representation'))]
+    if widths and adaptation.get('maxWidth'):
+        adaptation.set('maxWidth', str(max(widths)))
+    if heights and adaptation.get('maxHeight'):
+        adaptation.set('maxHeight', str(max(heights)))
+
+    temp_path = f'{manifest_path}.tmp'
+    tree.write(temp_path, encoding = 'utf-8', xml_declaration = True)
+    os.replace(temp_path, manifest_path)
+
+    ladder = [r for r in target if r['resolution'] in present]
+    return len(ladder) == len(target), ladder
+
+
+def can_reconcile(stream_instance) -> bool:
+    """Checks if every enabled format already has an encoded ladder that a new version can be patched from"""
+    if get_rendition_storage():
+        # published streams do not stay on local scratch, a changed ladder is encoded again
+        return False
+
+    encoded = stream_instance.encoded_ladder or {}
+    formats = stream_instance.ladder_formats
+    checks = []
+    if 'hls' in formats:
+        checks.append(stream_instance.hls_ready and bool(encoded.get('hls')))
+
+    if 'dash' in formats:
+        checks.append(stream_instance.dash_ready and bool(encoded.get('dash')))
+    return bool(checks) and all(checks)
+
+
+def reconcile_ladder(stream_instance) -> typing.Tuple[bool, bool, typing.Dict[str, typing.List[Rung]]]:
+    """
+    Encodes only the rungs that are missing or were encoded with different parameters into the pending version,
+    which is seeded with the published one, deletes the rungs that left the ladder and rewrites master.m3u8 and manifest.mpd.
+    Returns the HLS and MPEG-DASH results and the rungs that are now present per format
+    """
+    # formats that were evicted are not seeded into the new version
+    formats = stream_instance.ladder_formats
+    encoded = {fmt: rungs for fmt, rungs in (stream_instance.encoded_ladder or {}).items() if fmt in formats}
+    hls_success = False
+    dash_success = False
+    if not ffmpeg_installed():
+        return hls_success, dash_success, encoded
+
+    if not stream_instance.pending_version:
+        # without a pending version the encoders would write into the published directories
+        stream_instance.add_remark('Ladder reconciliation error: There is no pending version to encode into')
+        return hls_success, dash_success, encoded
+
+    target = stream_instance.target_ladder
+    if 'hls' in formats:
+        hls_success, encoded['hls'] = _reconcile_hls(stream_instance, target)
+
+    if 'dash' in formats:
+        dash_success, encoded['dash'] = _reconcile_dash(stream_instance, target)
+    return hls_success, dash_success, encoded
@@ -0,0 +1,82 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import filesizeformat
+
+from ...gc_utils import Collector, LiveFiles, remove_orphan
+from ...http_utils import TokenBucket
+from ...settings import stream_settings
+
+TARGETS = ('hls', 'dash', 'scratch', 'downloads', 'thumbnails', 'sources', 'incoming', 'faststart')
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the renditions, downloads, temporary thumbnails and sources that no video stream references. "
+        "Files younger than --min-age are kept, they may belong to an encode or an upload in progress."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target",
+            action = "append",
+            choices = TARGETS,
+            default = None,
+            help = "Only collect below this root, can be repeated. Every root is scanned by default."
+        )
+        parser.add_argument(
+            "--min-age",
+            type = float,
+            default = 24.0,
+            help = "Only delete files that were not modified for this many hours."
+        )
+        parser.add_argument(
+            "--workers",
+            type = int,
+            default = None,
+            help = "Number of directories scanned in parallel."
+        )
+        parser.add_argument(
+            "--dry-run",
+            action = "store_true",
+            help = "Only report the orphans and the space they take."
+        )
+
+    def handle(self, *args, **options):
+        if options["min_age"] < 0:
+            raise CommandError("--min-age can not be negative")
+
+        live = LiveFiles.collect()
+        collector = Collector(live, int(options["min_age"] * 3600), options["workers"])
+        orphans = collector.scan(options["target"])
+
+        totals = defaultdict(lambda: [0, 0])
+        for orphan in orphans:
+            totals[orphan.target][0] += 1
+            totals[orphan.target][1] += orphan.size
+            if options["verbosity"] > 1:
+                self.stdout.write(f"{orphan.reason}: {orphan.path} ({filesizeformat(orphan.size)})")
+
+        for target, (count, size) in sorted(totals.items()):
+            self.stdout.write(f"{target}: {count} orphans, {filesizeformat(size)} reclaimable")
+
+        reclaimable = sum(orphan.size for orphan in orphans)
+        if options["dry_run"]:
+            self.stdout.write(f"{len(orphans)} orphans, {filesizeformat(reclaimable)} reclaimable.")
+            return
+
+        throttle = TokenBucket(stream_settings.CLEANUP_UNLINK_RATE)
+        removed = 0
+        freed = 0
+        for orphan in orphans:
+            try:
+                remove_orphan(orphan, throttle)
+            except OSError as e:
+                self.stdout.write(self.style.WARNING(f"Could not delete {orphan.path}: {e}"))
+                continue
+            removed += 1
+            freed += orphan.size
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {removed} orphans, freed {filesizeformat(freed)}."
+        ))
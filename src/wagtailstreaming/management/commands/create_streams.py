@@ -1,13 +1,11 @@
 import os
-import mimetypes
-
-from django.core.files import File
 
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth import get_user_model
 from wagtail.models import Collection
 
-from ...models import get_stream_model
+from ...import_utils import AUTO, PLACEMENT_MODES, Importer, scan
+from ... import metrics
 
 
 class Command(BaseCommand):
@@ -19,6 +17,9 @@ class Command(BaseCommand):
             type = str,
             help = "Absolute path to the directory containing video files."
         )
+        self.add_import_arguments(parser)
+
+    def add_import_arguments(self, parser):
         parser.add_argument(
             "--user",
             type = str,
@@ -31,63 +32,75 @@ class Command(BaseCommand):
             default = None,
             help = "Optional name of the collection to assign to these videos."
         )
+        parser.add_argument(
+            "--no-recursive",
+            action = "store_true",
+            help = "Only import the files directly inside the directory."
+        )
+        parser.add_argument(
+            "--workers",
+            type = int,
+            default = None,
+            help = "Number of files validated, hashed and probed at the same time."
+        )
+        parser.add_argument(
+            "--batch-size",
+            type = int,
+            default = 500,
+            help = "Number of streams inserted per query."
+        )
+        parser.add_argument(
+            "--mode",
+            choices = PLACEMENT_MODES,
+            default = AUTO,
+            help = (
+                "How files are placed into the storage. 'auto' hardlinks or reflinks when the directory "
+                "is on the same filesystem and copies otherwise, 'move' removes the imported files."
+            )
+        )
 
-    def handle(self, *args, **options):
-        directory = options["directory"]
-        user_identifier = options["user"]
-        collection_name = options["collection"]
-
-        if not os.path.isdir(directory):
-            raise CommandError(f"Directory does not exist: {directory}")
+    def get_user(self, user_identifier):
+        if not user_identifier:
+            return None
 
-        user = None
-        if user_identifier:
-            User = get_user_model()
-            try:
-                user = User.objects.filter(username = user_identifier).first() or User.objects.filter(email = user_identifier).first()
-                if not user:
-                    self.stdout.write(self.style.WARNING(f"User '{user_identifier}' not found. Skipping 'uploaded_by'."))
+        User = get_user_model()
+        try:
+            user = User.objects.filter(username = user_identifier).first() or User.objects.filter(email = user_identifier).first()
+            if not user:
+                self.stdout.write(self.style.WARNING(f"User '{user_identifier}' not found. Skipping 'uploaded_by'."))
+            return user
 
-            except Exception as e:
-                self.stdout.write(self.style.WARNING(f"Error finding user: {e}"))
+        except Exception as e:
+            self.stdout.write(self.style.WARNING(f"Error finding user: {e}"))
+        return None
 
+    def get_importer(self, options) -> Importer:
         collection = Collection.get_first_root_node()
-        if collection_name:
-            collection, _ = Collection.objects.get_or_create(name = collection_name)
-
-        stream_model = get_stream_model()
-
-        created_count = 0
-        skipped_count = 0
-
-        for filename in os.listdir(directory):
-            file_path = os.path.join(directory, filename)
-            if not os.path.isfile(file_path):
-                continue
-
-            mime_type, _ = mimetypes.guess_type(file_path)
-            if not mime_type or not mime_type.startswith("video/"):
-                skipped_count += 1
-                continue
+        if options["collection"]:
+            collection, _ = Collection.objects.get_or_create(name = options["collection"])
+
+        return Importer(
+            user = self.get_user(options["user"]),
+            collection = collection,
+            workers = options["workers"],
+            batch_size = options["batch_size"],
+            mode = options["mode"],
+            log = self.stdout.write,
+        )
 
-            title = os.path.splitext(filename)[0]
-            if stream_model.objects.filter(title = title).exists():
-                self.stdout.write(self.style.WARNING(f"Skipped duplicate: {title}"))
-                skipped_count += 1
-                continue
+    def handle(self, *args, **options):
+        directory = options["directory"]
+        if not os.path.isdir(directory):
+            raise CommandError(f"Directory does not exist: {directory}")
 
-            with open(file_path, "rb") as f:
-                django_file = File(f)
-                video = stream_model.objects.create(
-                    title = title,
-                    file = django_file,
-                    uploaded_by = user,
-                    collection = collection,
-                )
+        importer = self.get_importer(options)
+        paths = (entry.path for entry in scan(directory, not options["no_recursive"]))
+        report = importer.run(paths)
+        metrics.flush()
 
-            created_count += 1
-            self.stdout.write(self.style.SUCCESS(f"Created stream: {video.title}"))
+        for path, reason in report.skipped:
+            self.stdout.write(self.style.WARNING(f"Skipped {path}: {reason}"))
 
         self.stdout.write(self.style.SUCCESS(
-            f"Created {created_count} videos, skipped {skipped_count}."
+            f"Created {len(report.created)} videos, skipped {len(report.skipped)}."
         ))
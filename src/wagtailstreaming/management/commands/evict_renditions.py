@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import filesizeformat
+
+from ...settings import stream_settings
+from ...storage_utils import evict
+
+
+class Command(BaseCommand):
+    help = (
+        "Drop the MPEG-DASH streams and the tallest rungs of videos that were not played recently "
+        "until the published streams fit in the storage budget. A play queues the full streams again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--budget",
+            type = int,
+            default = None,
+            help = "Storage budget in bytes, STORAGE_BUDGET by default."
+        )
+        parser.add_argument(
+            "--idle-days",
+            type = int,
+            default = None,
+            help = "Only evict videos that were not played for this many days, EVICTION_IDLE_DAYS by default."
+        )
+        parser.add_argument(
+            "--dry-run",
+            action = "store_true",
+            help = "Only report what would be evicted."
+        )
+
+    def handle(self, *args, **options):
+        budget = stream_settings.STORAGE_BUDGET if options["budget"] is None else options["budget"]
+        if budget <= 0:
+            raise CommandError("No storage budget, set STORAGE_BUDGET or pass --budget")
+
+        evictions = evict(budget, options["idle_days"], options["dry_run"])
+        for eviction in evictions:
+            dropped = ["MPEG-DASH"] if eviction.drop_dash else []
+            if eviction.ladder_cap:
+                dropped.append(f"above {eviction.ladder_cap}p")
+            self.stdout.write(
+                f"{eviction.video.title} ({eviction.video.id}): {', '.join(dropped)}, "
+                f"about {filesizeformat(eviction.saving)}"
+            )
+
+        saving = sum(eviction.saving for eviction in evictions)
+        verb = "Would evict" if options["dry_run"] else "Evicting"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} the streams of {len(evictions)} videos, about {filesizeformat(saving)}."
+        ))
@@ -0,0 +1,181 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from wagtail.models import Collection
+
+from ...dataclasses import Duration
+from ...models import get_stream_model
+
+
+class Command(BaseCommand):
+    help = "Queue existing VideoStream instances for conversion with the current ladder and encoder settings."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--collection",
+            type = str,
+            default = None,
+            help = "Only re-encode videos of the collection with this name."
+        )
+        parser.add_argument(
+            "--tag",
+            type = str,
+            default = None,
+            help = "Only re-encode videos with this tag."
+        )
+        parser.add_argument(
+            "--since",
+            type = str,
+            default = None,
+            help = "Only re-encode videos uploaded on or after this date (YYYY-MM-DD)."
+        )
+        parser.add_argument(
+            "--until",
+            type = str,
+            default = None,
+            help = "Only re-encode videos uploaded before this date (YYYY-MM-DD)."
+        )
+        parser.add_argument(
+            "--resolution",
+            type = str,
+            default = None,
+            help = "Only re-encode videos whose source has this resolution, e.g. 1920x1080."
+        )
+        parser.add_argument(
+            "--codec",
+            type = str,
+            default = None,
+            help = "Only re-encode videos whose source has this video codec, e.g. h264."
+        )
+        parser.add_argument(
+            "--rate",
+            type = float,
+            default = 60.0,
+            help = "Maximum number of videos queued per minute."
+        )
+        parser.add_argument(
+            "--max-concurrent",
+            type = int,
+            default = 1,
+            help = "Maximum number of queued videos that have not finished converting yet."
+        )
+        parser.add_argument(
+            "--force",
+            action = "store_true",
+            help = "Also re-encode videos whose outputs already match the target ladder."
+        )
+        parser.add_argument(
+            "--dry-run",
+            action = "store_true",
+            help = "Only list the videos that would be re-encoded."
+        )
+
+    def _parse_date(self, value):
+        try:
+            return timezone.make_aware(datetime.strptime(value, "%Y-%m-%d"))
+        except ValueError:
+            raise CommandError(f"Invalid date: {value}, expected YYYY-MM-DD")
+
+    def get_queryset(self, options):
+        stream_model = get_stream_model()
+        queryset = stream_model.objects.exclude(file = "").filter(file__isnull = False)
+
+        if options["collection"]:
+            collection = Collection.objects.filter(name = options["collection"]).first()
+            if not collection:
+                raise CommandError(f"Collection does not exist: {options['collection']}")
+            queryset = queryset.filter(collection = collection)
+
+        if options["tag"]:
+            queryset = queryset.filter(tags__name = options["tag"])
+
+        if options["since"]:
+            queryset = queryset.filter(created_at__gte = self._parse_date(options["since"]))
+
+        if options["until"]:
+            queryset = queryset.filter(created_at__lt = self._parse_date(options["until"]))
+
+        if options["resolution"]:
+            try:
+                width, height = (int(v) for v in options["resolution"].lower().split("x"))
+            except ValueError:
+                raise CommandError(f"Invalid resolution: {options['resolution']}, expected WIDTHxHEIGHT")
+            queryset = queryset.filter(source_width = width, source_height = height)
+
+        if options["codec"]:
+            queryset = queryset.filter(source_codec__iexact = options["codec"])
+
+        return queryset.order_by("created_at", "id").distinct()
+
+    def handle(self, *args, **options):
+        from ...task_utils import sched_reencode
+        from ...scheduling import estimator
+
+        if options["max_concurrent"] < 1:
+            raise CommandError("--max-concurrent must be at least 1")
+
+        if options["rate"] <= 0:
+            raise CommandError("--rate must be greater than 0")
+
+        stream_model = get_stream_model()
+        candidates = []
+        skipped_count = 0
+        for video in self.get_queryset(options).iterator():
+            if video.source_height is None:
+                video.probe()
+
+            if not options["force"] and video.ladder_matches():
+                skipped_count += 1
+                continue
+            candidates.append(video)
+
+        total = len(candidates)
+        self.stdout.write(f"{total} videos to re-encode, {skipped_count} already match the target ladder.")
+        if options["dry_run"]:
+            for video in candidates:
+                self.stdout.write(f"  {video.title}")
+            return
+
+        interval = 60.0 / options["rate"]
+        queued = []
+        unscheduled = 0
+        for i, video in enumerate(candidates, start = 1):
+            while True:
+                in_flight = stream_model.objects.filter(
+                    id__in = queued,
+                    needs_reencode = True,
+                    dead_lettered = False
+                ).count()
+                if in_flight < options["max_concurrent"]:
+                    break
+                time.sleep(max(interval, 5.0))
+
+            if not sched_reencode(video):
+                # still marked for re-encoding, `check_queue` picks it up once the scheduler is back
+                self.stdout.write(self.style.WARNING(f"[{i}/{total}] Could not schedule {video.title}"))
+                unscheduled += 1
+            queued.append(video.id)
+
+            # conversions run one at a time, so everything not finished yet is still ahead
+            remaining = sum(
+                estimator.seconds(v.encode_cost, v.source_duration)
+                for v in candidates[max(i - 1 - in_flight, 0):]
+            )
+            eta = Duration(duration = remaining)
+            self.stdout.write(self.style.SUCCESS(
+                f"[{i}/{total}] Queued {video.title} (ETA {eta.humanized})"
+            ))
+
+            if i < total:
+                time.sleep(interval)
+
+        failed = stream_model.objects.filter(id__in = queued, dead_lettered = True).count()
+        self.stdout.write(self.style.SUCCESS(
+            f"Queued {len(queued)} videos, skipped {skipped_count}."
+        ))
+        if unscheduled:
+            self.stdout.write(self.style.WARNING(f"{unscheduled} videos could not be scheduled right away."))
+        if failed:
+            self.stdout.write(self.style.WARNING(f"{failed} queued videos have been dead lettered."))
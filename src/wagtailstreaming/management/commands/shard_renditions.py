@@ -0,0 +1,103 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from ...models import get_stream_model
+from ...rendition_utils import get_rendition_storage, seed_directory
+from ...settings import stream_settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Move published renditions into the sharded directory layout while they are being served. "
+        "Files are hardlinked into the new layout, the instances are switched to it and the old "
+        "directories are deleted after the rendition grace period."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--depth",
+            type = int,
+            default = None,
+            help = "Number of shard directories above each rendition key, defaults to RENDITION_SHARD_DEPTH."
+        )
+        parser.add_argument(
+            "--limit",
+            type = int,
+            default = 0,
+            help = "Stop after moving this many rendition directories."
+        )
+        parser.add_argument(
+            "--dry-run",
+            action = "store_true",
+            help = "Only count the rendition directories that would be moved."
+        )
+
+    def get_queryset(self, depth: int):
+        # instances that are being encoded publish into the configured layout on their own
+        return get_stream_model().objects.exclude(rendition_layout = depth).filter(
+            Q(hls_ready = True) | Q(dash_ready = True),
+            pending_version = '',
+        ).order_by("id")
+
+    def move(self, video, depth: int) -> int:
+        """Links the published version of `video` into the new layout and switches every instance that reads it"""
+        # the retirement removes every format of the old layout, so a format that is no longer allowed is linked too
+        for fmt in ('hls', 'dash'):
+            source = video.rendition_path(fmt)
+            if os.path.isdir(source):
+                seed_directory(source, video.rendition_path(fmt, layout = depth))
+
+        readers = type(video).objects.filter(pk = video.pk)
+        if video.rendition_key:
+            readers = type(video).objects.filter(rendition_key = video.rendition_key)
+
+        return readers.filter(
+            rendition_version = video.rendition_version,
+            rendition_layout = video.rendition_layout,
+            pending_version = '',
+        ).update(rendition_layout = depth)
+
+    def handle(self, *args, **options):
+        from ...task_utils import sched_retirement
+
+        if get_rendition_storage():
+            raise CommandError("Renditions are served from RENDITION_STORAGE, their local layout is not used.")
+
+        depth = stream_settings.RENDITION_SHARD_DEPTH if options["depth"] is None else options["depth"]
+        if depth < 0:
+            raise CommandError("--depth can not be negative")
+
+        queryset = self.get_queryset(depth)
+        if options["dry_run"]:
+            self.stdout.write(f"{queryset.count()} instances have renditions outside of a {depth} level layout.")
+            return
+
+        moved = 0
+        switched = 0
+        seen = set()
+        for video in queryset.iterator():
+            key = video.rendition_key or video.hashed_id
+            if (key, video.rendition_version, video.rendition_layout) in seen:
+                continue
+            seen.add((key, video.rendition_version, video.rendition_layout))
+
+            try:
+                count = self.move(video, depth)
+            except OSError as e:
+                self.stdout.write(self.style.WARNING(f"Could not move the renditions of {video.title}: {e}"))
+                continue
+
+            # players that loaded a playlist before the switch keep reading the old directory for a while
+            sched_retirement(key, video.rendition_version, video.rendition_layout)
+            moved += 1
+            switched += count
+            self.stdout.write(f"[{moved}] {key} -> {depth} levels ({count} instances)")
+
+            if options["limit"] and moved >= options["limit"]:
+                break
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {moved} rendition directories, switched {switched} instances."
+        ))
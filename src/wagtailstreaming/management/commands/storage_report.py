@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import filesizeformat
+from django.db.models import Q
+
+from wagtail.models import Collection
+
+from ...models import get_stream_model
+from ...settings import stream_settings
+from ...storage_utils import recount, storage_totals
+
+
+class Command(BaseCommand):
+    help = (
+        "Report the space taken by the published streams in total, per collection and for the largest videos, "
+        "from the sizes recorded when they were published."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--recount",
+            action = "store_true",
+            help = "Measure the published streams of every video first, for videos converted before sizes were recorded."
+        )
+        parser.add_argument(
+            "--top",
+            type = int,
+            default = 10,
+            help = "Number of the largest videos listed."
+        )
+
+    def handle(self, *args, **options):
+        if options["top"] < 0:
+            raise CommandError("--top can not be negative")
+
+        model = get_stream_model()
+        if options["recount"]:
+            counted = 0
+            for video in model.objects.filter(Q(hls_ready = True) | Q(dash_ready = True)).order_by("id").iterator():
+                try:
+                    recount(video)
+                except OSError as e:
+                    self.stdout.write(self.style.WARNING(f"Could not measure {video.title} ({video.id}): {e}"))
+                    continue
+                counted += 1
+            self.stdout.write(f"Measured the streams of {counted} videos.")
+
+        total, collections = storage_totals()
+        names = dict(Collection.objects.filter(id__in = collections.keys()).values_list("id", "name"))
+        for collection, size in collections.most_common():
+            self.stdout.write(f"{names.get(collection, collection)}: {filesizeformat(size)}")
+
+        for video in model.objects.filter(rendition_bytes__gt = 0).order_by("-rendition_bytes")[:options["top"]]:
+            formats = ", ".join(f"{fmt} {filesizeformat(size)}" for fmt, size in sorted(video.rendition_sizes.items()))
+            self.stdout.write(f"{video.title} ({video.id}): {filesizeformat(video.rendition_bytes)} ({formats})")
+
+        budget = stream_settings.STORAGE_BUDGET
+        summary = f"Published streams take {filesizeformat(total)}"
+        if budget:
+            summary += f" of a {filesizeformat(budget)} budget"
+        self.stdout.write(self.style.SUCCESS(f"{summary}."))
@@ -0,0 +1,83 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from ...models import RenditionHealth, get_stream_model
+from ...verify_utils import verify_all
+from ... import metrics
+
+
+class Command(BaseCommand):
+    help = (
+        "Check that every playlist, manifest and segment of the published streams exists and is plausible, "
+        "and record the health of each video. Broken videos can be queued for re-encoding."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type = int,
+            default = 4,
+            help = "Number of videos verified in parallel."
+        )
+        parser.add_argument(
+            "--sample",
+            type = int,
+            default = 0,
+            help = "Also run ffprobe on this many segment files of each healthy format."
+        )
+        parser.add_argument(
+            "--unchecked",
+            action = "store_true",
+            help = "Only verify videos whose published streams have not been checked yet."
+        )
+        parser.add_argument(
+            "--limit",
+            type = int,
+            default = 0,
+            help = "Stop after this many videos."
+        )
+        parser.add_argument(
+            "--reencode",
+            action = "store_true",
+            help = "Queue videos with broken streams for re-encoding."
+        )
+
+    def get_queryset(self, options):
+        queryset = get_stream_model().objects.filter(
+            Q(hls_ready = True) | Q(dash_ready = True)
+        ).order_by("id")
+
+        if options["unchecked"]:
+            queryset = queryset.filter(rendition_health = RenditionHealth.UNCHECKED)
+        if options["limit"]:
+            queryset = queryset[:options["limit"]]
+        return queryset
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+
+        totals = Counter()
+        results = verify_all(
+            self.get_queryset(options),
+            workers = options["workers"],
+            sample = options["sample"],
+            reencode = options["reencode"],
+        )
+        for video, health, reports in results:
+            totals[health] += 1
+            if health == RenditionHealth.HEALTHY:
+                if options["verbosity"] > 1:
+                    self.stdout.write(f"{video.title}: healthy")
+                continue
+
+            problems = [f"{fmt}: {problem}" for fmt, report in reports.items() for problem in report["problems"]]
+            self.stdout.write(self.style.WARNING(f"{video.title} ({video.id}): {'; '.join(problems)}"))
+        metrics.flush()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Verified {sum(totals.values())} rendition versions, "
+            f"{totals[RenditionHealth.HEALTHY]} healthy, {totals[RenditionHealth.BROKEN]} broken."
+        ))
@@ -0,0 +1,84 @@
+import signal
+import os
+
+from django.core.management.base import CommandError
+from django.db import close_old_connections
+
+from ...import_utils import MOVE
+from ...watch_utils import FolderWatcher
+from ... import task_utils, metrics
+from .create_streams import Command as CreateStreamsCommand
+
+
+class Command(CreateStreamsCommand):
+    help = "Watch drop directories and create VideoStream instances from the video files placed in them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "directories",
+            nargs = "+",
+            type = str,
+            help = "Absolute paths to the directories that are watched."
+        )
+        self.add_import_arguments(parser)
+        parser.add_argument(
+            "--settle",
+            type = float,
+            default = 10.0,
+            help = "Seconds a file that is still open must stay unchanged before it is imported."
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type = float,
+            default = 5.0,
+            help = "Seconds between scans when inotify is not available."
+        )
+        parser.add_argument(
+            "--poll",
+            action = "store_true",
+            help = "Scan the directories periodically instead of using inotify."
+        )
+        # imported files leave the drop directories, so a restart does not see them again
+        parser.set_defaults(mode = MOVE)
+
+    def import_paths(self, importer, paths):
+        close_old_connections()
+        report = importer.run(paths)
+        metrics.flush()
+        for path, reason in report.skipped:
+            self.stdout.write(self.style.WARNING(f"Skipped {path}: {reason}"))
+
+        for instance in report.created:
+            self.stdout.write(self.style.SUCCESS(f"Created stream: {instance.title}"))
+
+        if report.created and not task_utils.upload_queue.ongoing:
+            front = task_utils.upload_queue.front
+            if front:
+                task_utils.sched_conversion(front)
+
+    def handle(self, *args, **options):
+        directories = options["directories"]
+        for directory in directories:
+            if not os.path.isdir(directory):
+                raise CommandError(f"Directory does not exist: {directory}")
+
+        importer = self.get_importer(options)
+        watcher = FolderWatcher(
+            directories,
+            lambda paths: self.import_paths(importer, paths),
+            settle = options["settle"],
+            poll_interval = options["poll_interval"],
+            recursive = not options["no_recursive"],
+            use_inotify = False if options["poll"] else None,
+        )
+
+        def stop(signum, frame):
+            watcher.running = False
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        method = "inotify" if watcher.inotify else "polling"
+        self.stdout.write(f"Watching {', '.join(directories)} ({method})")
+        watcher.run()
+        self.stdout.write("Stopped watching")
@@ -0,0 +1,301 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import logging
+import atexit
+import typing
+import time
+import re
+
+from .settings import stream_settings
+
+LOGGER = logging.getLogger(__name__)
+
+PREFIX = 'wagtailstreaming'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+SECONDS_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 21600, 86400)
+RATIO_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(-2, 10)) # 256KB/s to 512MB/s
+
+METRICS = {
+    'queue_depth': (GAUGE, 'Videos waiting in a queue', ()),
+    'queue_wait_seconds': (HISTOGRAM, 'Time between entering the conversion queue and start of conversion', SECONDS_BUCKETS),
+    'encode_seconds': (HISTOGRAM, 'Wall clock time of one encode process', SECONDS_BUCKETS),
+    'encode_speed_ratio': (HISTOGRAM, 'Seconds of video encoded per wall clock second', RATIO_BUCKETS),
+    'probe_seconds': (HISTOGRAM, 'Latency of ffprobe', SECONDS_BUCKETS),
+    'remux_seconds': (HISTOGRAM, 'Wall clock time of one faststart remux', SECONDS_BUCKETS),
+    'publish_seconds': (HISTOGRAM, 'Time from the start of an encode until its renditions were uploaded', SECONDS_BUCKETS),
+    'publish_bytes_total': (COUNTER, 'Bytes uploaded to the rendition storage', ()),
+    'download_bytes_total': (COUNTER, 'Bytes fetched from remote sources', ()),
+    'download_throughput_bytes': (HISTOGRAM, 'Bytes per second of finished downloads', THROUGHPUT_BUCKETS),
+    'failures_total': (COUNTER, 'Failed jobs by kind', ()),
+    'verified_total': (COUNTER, 'Rendition integrity checks by health', ()),
+}
+
+Sample = typing.Tuple[str, str, float]
+
+
+def format_labels(labels: typing.Dict[str, typing.Any]) -> str:
+    """Renders labels the way the Prometheus text format expects them, sorted so they can be used as keys"""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items()))
+
+
+def format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class MetricsSink(ABC):
+    """Receives pipeline measurements, subclass and point `METRICS_SINK` to it to export them elsewhere"""
+
+    @abstractmethod
+    def inc(self, name: str, value: float = 1, **labels):
+        ...
+
+    @abstractmethod
+    def set(self, name: str, value: float, **labels):
+        ...
+
+    @abstractmethod
+    def observe(self, name: str, value: float, **labels):
+        ...
+
+    def collect(self) -> typing.List[Sample]:
+        """Provides the stored samples as (series name, rendered labels, value)"""
+        return []
+
+    def flush(self):
+        """Writes out buffered measurements, sinks that write right away have nothing to do"""
+
+
+class NullMetricsSink(MetricsSink):
+    def inc(self, name, value = 1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+class DatabaseMetricsSink(MetricsSink):
+    """
+    Keeps the samples in the database so that every worker and web node reports the same numbers.
+    Measurements are added up in memory and written at the end of every task and command, see `flush`.
+    In between, the main thread writes them every `METRICS_FLUSH_SECONDS`, pool threads never query the database for them
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._adds: typing.DefaultDict[typing.Tuple[str, str], float] = defaultdict(float)
+        self._gauges: typing.Dict[typing.Tuple[str, str], float] = {}
+        self._ensured: typing.Set[typing.Tuple[str, str]] = set()
+        self._flushed_at = time.monotonic()
+
+    @property
+    def model(self):
+        from .models import MetricSample
+        return MetricSample
+
+    def _ensure(self, series: typing.List[typing.Tuple[str, str]]):
+        self.model.objects.bulk_create(
+            [self.model(name = n, labels = l) for n, l in series],
+            ignore_conflicts = True
+        )
+
+    def _add(self, name: str, labels: str, value: float):
+        updated = self.model.objects.filter(name = name, labels = labels).update(value = F('value') + value)
+        if updated:
+            return
+
+        try:
+            with transaction.atomic():
+                self.model.objects.create(name = name, labels = labels, value = value)
+
+        except IntegrityError: # created by another worker in the meantime
+            self.model.objects.filter(name = name, labels = labels).update(value = F('value') + value)
+
+    def _buffer(self, adds: typing.Dict[typing.Tuple[str, str], float]):
+        with self._lock:
+            for series, value in adds.items():
+                self._adds[series] += value
+        self._flush_due()
+
+    def _flush_due(self):
+        # importer and verifier pool threads leave it to the main thread, they never close their connections
+        if threading.current_thread() is not threading.main_thread():
+            return
+        if time.monotonic() - self._flushed_at >= stream_settings.METRICS_FLUSH_SECONDS:
+            self.flush()
+
+    def inc(self, name, value = 1, **labels):
+        self._buffer({(f'{PREFIX}_{name}', format_labels(labels)): value})
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(f'{PREFIX}_{name}', format_labels(labels))] = value
+        self._flush_due()
+
+    def observe(self, name, value, **labels):
+        _, _, buckets = METRICS.get(name, (HISTOGRAM, '', SECONDS_BUCKETS))
+        bucket_name = f'{PREFIX}_{name}_bucket'
+        plain = format_labels(labels)
+        # every bucket is written, empty ones too, so the histogram is complete from the first observation
+        adds = {
+            (bucket_name, format_labels({**labels, 'le': format_bound(b)})): 1 if value <= b else 0
+            for b in (*buckets, float('inf'))
+        }
+        adds[(f'{PREFIX}_{name}_count', plain)] = 1
+        adds[(f'{PREFIX}_{name}_sum', plain)] = value
+        self._buffer(adds)
+
+    def flush(self):
+        with self._lock:
+            adds, self._adds = self._adds, defaultdict(float)
+            gauges, self._gauges = self._gauges, {}
+            self._flushed_at = time.monotonic()
+
+        try:
+            new = [series for series in adds if series not in self._ensured]
+            if new:
+                self._ensure(new)
+                self._ensured.update(new)
+            for (name, labels), value in adds.items():
+                if value:
+                    self._add(name, labels, value)
+            for (name, labels), value in gauges.items():
+                self.model.objects.update_or_create(name = name, labels = labels, defaults = {'value': value})
+
+        except Exception as e: # metrics must never break the pipeline, the measurements are dropped
+            LOGGER.error(f'Could not write {len(adds) + len(gauges)} metric series: {e}')
+
+    def collect(self):
+        self.flush()
+        return list(self.model.objects.order_by('name', 'labels').values_list('name', 'labels', 'value'))
+
+
+_sink: typing.Optional[MetricsSink] = None
+
+
+def get_sink() -> MetricsSink:
+    """The sink of this process, created once so that buffered measurements add up"""
+    global _sink
+    if _sink is not None:
+        return _sink
+
+    sink = DatabaseMetricsSink
+    path = stream_settings.METRICS_SINK
+    if isinstance(path, str) and path:
+        try:
+            sink = import_string(path)
+        except Exception as e:
+            LOGGER.error(f'Could not import METRICS_SINK class: {e}')
+
+    _sink = sink()
+    atexit.register(flush)
+    return _sink
+
+
+def flush(**kwargs):
+    """Writes out the measurements buffered by this process, at the end of every task and command"""
+    if _sink is None:
+        return
+
+    try:
+        _sink.flush()
+
+    except Exception as e:
+        LOGGER.error(f'Could not flush metrics: {e}')
+
+
+def _record(method: str, name: str, value: float, **labels):
+    if not stream_settings.ENABLE_METRICS:
+        return
+
+    try:
+        getattr(get_sink(), method)(name, value, **labels)
+
+    except Exception as e: # metrics must never break the pipeline
+        LOGGER.error(f'Could not record metric {name}: {e}')
+
+
+def inc(name: str, value: float = 1, **labels):
+    _record('inc', name, value, **labels)
+
+
+def set_gauge(name: str, value: float, **labels):
+    _record('set', name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    _record('observe', name, value, **labels)
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """Observes the wall clock seconds spent inside the block"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def live_samples() -> typing.List[Sample]:
+    """Gauges that are cheaper to compute on scrape than to keep up to date"""
+    from .task_utils import download_queue, upload_queue
+    from .models import get_stream_model
+
+    return [
+        (f'{PREFIX}_queue_depth', format_labels({'queue': 'upload'}), upload_queue.get_stream_instances().count()),
+        (f'{PREFIX}_queue_depth', format_labels({'queue': 'download'}), download_queue.get_stream_instances().count()),
+        (f'{PREFIX}_queue_depth', format_labels({'queue': 'dead_letter'}), get_stream_model().objects.filter(dead_lettered = True).count()),
+    ]
+
+
+def _family(series: str) -> str:
+    for suffix in ('_bucket', '_sum', '_count'):
+        base = series[len(PREFIX) + 1:-len(suffix)] if series.endswith(suffix) else None
+        if base in METRICS and METRICS[base][0] == HISTOGRAM:
+            return base
+    return series[len(PREFIX) + 1:]
+
+
+def _sort_key(sample: Sample):
+    series, labels, _ = sample
+    le = float('inf')
+    match = re.search(r'le="([^"]+)"', labels)
+    if match:
+        le = float(match.group(1))
+        labels = labels.replace(match.group(0), '')
+    return _family(series), labels, series, le
+
+
+def render_prometheus() -> str:
+    """Renders the collected samples in the Prometheus text exposition format"""
+    samples = sorted(live_samples() + get_sink().collect(), key = _sort_key)
+
+    lines = []
+    described = set()
+    for series, labels, value in samples:
+        family = _family(series)
+        if family not in described and family in METRICS:
+            kind, help_text, _ = METRICS[family]
+            lines.append(f'# HELP {PREFIX}_{family} {help_text}')
+            lines.append(f'# TYPE {PREFIX}_{family} {kind}')
+            described.add(family)
+
+        rendered = f'{series}{{{labels}}}' if labels else series
+        lines.append(f'{rendered} {float(value)!r}')
+    return '\n'.join(lines) + '\n'
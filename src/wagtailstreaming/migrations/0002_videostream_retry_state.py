@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='retry_count',
+            field=models.PositiveIntegerField(default=0, help_text='the number of consecutive failed conversions of the same failure kind', verbose_name='retry count'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='last_failure',
+            field=models.CharField(blank=True, choices=[('ffmpeg', 'ffmpeg error'), ('memory', 'out of memory'), ('missing_file', 'missing file')], default='', help_text='the kind of failure of the latest unsuccessful conversion', max_length=32, verbose_name='last failure'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, help_text='the video is kept out of the conversion queue until this date', null=True, verbose_name='next attempt at'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='dead_lettered',
+            field=models.BooleanField(default=False, help_text='marked if the video ran out of conversion retries and was dropped from the queue', verbose_name='dead lettered'),
+        ),
+    ]
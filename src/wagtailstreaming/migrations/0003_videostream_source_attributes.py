@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0002_videostream_retry_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='source_duration',
+            field=models.FloatField(blank=True, editable=False, help_text='the duration in seconds of the raw video, filled in when the video is probed', null=True, verbose_name='source duration'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='source_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, help_text='the width of the raw video, filled in when the video is probed', null=True, verbose_name='source width'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='source_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, help_text='the height of the raw video, filled in when the video is probed', null=True, verbose_name='source height'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='source_codec',
+            field=models.CharField(blank=True, default='', editable=False, help_text='the video codec of the raw video, filled in when the video is probed', max_length=32, verbose_name='source codec'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='encode_cost',
+            field=models.FloatField(blank=True, editable=False, help_text='the predicted encode cost of the ladder in 1080p-equivalent seconds', null=True, verbose_name='encode cost'),
+        ),
+    ]
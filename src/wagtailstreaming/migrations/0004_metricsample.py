@@ -0,0 +1,26 @@
+# Generated by Django 5.2.7 on 2026-10-19 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0003_videostream_source_attributes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricSample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='name')),
+                ('labels', models.CharField(blank=True, default='', max_length=255, verbose_name='labels')),
+                ('value', models.FloatField(default=0.0, verbose_name='value')),
+            ],
+            options={
+                'verbose_name': 'metric sample',
+                'constraints': [models.UniqueConstraint(fields=('name', 'labels'), name='unique_metric_series')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0004_metricsample'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='encoded_ladder',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text='the rungs of each stream format and the parameters they were encoded with', verbose_name='encoded ladder'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='needs_reencode',
+            field=models.BooleanField(default=False, help_text='marked if the video is queued for conversion even though its streams are ready', verbose_name='needs re-encode'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-19 13:10
+
+from django.db import migrations, models
+import wagtailstreaming.source_utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0005_videostream_encoded_ladder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='rendition_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='the directory key of the streams, shared by instances of the same source', max_length=64, verbose_name='rendition key'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='source_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='the SHA-256 of the raw video, identical uploads share their streams', max_length=64, verbose_name='source hash'),
+        ),
+        migrations.AlterField(
+            model_name='videostream',
+            name='file',
+            field=models.FileField(blank=True, help_text='the video that is going to be processed or that has been processed, video must be lower or equal to 100MB', null=True, storage=wagtailstreaming.source_utils.get_source_storage, upload_to='videos', verbose_name='file'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-19 13:40
+
+import django.db.models.deletion
+import uuid
+import wagtailstreaming.source_utils
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0006_videostream_content_addressed_sources'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(help_text='the name of the file on the machine of the user', max_length=255, verbose_name='filename')),
+                ('length', models.PositiveBigIntegerField(help_text='the size of the file in bytes', verbose_name='length')),
+                ('offset', models.PositiveBigIntegerField(default=0, help_text='the number of bytes received so far', verbose_name='offset')),
+                ('stored_name', models.CharField(blank=True, default='', help_text='the name of the file in the source storage once the upload is complete', max_length=255, verbose_name='stored name')),
+                ('attributes', models.JSONField(blank=True, default=dict, help_text='the ffprobe output of the header of the file', verbose_name='attributes')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+                ('user', models.ForeignKey(blank=True, help_text='the user that started the upload', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'upload session',
+            },
+        ),
+        migrations.AlterField(
+            model_name='videostream',
+            name='file',
+            field=models.FileField(blank=True, help_text='the video that is going to be processed or that has been processed, large videos are uploaded in resumable chunks', null=True, storage=wagtailstreaming.source_utils.get_source_storage, upload_to='videos', verbose_name='file'),
+        ),
+        migrations.AlterField(
+            model_name='videostream',
+            name='file_url',
+            field=models.URLField(blank=True, help_text='the link that contains the video when it is hosted elsewhere', max_length=255, null=True, verbose_name='file URL'),
+        ),
+    ]
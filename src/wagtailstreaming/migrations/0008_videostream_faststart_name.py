@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0007_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='faststart_name',
+            field=models.CharField(blank=True, default='', editable=False, help_text='a copy of the raw video with its index moved to the front, served in its place', max_length=255, verbose_name='faststart file'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0008_videostream_faststart_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='pending_version',
+            field=models.CharField(blank=True, default='', editable=False, help_text='the encode that is being written, published in place of the rendition version once finished', max_length=32, verbose_name='pending version'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='rendition_version',
+            field=models.CharField(blank=True, default='', editable=False, help_text='the published encode of the streams, a sub-directory of the rendition key', max_length=32, verbose_name='rendition version'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0009_videostream_rendition_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='rendition_layout',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='the number of shard directories above the rendition key on disk', verbose_name='rendition layout'),
+        ),
+    ]
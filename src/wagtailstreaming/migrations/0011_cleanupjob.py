@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:55
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0010_videostream_rendition_layout'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CleanupJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('renditions', 'renditions'), ('source', 'source'), ('thumbnail', 'thumbnail')], max_length=32, verbose_name='kind')),
+                ('name', models.CharField(help_text='the rendition key or the name of the file in its storage', max_length=255, verbose_name='name')),
+                ('version', models.CharField(blank=True, default='', help_text='the rendition version to delete, empty for the files of an unversioned encode', max_length=32, verbose_name='version')),
+                ('layout', models.PositiveSmallIntegerField(default=0, help_text='the number of shard levels the rendition version was published with', verbose_name='layout')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='attempts')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='last error')),
+                ('run_after', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='the job is not picked up before this time', verbose_name='run after')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+            ],
+            options={
+                'verbose_name': 'cleanup job',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0011_cleanupjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='rendition_health',
+            field=models.CharField(blank=True, choices=[('', 'unchecked'), ('healthy', 'healthy'), ('broken', 'broken')], default='', editable=False, help_text='the result of the latest integrity check of the published streams', max_length=16, verbose_name='rendition health'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='health_report',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text='the problems the latest integrity check found, per format', verbose_name='health report'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='health_checked_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='health checked at'),
+        ),
+    ]
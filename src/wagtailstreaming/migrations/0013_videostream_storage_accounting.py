@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0012_videostream_rendition_health'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='rendition_bytes',
+            field=models.PositiveBigIntegerField(default=0, editable=False, help_text='the size of the published streams of every format', verbose_name='rendition bytes'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='rendition_sizes',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text='the size of the published streams per format', verbose_name='rendition sizes'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='last_played_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, help_text='the last time a player loaded the streams, recorded at most once per hour', null=True, verbose_name='last played at'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='ladder_cap',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='the height of the tallest rung kept while the video is cold, 0 for the full ladder', verbose_name='ladder cap'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='dash_evicted',
+            field=models.BooleanField(default=False, editable=False, help_text='marked if the MPEG-DASH streams were dropped because the video is cold', verbose_name='MPEG-DASH evicted'),
+        ),
+    ]
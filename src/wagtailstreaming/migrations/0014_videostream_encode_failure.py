@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0013_videostream_storage_accounting'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='encode_failure',
+            field=models.CharField(blank=True, choices=[('ffmpeg', 'ffmpeg error'), ('memory', 'out of memory'), ('missing_file', 'missing file')], default='', editable=False, help_text='the kind of failure an encoder reported during the running conversion', max_length=32, verbose_name='encode failure'),
+        ),
+    ]
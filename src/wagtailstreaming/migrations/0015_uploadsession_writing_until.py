@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0014_videostream_encode_failure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='writing_until',
+            field=models.DateTimeField(blank=True, editable=False, help_text='the end of the lease of the request that is writing a chunk, renewed while it writes', null=True, verbose_name='writing until'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-19 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0015_uploadsession_writing_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='download_heartbeat',
+            field=models.DateTimeField(blank=True, editable=False, help_text='the last time the worker downloading the video reported it was alive', null=True, verbose_name='download heartbeat'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='download_attempts',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='the number of consecutive failed downloads', verbose_name='download attempts'),
+        ),
+        migrations.AddField(
+            model_name='videostream',
+            name='download_retry_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='the video is kept out of the download queue until this date', null=True, verbose_name='download retry at'),
+        ),
+    ]
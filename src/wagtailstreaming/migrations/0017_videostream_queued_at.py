@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0016_videostream_download_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videostream',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='the date in which the video last entered the conversion queue, the upload date until then', null=True, verbose_name='queued at'),
+        ),
+    ]
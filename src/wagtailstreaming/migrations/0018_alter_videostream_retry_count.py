@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagtailstreaming', '0017_videostream_queued_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='videostream',
+            name='retry_count',
+            field=models.PositiveIntegerField(default=0, help_text='the number of consecutive failed conversions', verbose_name='retry count'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.utils.translation import gettext_lazy as _
+from django.utils import timezone
 from django.core.files import File
 from django.urls import reverse
 from django.db import models
@@ -20,21 +21,33 @@ from taggit.managers import TaggableManager
 
 import logging
 import typing
+import uuid
 import os
 
 from .conversion_utils import (
     _res_str_to_values, 
     check_attributes, 
     create_thumbnail, 
+    ladder_entries, 
+    predict_cost, 
 )
 from .dataclasses import (
+    DownloadProgress, 
     VideoAttribute, 
     Duration, 
     Progress, 
+    Stream, 
     DASH, 
     RAW, 
     HLS, 
 )
+from .rendition_utils import (
+    get_rendition_storage, 
+    local_rendition_dir, 
+    rendition_name, 
+    rendition_dir, 
+)
+from .source_utils import get_source_storage
 from .validators import (
     VideoFileValidator, 
     PhotoFileValidator
@@ -54,6 +67,24 @@ from .utils import (
 LOGGER = logging.getLogger(__name__)
 
 
+class FailureKind(models.TextChoices):
+    FFMPEG = 'ffmpeg', _('ffmpeg error')
+    MEMORY = 'memory', _('out of memory')
+    MISSING_FILE = 'missing_file', _('missing file')
+
+
+class RenditionHealth(models.TextChoices):
+    UNCHECKED = '', _('unchecked')
+    HEALTHY = 'healthy', _('healthy')
+    BROKEN = 'broken', _('broken')
+
+
+class CleanupKind(models.TextChoices):
+    RENDITIONS = 'renditions', _('renditions')
+    SOURCE = 'source', _('source')
+    THUMBNAIL = 'thumbnail', _('thumbnail')
+
+
 class VideoStreamQuerySet(
         models.QuerySet, 
         SearchableQuerySetMixin
@@ -77,16 +108,17 @@ class VideoStream(
 
     file = models.FileField(
         upload_to = 'videos', 
+        storage = get_source_storage, 
         null = True, blank = True, 
         verbose_name = _('file'), 
-        help_text = _('the video that is going to be processed or that has been processed, video must be lower or equal to 100MB')
+        help_text = _('the video that is going to be processed or that has been processed, large videos are uploaded in resumable chunks')
     )
 
     file_url = models.URLField(
         max_length = 255, 
         null = True, blank = True, 
         verbose_name = _('file URL'), 
-        help_text = _('the link that contains the video when video is greater than 100MB')
+        help_text = _('the link that contains the video when it is hosted elsewhere')
     )
 
     thumbnail = models.FileField(
@@ -134,6 +166,12 @@ class VideoStream(
         help_text = _('the date in which the video has been uploaded')
     )
 
+    queued_at = models.DateTimeField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('queued at'), 
+        help_text = _('the date in which the video last entered the conversion queue, the upload date until then')
+    )
+
     date_processed = models.DateTimeField(
         null = True, blank = True, 
         verbose_name = _('start of conversion'), 
@@ -146,6 +184,191 @@ class VideoStream(
         help_text = _('the date in which the video was done converting')
     )
 
+    source_duration = models.FloatField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('source duration'), 
+        help_text = _('the duration in seconds of the raw video, filled in when the video is probed')
+    )
+
+    source_width = models.PositiveIntegerField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('source width'), 
+        help_text = _('the width of the raw video, filled in when the video is probed')
+    )
+
+    source_height = models.PositiveIntegerField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('source height'), 
+        help_text = _('the height of the raw video, filled in when the video is probed')
+    )
+
+    source_codec = models.CharField(
+        max_length = 32, 
+        blank = True, default = '', editable = False, 
+        verbose_name = _('source codec'), 
+        help_text = _('the video codec of the raw video, filled in when the video is probed')
+    )
+
+    encode_cost = models.FloatField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('encode cost'), 
+        help_text = _('the predicted encode cost of the ladder in 1080p-equivalent seconds')
+    )
+
+    source_hash = models.CharField(
+        max_length = 64, 
+        blank = True, default = '', editable = False, db_index = True, 
+        verbose_name = _('source hash'), 
+        help_text = _('the SHA-256 of the raw video, identical uploads share their streams')
+    )
+
+    faststart_name = models.CharField(
+        max_length = 255, 
+        blank = True, default = '', editable = False, 
+        verbose_name = _('faststart file'), 
+        help_text = _('a copy of the raw video with its index moved to the front, served in its place')
+    )
+
+    rendition_key = models.CharField(
+        max_length = 64, 
+        blank = True, default = '', editable = False, db_index = True, 
+        verbose_name = _('rendition key'), 
+        help_text = _('the directory key of the streams, shared by instances of the same source')
+    )
+
+    rendition_version = models.CharField(
+        max_length = 32, 
+        blank = True, default = '', editable = False, 
+        verbose_name = _('rendition version'), 
+        help_text = _('the published encode of the streams, a sub-directory of the rendition key')
+    )
+
+    rendition_layout = models.PositiveSmallIntegerField(
+        default = 0, editable = False, 
+        verbose_name = _('rendition layout'), 
+        help_text = _('the number of shard directories above the rendition key on disk')
+    )
+
+    pending_version = models.CharField(
+        max_length = 32, 
+        blank = True, default = '', editable = False, 
+        verbose_name = _('pending version'), 
+        help_text = _('the encode that is being written, published in place of the rendition version once finished')
+    )
+
+    encoded_ladder = models.JSONField(
+        default = dict, blank = True, editable = False, 
+        verbose_name = _('encoded ladder'), 
+        help_text = _('the rungs of each stream format and the parameters they were encoded with')
+    )
+
+    needs_reencode = models.BooleanField(
+        default = False, 
+        verbose_name = _('needs re-encode'), 
+        help_text = _('marked if the video is queued for conversion even though its streams are ready')
+    )
+
+    rendition_health = models.CharField(
+        max_length = 16, 
+        blank = True, default = '', editable = False, 
+        choices = RenditionHealth.choices, 
+        verbose_name = _('rendition health'), 
+        help_text = _('the result of the latest integrity check of the published streams')
+    )
+
+    health_report = models.JSONField(
+        default = dict, blank = True, editable = False, 
+        verbose_name = _('health report'), 
+        help_text = _('the problems the latest integrity check found, per format')
+    )
+
+    health_checked_at = models.DateTimeField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('health checked at')
+    )
+
+    rendition_bytes = models.PositiveBigIntegerField(
+        default = 0, editable = False, 
+        verbose_name = _('rendition bytes'), 
+        help_text = _('the size of the published streams of every format')
+    )
+
+    rendition_sizes = models.JSONField(
+        default = dict, blank = True, editable = False, 
+        verbose_name = _('rendition sizes'), 
+        help_text = _('the size of the published streams per format')
+    )
+
+    last_played_at = models.DateTimeField(
+        null = True, blank = True, editable = False, db_index = True, 
+        verbose_name = _('last played at'), 
+        help_text = _('the last time a player loaded the streams, recorded at most once per hour')
+    )
+
+    ladder_cap = models.PositiveIntegerField(
+        default = 0, editable = False, 
+        verbose_name = _('ladder cap'), 
+        help_text = _('the height of the tallest rung kept while the video is cold, 0 for the full ladder')
+    )
+
+    dash_evicted = models.BooleanField(
+        default = False, editable = False, 
+        verbose_name = _('MPEG-DASH evicted'), 
+        help_text = _('marked if the MPEG-DASH streams were dropped because the video is cold')
+    )
+
+    retry_count = models.PositiveIntegerField(
+        default = 0, 
+        verbose_name = _('retry count'), 
+        help_text = _('the number of consecutive failed conversions')
+    )
+
+    last_failure = models.CharField(
+        max_length = 32, 
+        blank = True, default = '', 
+        choices = FailureKind.choices, 
+        verbose_name = _('last failure'), 
+        help_text = _('the kind of failure of the latest unsuccessful conversion')
+    )
+
+    encode_failure = models.CharField(
+        max_length = 32, 
+        blank = True, default = '', editable = False, 
+        choices = FailureKind.choices, 
+        verbose_name = _('encode failure'), 
+        help_text = _('the kind of failure an encoder reported during the running conversion')
+    )
+
+    next_attempt_at = models.DateTimeField(
+        null = True, blank = True, 
+        verbose_name = _('next attempt at'), 
+        help_text = _('the video is kept out of the conversion queue until this date')
+    )
+
+    dead_lettered = models.BooleanField(
+        default = False, 
+        verbose_name = _('dead lettered'), 
+        help_text = _('marked if the video ran out of conversion retries and was dropped from the queue')
+    )
+
+    download_heartbeat = models.DateTimeField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('download heartbeat'), 
+        help_text = _('the last time the worker downloading the video reported it was alive')
+    )
+
+    download_attempts = models.PositiveIntegerField(
+        default = 0, editable = False, 
+        verbose_name = _('download attempts'), 
+        help_text = _('the number of consecutive failed downloads')
+    )
+
+    download_retry_at = models.DateTimeField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('download retry at'), 
+        help_text = _('the video is kept out of the download queue until this date')
+    )
+
     remarks = models.TextField(
         null = True, blank = True,
         verbose_name = _('remarks'), 
@@ -194,6 +417,7 @@ class VideoStream(
         'stream_urls', 
         'thumbnail_url', 
         'embed_url', 
+        'eta', 
     ]
 
     listing_default_fields = [
@@ -223,7 +447,14 @@ class VideoStream(
 
     @property
     def hashed_id(self) -> str:
-        return hash_this(self.id) if self.id else ''
+        if not self.id:
+            return ''
+
+        # keyed by the id, an instance that is saved for the first time gets its hash then
+        cached = self.__dict__.get('_hashed_id')
+        if not cached or cached[0] != self.id:
+            cached = self.__dict__['_hashed_id'] = (self.id, hash_this(self.id))
+        return cached[1]
 
     @property
     def download_root(self) -> str:
@@ -237,6 +468,12 @@ class VideoStream(
         path = os.path.join(stream_settings.DOWNLOAD_ROOT, self.hashed_id)
         return create_dir(path)
 
+    @property
+    def download_progress(self) -> DownloadProgress:
+        if not (self.file_url or '').startswith('[DOWNLOADING]'):
+            return DownloadProgress()
+        return DownloadProgress(root = os.path.join(stream_settings.DOWNLOAD_ROOT, self.hashed_id))
+
     @property
     def attrs(self) -> VideoAttribute:
         if not self.file:
@@ -251,38 +488,80 @@ class VideoStream(
         ]):
             return RAW()
 
+        playback = None
+        if self.faststart_name:
+            playback = self.file.field.attr_class(self, self.file.field, self.faststart_name)
+
         return RAW(
             _file = self.file, 
-            path = self.file.path, 
-            url = self.file.url
+            _playback = playback
+        )
+
+    def rendition_path(
+            self, 
+            fmt: str, 
+            version: typing.Optional[str] = None, 
+            layout: typing.Optional[int] = None
+        ) -> str:
+        """Local directory of a version of the renditions of a format, the published one by default"""
+        return local_rendition_dir(
+            stream_settings.HLS_ROOT if fmt == 'hls' else stream_settings.DASH_ROOT, 
+            self.rendition_key or self.hashed_id, 
+            self.rendition_version if version is None else version, 
+            self.rendition_layout if layout is None else layout, 
         )
 
+    def encoding_path(self, fmt: str) -> str:
+        """Directory the encoders write the pending version of a format to, new versions use the configured layout"""
+        version = self.pending_version or self.rendition_version
+        if not stream_settings.ENCODE_SCRATCH_ROOT:
+            if self.pending_version:
+                return self.rendition_path(fmt, version, stream_settings.RENDITION_SHARD_DEPTH)
+            return self.rendition_path(fmt)
+
+        key = rendition_dir(self.rendition_key or self.hashed_id, version)
+        return os.path.join(stream_settings.ENCODE_SCRATCH_ROOT, fmt, key)
+
+    def scratch_root(self, fmt: str) -> str:
+        """Creates the directory of `encoding_path`, it is published to `rendition_path` or the rendition storage once finished"""
+        return create_dir(self.encoding_path(fmt))
+
+    def published_stream(self, stream_class: typing.Type[Stream], fmt: str, ready: bool) -> Stream:
+        """Stream of the published version of a format, resolved from the ready flag and the stored version without touching the files"""
+        if not ready:
+            return stream_class()
+
+        storage = get_rendition_storage()
+        if storage:
+            key = rendition_dir(self.rendition_key or self.hashed_id, self.rendition_version)
+            return stream_class(_storage = storage, _name = rendition_name(fmt, key))
+        return stream_class(root = self.rendition_path(fmt))
+
     @property
     def hls(self) -> HLS:
         if not all((
             stream_settings.ALLOW_HLS, 
-            self.raw.file_root, 
+            self.file, 
             self.id
         )):
             return HLS()
-        
-        path = os.path.join(stream_settings.HLS_ROOT, self.hashed_id)
-        return HLS(root = create_dir(path))
+        return self.published_stream(HLS, 'hls', self.hls_ready)
 
     @property
     def dash(self) -> DASH:
         if not all((
             stream_settings.ALLOW_DASH, 
-            self.raw.file_root, 
+            self.file, 
             self.id
         )):
             return DASH()
-
-        path = os.path.join(stream_settings.DASH_ROOT, self.hashed_id)
-        return DASH(root = create_dir(path))
+        return self.published_stream(DASH, 'dash', self.dash_ready)
 
     @property
     def duration(self) -> Duration:
+        if self.source_duration is not None:
+            return Duration(duration = self.source_duration)
+
         if not self.file:
             return Duration()
         return Duration(duration = self.attrs.format.duration or 0.0)
@@ -290,10 +569,12 @@ class VideoStream(
     @property
     def supported_resolutions(self) -> typing.List[typing.Tuple[str, str]]:
         resolutions = []
-        if len(self.attrs.streams) <= 0:
-            return resolutions
-        
-        height = self.attrs.streams[0].height
+        height = self.source_height
+        if height is None:
+            if len(self.attrs.streams) <= 0:
+                return resolutions
+            height = self.attrs.streams[0].height
+
         if not height:
             return resolutions
         
@@ -303,8 +584,37 @@ class VideoStream(
 
             if h <= height:
                 resolutions.append(r)
+
+        if self.ladder_cap:
+            # cold videos keep their lower rungs, at least the lowest one
+            capped = [r for r in resolutions if _res_str_to_values(r[0])[1] <= self.ladder_cap]
+            resolutions = capped or resolutions[-1:]
         return resolutions
     
+    @property
+    def target_ladder(self) -> typing.List[typing.Dict[str, str]]:
+        """The rungs the video would be encoded with under the current settings"""
+        return ladder_entries(self.supported_resolutions)
+
+    @property
+    def ladder_formats(self) -> typing.List[str]:
+        formats = []
+        if stream_settings.ALLOW_HLS:
+            formats.append('hls')
+
+        if stream_settings.ALLOW_DASH and not self.dash_evicted:
+            formats.append('dash')
+        return formats
+
+    def ladder_matches(self) -> bool:
+        """Checks if every enabled format has been encoded with the target ladder"""
+        target = self.target_ladder
+        if not target:
+            return False
+
+        encoded = self.encoded_ladder or {}
+        return all(encoded.get(fmt) == target for fmt in self.ladder_formats)
+
     @property
     def supported_streams(self) -> typing.List[str]:
         modes = []
@@ -315,7 +625,7 @@ class VideoStream(
             modes.append('hls')
 
         if self.dash_ready:
-            modes.appand('dash')
+            modes.append('dash')
         return modes
 
     @property
@@ -323,15 +633,26 @@ class VideoStream(
         if not self.date_processed:
             return Progress()
 
+        # ffmpeg reports its progress next to the segments it is writing
         return Progress(
             hls_ready = self.hls_ready, 
             dash_ready = self.dash_ready, 
-            hls_root = self.hls.root, 
-            dash_root = self.dash.root, 
+            hls_root = self.encoding_path('hls'), 
+            dash_root = self.encoding_path('dash'), 
             total_duration = self.duration.duration, 
             resolutions = self.supported_resolutions
         )
 
+    @property
+    def eta(self) -> typing.Optional[Duration]:
+        """Estimated time until the video is converted, None if it is not queued"""
+        from .task_utils import upload_queue
+
+        seconds = upload_queue.eta(self)
+        if seconds is None:
+            return None
+        return Duration(duration = seconds)
+
     @property
     def usage(self):
         return reverse('wagtailstreaming:stream_usage', args = (self.id,))
@@ -348,6 +669,37 @@ class VideoStream(
     def get_usage(self):
         return ReferenceIndex.get_references_to(self).group_by_source_object()
 
+    def probe(
+            self, 
+            save: bool = True, 
+            attrs: typing.Optional[VideoAttribute] = None
+        ) -> bool:
+        """
+        Stores the attributes of the raw video that the scheduler and the segmenters rely on. 
+        `attrs` can be given when the video was probed from elsewhere, e.g. the header of a download
+        """
+        attrs = attrs or self.attrs
+        video_streams = [s for s in attrs.streams if s.codec_type == 'video']
+        if not video_streams:
+            return False
+
+        stream = video_streams[0]
+        self.source_duration = attrs.format.duration or stream.duration
+        self.source_width = stream.width
+        self.source_height = stream.height
+        self.source_codec = stream.codec_name or ''
+        self.encode_cost = predict_cost(self.source_duration, self.supported_resolutions)
+
+        if save:
+            self.save(update_fields = [
+                'source_duration', 
+                'source_width', 
+                'source_height', 
+                'source_codec', 
+                'encode_cost', 
+            ])
+        return True
+
     def _populate_thumbnail(self) -> bool:
         if self.thumbnail:
             return True
@@ -392,6 +744,166 @@ class VideoStream(
         ordering = ['title']
 
 
+class MetricSample(models.Model):
+    """A series of the pipeline metrics kept by `metrics.DatabaseMetricsSink`"""
+
+    name = models.CharField(
+        max_length = 255, 
+        verbose_name = _('name')
+    )
+
+    labels = models.CharField(
+        max_length = 255, 
+        blank = True, default = '', 
+        verbose_name = _('labels')
+    )
+
+    value = models.FloatField(
+        default = 0.0, 
+        verbose_name = _('value')
+    )
+
+    def __str__(self) -> str:
+        return f'{self.name}{{{self.labels}}}'
+
+    class Meta:
+        verbose_name = _('metric sample')
+        constraints = [
+            models.UniqueConstraint(fields = ['name', 'labels'], name = 'unique_metric_series'), 
+        ]
+
+
+class UploadSession(models.Model):
+    """A resumable upload of a raw video, received chunk by chunk through `views.upload`"""
+
+    id = models.UUIDField(
+        primary_key = True, 
+        default = uuid.uuid4, 
+        editable = False
+    )
+
+    user = models.ForeignKey(
+        user_settings.AUTH_USER_MODEL, 
+        on_delete = models.CASCADE, 
+        null = True, blank = True, related_name = '+', 
+        verbose_name = _('user'), 
+        help_text = _('the user that started the upload')
+    )
+
+    filename = models.CharField(
+        max_length = 255, 
+        verbose_name = _('filename'), 
+        help_text = _('the name of the file on the machine of the user')
+    )
+
+    length = models.PositiveBigIntegerField(
+        verbose_name = _('length'), 
+        help_text = _('the size of the file in bytes')
+    )
+
+    offset = models.PositiveBigIntegerField(
+        default = 0, 
+        verbose_name = _('offset'), 
+        help_text = _('the number of bytes received so far')
+    )
+
+    stored_name = models.CharField(
+        max_length = 255, 
+        blank = True, default = '', 
+        verbose_name = _('stored name'), 
+        help_text = _('the name of the file in the source storage once the upload is complete')
+    )
+
+    attributes = models.JSONField(
+        default = dict, blank = True, 
+        verbose_name = _('attributes'), 
+        help_text = _('the ffprobe output of the header of the file')
+    )
+
+    writing_until = models.DateTimeField(
+        null = True, blank = True, editable = False, 
+        verbose_name = _('writing until'), 
+        help_text = _('the end of the lease of the request that is writing a chunk, renewed while it writes')
+    )
+
+    created_at = models.DateTimeField(
+        auto_now_add = True, 
+        verbose_name = _('created at')
+    )
+
+    updated_at = models.DateTimeField(
+        auto_now = True, 
+        verbose_name = _('updated at')
+    )
+
+    @property
+    def complete(self) -> bool:
+        return bool(self.stored_name)
+
+    def __str__(self) -> str:
+        return f'{self.filename} ({self.offset}/{self.length})'
+
+    class Meta:
+        verbose_name = _('upload session')
+
+
+class CleanupJob(models.Model):
+    """Files that are no longer needed, deleted in the background by `cleanup_utils.run_cleanup`"""
+
+    kind = models.CharField(
+        max_length = 32, 
+        choices = CleanupKind.choices, 
+        verbose_name = _('kind')
+    )
+
+    name = models.CharField(
+        max_length = 255, 
+        verbose_name = _('name'), 
+        help_text = _('the rendition key or the name of the file in its storage')
+    )
+
+    version = models.CharField(
+        max_length = 32, 
+        blank = True, default = '', 
+        verbose_name = _('version'), 
+        help_text = _('the rendition version to delete, empty for the files of an unversioned encode')
+    )
+
+    layout = models.PositiveSmallIntegerField(
+        default = 0, 
+        verbose_name = _('layout'), 
+        help_text = _('the number of shard levels the rendition version was published with')
+    )
+
+    attempts = models.PositiveSmallIntegerField(
+        default = 0, 
+        verbose_name = _('attempts')
+    )
+
+    last_error = models.TextField(
+        blank = True, default = '', 
+        verbose_name = _('last error')
+    )
+
+    run_after = models.DateTimeField(
+        default = timezone.now, 
+        db_index = True, 
+        verbose_name = _('run after'), 
+        help_text = _('the job is not picked up before this time')
+    )
+
+    created_at = models.DateTimeField(
+        auto_now_add = True, 
+        verbose_name = _('created at')
+    )
+
+    def __str__(self) -> str:
+        return f'{self.kind} {self.name} {self.version}'.strip()
+
+    class Meta:
+        verbose_name = _('cleanup job')
+
+
 def get_stream_model() -> typing.Type[VideoStream]:
     cust_model = stream_settings.VIDEO_STREAM_MODEL
     if isinstance(cust_model, str) and cust_model:
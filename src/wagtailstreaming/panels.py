@@ -27,8 +27,8 @@ class VideoStreamFieldComparison(ForeignObjectComparison):
             return ''
 
         context = {
-            'obj_a': render_player(None, obj_a),
-            'obj_b': render_player(None, obj_b),
+            'obj_a': render_player(None, obj_a, count_play = False),
+            'obj_b': render_player(None, obj_b, count_play = False),
         }
 
         return render_to_string('wagtailstreaming_templates/widgets/compare.html', context)
\ No newline at end of file
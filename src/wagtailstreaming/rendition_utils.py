@@ -0,0 +1,567 @@
+from django.core.files.storage import InvalidStorageError, storages
+from django.utils.module_loading import import_string
+from django.core.files import File
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import ctypes.util
+import threading
+import posixpath
+import secrets
+import logging
+import typing
+import shutil
+import ctypes
+import errno
+import time
+import os
+import re
+
+from .settings import stream_settings
+from .http_utils import TokenBucket
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+POLL_SECONDS = 2.0
+TEMP_SUFFIX = '.tmp'
+PROGRESS_SUFFIX = '.txt' # ffmpeg -progress reports, only read while encoding
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+MANIFEST_EXTENSIONS = ('.m3u8', '.mpd')
+VERSION_PATTERN = re.compile(r'^v\d{14}[0-9a-f]{4}$')
+SHARD_WIDTH = 2
+UNLINK_BATCH = 100
+ENTRY_MANIFESTS = {
+    'hls': 'master.m3u8',
+    'dash': 'manifest.mpd',
+}
+
+
+@lru_cache(maxsize = None)
+def _storage_from_path(path: str):
+    return import_string(path)()
+
+
+def get_rendition_storage():
+    """Storage the streams are published to, None when they are served from `HLS_ROOT` and `DASH_ROOT`"""
+    path = stream_settings.RENDITION_STORAGE
+    if not path:
+        return None
+
+    try:
+        return storages[path]
+    except InvalidStorageError:
+        return _storage_from_path(path)
+
+
+def new_version() -> str:
+    """Name of the directory of a new encode, sortable by the time it started"""
+    return f"v{time.strftime('%Y%m%d%H%M%S', time.gmtime())}{secrets.token_hex(2)}"
+
+
+def is_version(name: str) -> bool:
+    return bool(VERSION_PATTERN.match(name))
+
+
+def rendition_dir(key: str, version: str = '') -> str:
+    """`<key>/<version>`, renditions encoded before versioning sit in `<key>` itself"""
+    return f'{key}/{version}' if version else key
+
+
+def shard_path(key: str, depth: int) -> str:
+    """`ab/cd/<key>` for a depth of 2, keeps the directories small in very large libraries"""
+    shards = [key[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(depth)]
+    return os.path.join(*shards, key)
+
+
+def local_rendition_dir(base: str, key: str, version: str = '', layout: int = 0) -> str:
+    """Local directory of a version of the renditions below `base` in a layout of `layout` shard levels"""
+    path = os.path.join(base, shard_path(key, layout))
+    return os.path.join(path, version) if version else path
+
+
+def rendition_name(fmt: str, key: str, relative: str = '') -> str:
+    """Name of a rendition file in the rendition storage, `<format>/<key>/<relative path>`"""
+    name = f'{fmt}/{key}'
+    if relative:
+        name = posixpath.join(name, relative.replace(os.sep, '/'))
+    return name
+
+
+def _batches(items: typing.List[str]) -> typing.Iterator[typing.List[str]]:
+    for start in range(0, len(items), UNLINK_BATCH):
+        yield items[start:start + UNLINK_BATCH]
+
+
+def _delete_tree(
+        storage, 
+        name: str, 
+        pool: ThreadPoolExecutor, 
+        keep_versions: bool = False, 
+        throttle: typing.Optional[TokenBucket] = None
+    ):
+    try:
+        directories, files = storage.listdir(name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+
+    for batch in _batches([posixpath.join(name, f) for f in files]):
+        if throttle:
+            throttle.consume(len(batch))
+        list(pool.map(storage.delete, batch))
+
+    for directory in directories:
+        if keep_versions and is_version(directory):
+            continue
+        _delete_tree(storage, posixpath.join(name, directory), pool, throttle = throttle)
+
+
+def delete_renditions(
+        fmt: str, 
+        key: str, 
+        keep_versions: bool = False, 
+        throttle: typing.Optional[TokenBucket] = None
+    ):
+    """Deletes the published files of a format from the rendition storage"""
+    storage = get_rendition_storage()
+    if not (storage and key):
+        return
+
+    with ThreadPoolExecutor(max_workers = stream_settings.RENDITION_UPLOAD_WORKERS) as pool:
+        _delete_tree(storage, rendition_name(fmt, key), pool, keep_versions, throttle)
+
+
+def _unlink(files: typing.List[str], throttle: typing.Optional[TokenBucket] = None):
+    for batch in _batches(files):
+        if throttle:
+            throttle.consume(len(batch))
+        for file_path in batch:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+
+def remove_tree(path: str, throttle: typing.Optional[TokenBucket] = None):
+    """Unlinks a local directory tree bottom-up in batches, `throttle` limits the files removed per second"""
+    try:
+        with os.scandir(path) as entries:
+            entries = list(entries)
+    except FileNotFoundError:
+        return
+
+    files = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks = False):
+            remove_tree(entry.path, throttle)
+        else:
+            files.append(entry.path)
+
+    _unlink(files, throttle)
+
+    try:
+        os.rmdir(path)
+    except FileNotFoundError:
+        pass
+
+
+def directory_bytes(path: str) -> int:
+    """Total size of the files below a directory"""
+    size = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks = False):
+                        stack.append(entry.path)
+                    else:
+                        size += entry.stat(follow_symlinks = False).st_size
+        except FileNotFoundError:
+            continue
+    return size
+
+
+def _remove_empty(path: str, base: str):
+    """Removes `path` and the shard directories above it that became empty"""
+    while os.path.normpath(path) != os.path.normpath(base):
+        try:
+            os.rmdir(path)
+        except OSError:
+            return
+        path = os.path.dirname(path)
+
+
+def remove_version(
+        key: str, 
+        version: str, 
+        layout: int = 0, 
+        throttle: typing.Optional[TokenBucket] = None
+    ):
+    """
+    Deletes one version of the renditions of a source, locally and from the rendition storage.
+    The unversioned files of an older encode are removed without the versions next to them.
+    `layout` is the number of shard levels the version was published with locally
+    """
+    for fmt, base in (('hls', stream_settings.HLS_ROOT), ('dash', stream_settings.DASH_ROOT)):
+        delete_renditions(fmt, rendition_dir(key, version), keep_versions = not version, throttle = throttle)
+
+        local = local_rendition_dir(base, key, version, layout)
+        if version:
+            remove_tree(local, throttle)
+            _remove_empty(os.path.dirname(local), base)
+            continue
+
+        try:
+            with os.scandir(local) as entries:
+                entries = list(entries)
+        except FileNotFoundError:
+            continue
+
+        files = []
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks = False):
+                files.append(entry.path)
+            elif not is_version(entry.name):
+                remove_tree(entry.path, throttle)
+
+        _unlink(files, throttle)
+        _remove_empty(local, base)
+
+
+def seed_directory(source: str, target: str):
+    """
+    Fills a new version with the files of the published one, hardlinked where both share a filesystem.
+    Encoders must delete a seeded file before writing it, writing through a hardlink changes the published copy
+    """
+    for directory, directories, files in os.walk(source):
+        relative = os.path.relpath(directory, source)
+        if directory == source:
+            directories[:] = [d for d in directories if not is_version(d)]
+
+        destination = os.path.normpath(os.path.join(target, relative))
+        os.makedirs(destination, exist_ok = True)
+        for name in files:
+            if name.endswith((TEMP_SUFFIX, PROGRESS_SUFFIX)):
+                continue
+
+            path = os.path.join(directory, name)
+            try:
+                os.link(path, os.path.join(destination, name))
+            except FileExistsError: # linked by an earlier run that was interrupted
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(path, os.path.join(destination, name))
+
+
+def _exchange(source: str, target: str) -> bool:
+    """Swaps two paths in one step with renameat2(RENAME_EXCHANGE), False where the kernel or libc lacks it"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    if renameat2(AT_FDCWD, os.fsencode(source), AT_FDCWD, os.fsencode(target), RENAME_EXCHANGE) == 0:
+        return True
+
+    code = ctypes.get_errno()
+    if code in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(code, os.strerror(code), target)
+
+
+def publish_directory(source: str, target: str):
+    """
+    Puts a finished rendition directory at `target` with a rename, readers see either the previous renditions
+    or the complete new ones. A scratch directory on another filesystem is copied next to `target` first
+    """
+    os.makedirs(os.path.dirname(target), exist_ok = True)
+    staging = f'{target}.{os.getpid()}{TEMP_SUFFIX}'
+    shutil.rmtree(staging, ignore_errors = True)
+    try:
+        os.rename(source, staging)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # one bulk copy over the network instead of the many small writes of the encoder
+        shutil.copytree(source, staging, ignore = shutil.ignore_patterns(f'*{PROGRESS_SUFFIX}'))
+        shutil.rmtree(source, ignore_errors = True)
+
+    if not os.path.exists(target):
+        os.rename(staging, target)
+        return
+
+    if not _exchange(staging, target):
+        # a directory can not replace another one that is not empty, there is a short gap in between
+        previous = f'{target}.{os.getpid()}.old'
+        os.rename(target, previous)
+        os.rename(staging, target)
+        staging = previous
+    shutil.rmtree(staging, ignore_errors = True)
+
+
+class SegmentUploader:
+    """
+    Copies the output of an encoder from its local scratch directory to the rendition storage while it is written.
+    Segments are uploaded by a pool of threads once their size and modification time stopped changing,
+    playlists and manifests only after the encoder finished, the entry manifest last, so a player never
+    finds a reference to a file that is not uploaded yet. Large files are split into multipart uploads
+    by the storage itself (S3 storages do it above their multipart threshold)
+    """
+
+    def __init__(
+            self,
+            storage,
+            fmt: str,
+            key: str,
+            local_root: str,
+            workers: typing.Optional[int] = None
+        ):
+        self.storage = storage
+        self.fmt = fmt
+        self.key = key
+        self.local_root = local_root
+        self.entry = ENTRY_MANIFESTS.get(fmt, '')
+        self.single_file = stream_settings.SINGLE_FILE_SEGMENTS
+
+        self._pool = ThreadPoolExecutor(max_workers = workers or stream_settings.RENDITION_UPLOAD_WORKERS)
+        self._seen: typing.Dict[str, typing.Tuple[int, float]] = {}
+        self._uploaded: typing.Dict[str, typing.Tuple[int, float]] = {}
+        self._futures = []
+        self._stop = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def uploaded_bytes(self) -> int:
+        return sum(size for size, _ in self._uploaded.values())
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(POLL_SECONDS):
+            try:
+                self.sync()
+            except OSError as e:
+                LOGGER.warning(f'Could not scan {self.local_root} for finished segments: {e}')
+
+    def _files(self) -> typing.Iterator[typing.Tuple[str, int, float]]:
+        for directory, _, files in os.walk(self.local_root):
+            for name in files:
+                if name.endswith((TEMP_SUFFIX, PROGRESS_SUFFIX)):
+                    continue
+
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: # replaced by the encoder meanwhile
+                    continue
+                yield os.path.relpath(path, self.local_root), stat.st_size, stat.st_mtime
+
+    def sync(self, final: bool = False) -> typing.List[str]:
+        """Submits the segments that are complete, returns the manifests that are left for the end"""
+        manifests = []
+        for relative, size, mtime in self._files():
+            state = (size, mtime)
+            if self._uploaded.get(relative) == state:
+                continue
+
+            if relative.endswith(MANIFEST_EXTENSIONS):
+                manifests.append(relative)
+                continue
+
+            # a single-file rung grows until the encoder exits, it is uploaded once
+            if self.single_file and not final:
+                continue
+
+            if final or self._seen.get(relative) == state:
+                self._uploaded[relative] = state
+                self._futures.append(self._pool.submit(self.upload, relative))
+            self._seen[relative] = state
+        return manifests
+
+    def upload(self, relative: str):
+        # every encode gets a new version directory, nothing is overwritten
+        name = rendition_name(self.fmt, self.key, relative)
+        with open(os.path.join(self.local_root, relative), 'rb') as f:
+            self.storage.save(name, File(f, name = os.path.basename(relative)))
+
+    def _wait(self) -> bool:
+        okay = True
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                LOGGER.error(f'Could not upload a {self.fmt} rendition file of {self.key}: {e}')
+                okay = False
+        self._futures = []
+        return okay
+
+    def finish(self, success: bool = True) -> bool:
+        """Uploads what is left after the encoder exited, returns True if every file was published"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+        try:
+            if not success:
+                self._wait()
+                return False
+
+            manifests = self.sync(final = True)
+            variants = [m for m in manifests if m != self.entry]
+            self._futures.extend(self._pool.submit(self.upload, m) for m in variants)
+            if not self._wait():
+                return False
+
+            if self.entry in manifests:
+                self.upload(self.entry)
+            return True
+
+        except Exception as e:
+            LOGGER.error(f'Could not publish the {self.fmt} renditions of {self.key}: {e}')
+            return False
+
+        finally:
+            self._pool.shutdown(wait = True)
+
+
+class RenditionPublisher:
+    """
+    Publishes a new version of the renditions of an instance. Encoders write the pending version to `scratch_root`,
+    finished formats are uploaded to the rendition storage while they are written or, without one,
+    renamed into its `rendition_path` when the whole ladder is done. The instance then points at the new version
+    and the previous one is deleted after `RENDITION_GRACE_PERIOD`, so published files never change
+    """
+
+    def __init__(
+            self,
+            stream_instance,
+            formats: typing.Optional[typing.List[str]] = None,
+            seed: bool = False
+        ):
+        self.stream_instance = stream_instance
+        self.formats = formats if formats is not None else stream_instance.ladder_formats
+        self.uploaders: typing.Dict[str, SegmentUploader] = {}
+        self.sizes: typing.Dict[str, int] = {}
+        self._start = time.monotonic()
+
+        self.key = stream_instance.rendition_key or stream_instance.hashed_id
+        self.previous = stream_instance.rendition_version
+        self.previous_layout = stream_instance.rendition_layout
+        self.replaces = stream_instance.hls_ready or stream_instance.dash_ready
+        stream_instance.pending_version = new_version()
+        type(stream_instance).objects.filter(pk = stream_instance.pk).update(
+            pending_version = stream_instance.pending_version
+        )
+
+        if seed:
+            # a reconciled ladder keeps the rungs that did not change
+            for fmt in self.formats:
+                seed_directory(stream_instance.rendition_path(fmt), stream_instance.scratch_root(fmt))
+
+        storage = get_rendition_storage()
+        if not storage:
+            return
+
+        directory = rendition_dir(self.key, stream_instance.pending_version)
+        for fmt in self.formats:
+            self.uploaders[fmt] = SegmentUploader(storage, fmt, directory, stream_instance.scratch_root(fmt))
+
+    def start(self):
+        self._start = time.monotonic()
+        for uploader in self.uploaders.values():
+            uploader.start()
+
+    def _upload(self, fmt: str, encoded: bool) -> bool:
+        uploader = self.uploaders[fmt]
+        published = uploader.finish(encoded)
+        # web nodes read the storage, the scratch copy is not needed anymore
+        shutil.rmtree(uploader.local_root, ignore_errors = True)
+
+        if encoded and not published:
+            self.stream_instance.add_remark(f'Encoded {fmt} renditions could not be uploaded to the rendition storage')
+        elif published:
+            metrics.inc('publish_bytes_total', uploader.uploaded_bytes, format = fmt)
+            self.sizes[fmt] = uploader.uploaded_bytes
+        return published
+
+    def _move(self, fmt: str, encoded: bool) -> bool:
+        scratch = self.stream_instance.scratch_root(fmt)
+        target = self.stream_instance.rendition_path(
+            fmt, self.stream_instance.pending_version, stream_settings.RENDITION_SHARD_DEPTH
+        )
+        if not encoded:
+            # nobody reads a pending version yet
+            shutil.rmtree(scratch, ignore_errors = True)
+            return False
+
+        try:
+            if scratch != target:
+                publish_directory(scratch, target)
+            self.sizes[fmt] = directory_bytes(target)
+            return True
+        except OSError as e:
+            self.stream_instance.add_remark(f'Encoded {fmt} renditions could not be moved into {target}: {e}')
+            shutil.rmtree(scratch, ignore_errors = True)
+            return False
+
+    def _drop_pending(self):
+        # nobody reads a version that was never switched to
+        try:
+            remove_version(self.key, self.stream_instance.pending_version, stream_settings.RENDITION_SHARD_DEPTH)
+        except Exception as e:
+            LOGGER.error(f'Could not remove the unpublished version {self.stream_instance.pending_version} of {self.key}: {e}')
+
+    def finish(self, hls_okay: bool, dash_okay: bool) -> typing.Tuple[bool, bool]:
+        """
+        Publishes the encoded formats and switches the instance to them once every requested format is published.
+        Otherwise the partial version is dropped, the instance keeps serving the previous one and no format counts as converted
+        """
+        results = {'hls': hls_okay, 'dash': dash_okay}
+        for fmt in self.formats:
+            publish = self._upload if fmt in self.uploaders else self._move
+            published = publish(fmt, results[fmt])
+            if published:
+                metrics.observe('publish_seconds', time.monotonic() - self._start, format = fmt)
+            results[fmt] = published
+
+        instance = self.stream_instance
+        switched = bool(self.formats) and all(results[fmt] for fmt in self.formats)
+        if not switched:
+            if any(results.values()):
+                instance.add_remark(f'Only some formats of version {instance.pending_version} were published, it is dropped')
+            self._drop_pending()
+            results = {'hls': False, 'dash': False}
+        else:
+            # one update moves the pointer, readers get either version but never a mix of both
+            instance.rendition_version = instance.pending_version
+            instance.rendition_layout = stream_settings.RENDITION_SHARD_DEPTH
+            # the new version has not been verified yet
+            instance.rendition_health = ''
+            instance.health_report = {}
+            instance.health_checked_at = None
+            instance.rendition_sizes = {fmt: self.sizes.get(fmt, 0) for fmt in self.formats if results[fmt]}
+            instance.rendition_bytes = sum(instance.rendition_sizes.values())
+        instance.pending_version = ''
+        type(instance).objects.filter(pk = instance.pk).update(
+            rendition_version = instance.rendition_version,
+            rendition_layout = instance.rendition_layout,
+            rendition_health = instance.rendition_health,
+            health_report = instance.health_report,
+            health_checked_at = instance.health_checked_at,
+            rendition_sizes = instance.rendition_sizes,
+            rendition_bytes = instance.rendition_bytes,
+            pending_version = '',
+        )
+
+        if switched and self.replaces:
+            from .task_utils import sched_retirement
+            sched_retirement(self.key, self.previous, self.previous_layout)
+        return results['hls'], results['dash']
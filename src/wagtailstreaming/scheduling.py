@@ -0,0 +1,157 @@
+from django.db.models import QuerySet, Window, F, Q
+from django.db.models.functions import RowNumber
+from django.utils.module_loading import import_string
+from django.utils import timezone
+
+import logging
+import typing
+import time
+
+from .models import VideoStream, get_stream_model
+from .settings import stream_settings
+
+LOGGER = logging.getLogger(__name__)
+
+SPEED_SAMPLE_SIZE = 50
+CACHE_SECONDS = 30
+
+
+stream_class = get_stream_model()
+
+
+class SchedulingPolicy:
+    """Base policy, orders the conversion queue and picks the next instance"""
+    ordering: typing.Tuple[typing.Any, ...] = ('created_at', 'id')
+
+    def order(self, qset: QuerySet[VideoStream]) -> QuerySet[VideoStream]:
+        return qset.order_by(*self.ordering)
+
+    def next(
+            self,
+            qset: QuerySet[VideoStream],
+            instance: VideoStream
+        ) -> typing.Optional[VideoStream]:
+        """Provides the highest priority instance other than the given one"""
+        return self.order(qset).exclude(id = instance.id).first()
+
+
+class FIFOPolicy(SchedulingPolicy):
+    """Converts videos in the order they were uploaded"""
+
+    def next(self, qset, instance):
+        return self.order(qset).filter(
+            Q(created_at__gt = instance.created_at) |
+            Q(created_at = instance.created_at, id__gt = instance.id)
+        ).first()
+
+
+class ShortestJobFirstPolicy(SchedulingPolicy):
+    """Converts the videos with the lowest predicted encode cost first, unprobed videos go last"""
+    ordering = (
+        F('encode_cost').asc(nulls_last = True),
+        'created_at',
+        'id',
+    )
+
+
+class FairSharePolicy(SchedulingPolicy):
+    """
+    Round-robins between the owners of the queued videos,
+    so one large batch can not hold the encoder for everyone else
+    """
+    partition_by = 'collection'
+    within_partition: typing.Tuple[typing.Any, ...] = ('created_at', 'id')
+
+    def order(self, qset):
+        return qset.annotate(
+            share_rank = Window(
+                expression = RowNumber(),
+                partition_by = [F(self.partition_by)],
+                order_by = [
+                    F(o).asc() if isinstance(o, str) else o
+                    for o in self.within_partition
+                ],
+            )
+        ).order_by('share_rank', 'created_at', 'id')
+
+
+class UploaderFairSharePolicy(FairSharePolicy):
+    partition_by = 'uploaded_by'
+
+
+class ShortestJobFairSharePolicy(FairSharePolicy):
+    """Fair share between collections, shortest job first within each collection"""
+    within_partition = (
+        F('encode_cost').asc(nulls_last = True),
+        'created_at',
+        'id',
+    )
+
+
+def get_scheduling_policy() -> SchedulingPolicy:
+    policy = FIFOPolicy
+    path = stream_settings.SCHEDULING_POLICY
+    if isinstance(path, str) and path:
+        try:
+            policy = import_string(path)
+        except Exception as e:
+            LOGGER.error(f'Could not import SCHEDULING_POLICY class: {e}')
+    return policy()
+
+
+class EncodeEstimator:
+    """Estimates encode times from the speed of recently converted videos"""
+
+    def __init__(self):
+        self._speed = None
+        self._computed_at = 0.0
+
+    def speed(self) -> typing.Optional[float]:
+        """1080p-equivalent seconds encoded per wall clock second"""
+        if time.monotonic() - self._computed_at < CACHE_SECONDS:
+            return self._speed
+
+        samples = stream_class.objects.filter(
+            encode_cost__gt = 0,
+            date_processed__isnull = False,
+            date_finished__isnull = False,
+        ).order_by('-date_finished').values_list(
+            'encode_cost',
+            'date_processed',
+            'date_finished'
+        )[:SPEED_SAMPLE_SIZE]
+
+        total_cost = 0.0
+        total_seconds = 0.0
+        for cost, started, finished in samples:
+            seconds = (finished - started).total_seconds()
+            if seconds > 0:
+                total_cost += cost
+                total_seconds += seconds
+
+        self._speed = round(total_cost / total_seconds, 4) if total_seconds else None
+        self._computed_at = time.monotonic()
+        return self._speed
+
+    def seconds(
+            self,
+            encode_cost: typing.Optional[float],
+            source_duration: typing.Optional[float]
+        ) -> float:
+        """Predicted wall clock seconds of a conversion, assumes realtime speed without history"""
+        speed = self.speed()
+        if encode_cost and speed:
+            return encode_cost / speed
+        return source_duration or 0.0
+
+    def remaining(self, instance: VideoStream) -> float:
+        """Predicted wall clock seconds left of an ongoing conversion"""
+        total = self.seconds(instance.encode_cost, instance.source_duration)
+        if not instance.date_processed:
+            return total
+
+        elapsed = (timezone.now() - instance.date_processed).total_seconds()
+        return max(total - elapsed, 0.0)
+
+
+estimator = EncodeEstimator()
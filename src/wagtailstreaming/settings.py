@@ -9,11 +9,19 @@ DEFAULTS = {
     'ALLOW_DASH': True, 
     'ALLOW_HLS': True, 
     'DISABLE_AUTO_CONVERSION': False, 
+    'ENABLE_METRICS': True, 
+    'PIPELINED_INGEST': True, 
+    'CONTENT_ADDRESSED_SOURCES': True, 
+    'CHUNKED_UPLOADS': True, 
+    'FASTSTART_SOURCES': True, 
+    'SINGLE_FILE_SEGMENTS': False, 
+    'REENCODE_BROKEN': False, 
 
     # dirs and serving
     'DASH_ROOT': os.path.join(user_settings.BASE_DIR, 'dash'), 
     'HLS_ROOT': os.path.join(user_settings.BASE_DIR, 'hls'), 
     'DOWNLOAD_ROOT': os.path.join(user_settings.BASE_DIR, 'downloads'), 
+    'ENCODE_SCRATCH_ROOT': '', 
     'DASH_URL': '/dash/', 
     'HLS_URL': '/hls/', 
     'DEFAULT_STREAM': 'hls', 
@@ -33,11 +41,55 @@ DEFAULTS = {
         'gif', 'jpg', 'jpeg', 'png', 'webp', 
     ], 
 
+    # retries
+    'MAX_RETRIES': {
+        'ffmpeg': 3, 
+        'memory': 5, 
+        'missing_file': 1, 
+    }, 
+    'RETRY_BACKOFF': 60, 
+    'RETRY_BACKOFF_MAX': 6 * 60 * 60, 
+
+    # downloads
+    'DOWNLOAD_CONNECTIONS': 4, 
+    'DOWNLOAD_PART_SIZE': 8 * 1024 * 1024, 
+    'DOWNLOAD_TIMEOUT': 30, 
+    'MAX_CONCURRENT_DOWNLOADS': 3, 
+    'DOWNLOAD_HOST_CONNECTIONS': 8, 
+    'DOWNLOAD_BANDWIDTH_LIMIT': 0, 
+    'DOWNLOAD_STALE_SECONDS': 5 * 60, 
+
+    # uploads
+    'UPLOAD_CHUNK_SIZE': 8 * 1024 * 1024, 
+    'UPLOAD_SESSION_TTL': 24 * 60 * 60, 
+    'MAX_UPLOAD_SIZE': 0, 
+
+    # renditions
+    'RENDITION_UPLOAD_WORKERS': 8, 
+    'RENDITION_GRACE_PERIOD': 24 * 60 * 60, 
+    'RENDITION_SHARD_DEPTH': 2, 
+
+    # cleanup
+    'CLEANUP_BATCH_SIZE': 50, 
+    'CLEANUP_UNLINK_RATE': 1000, 
+
+    # storage
+    'STORAGE_BUDGET': 0, 
+    'EVICTION_IDLE_DAYS': 30, 
+    'EVICTION_LADDER_CAP': 480, 
+
+    # metrics
+    'METRICS_FLUSH_SECONDS': 30, 
+
     # objects and functions
     'COLLECTION_PERMISSION_POLICY': '', 
     'VIDEO_STREAM_MODEL': '', 
     'FILE_CLEANUP': '', 
+    'SCHEDULING_POLICY': '', 
+    'METRICS_SINK': '', 
+    'METRICS_TOKEN': '', 
     'BASE_FORM': '', 
+    'RENDITION_STORAGE': '', 
 }
 PREFIX = 'WAGTAILSTREAMING'
 
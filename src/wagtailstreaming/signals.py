@@ -1,29 +1,27 @@
-from django.db.models.signals import pre_delete, pre_save
+from django.db.models.signals import post_save, pre_delete, pre_save
 from django.utils.module_loading import import_string
+from django.utils import timezone
 from django.db import transaction
 
 import logging
 import typing
-import shutil
 
-from .models import VideoStream, get_stream_model
+from .models import VideoStream, CleanupKind, get_stream_model
+from .cleanup_utils import record_instance_cleanup, record_cleanup
 from .settings import stream_settings
+from .source_utils import source_referenced, link_source
 
 LOGGER = logging.getLogger(__name__)
 
 
 def clear_files(instance: VideoStream):
-    if instance.hls_ready and instance.hls.root:
-        shutil.rmtree(instance.hls.root)
-    
-    if instance.dash_ready and instance.dash.root:
-        shutil.rmtree(instance.dash.root)
-
-    if instance.file:
-        instance.file.delete(save = False)
-
-    if instance.thumbnail:
-        instance.thumbnail.delete(save = False)
+    """
+    Records the files of an instance as cleanup jobs, a background worker deletes them in rate-limited batches.
+    Files that other instances of the same source still reference are kept when the jobs run
+    """
+    if record_instance_cleanup(instance):
+        from .task_utils import sched_cleanup
+        sched_cleanup()
 
 
 def get_cleanup() -> typing.Callable[[VideoStream], None]:
@@ -62,12 +60,69 @@ def change_cleanup(
     old_name = old.raw.name or ''
     new_name = instance.raw.name or ''
 
+    if old_name != new_name:
+        instance.source_duration = None
+        instance.source_width = None
+        instance.source_height = None
+        instance.source_codec = ''
+        instance.encode_cost = None
+        instance.source_hash = ''
+        instance.faststart_name = ''
+        instance.queued_at = timezone.now()
+        instance._source_changed = True
+
     if old_name != new_name and old_name:
+        # streams of the previous source are removed with it, a first source keeps what was published while it downloaded
+        instance.rendition_key = ''
+        instance.rendition_version = ''
+        instance.rendition_health = ''
+        instance.health_report = {}
+        instance.health_checked_at = None
+        instance.rendition_sizes = {}
+        instance.rendition_bytes = 0
+        instance.ladder_cap = 0
+        instance.dash_evicted = False
+        instance.encoded_ladder = {}
+        instance.hls_ready = False
+        instance.dash_ready = False
+
+        instance._replaced_source = [old.file.name, old.faststart_name]
         action = get_cleanup()
         transaction.on_commit(lambda: action(old))
 
 
+def source_link(
+        sender: typing.Type[VideoStream], 
+        instance: VideoStream, 
+        **kwargs
+    ):
+    if kwargs.get('raw'):
+        return
+
+    try:
+        link_source(instance)
+    except Exception as e:
+        LOGGER.error(f'Could not link the source of {instance}: {e}')
+
+    # the cleanup of a replaced source may have run before the row pointed at the new file
+    replaced = [name for name in getattr(instance, '_replaced_source', []) if name and not source_referenced(sender, name)]
+    if hasattr(instance, '_replaced_source'):
+        del instance._replaced_source
+    if replaced:
+        from .task_utils import sched_cleanup
+        for name in replaced:
+            record_cleanup(CleanupKind.SOURCE, name)
+        sched_cleanup()
+
+    changed = kwargs.get('created') or getattr(instance, '_source_changed', False)
+    instance._source_changed = False
+    if changed and instance.file and not instance.faststart_name and stream_settings.FASTSTART_SOURCES:
+        from .task_utils import sched_faststart
+        sched_faststart(instance)
+
+
 def register_signals():
     model = get_stream_model()
     pre_delete.connect(deletion_cleanup, sender = model)
-    pre_save.connect(change_cleanup, sender = model)
\ No newline at end of file
+    pre_save.connect(change_cleanup, sender = model)
+    post_save.connect(source_link, sender = model)
\ No newline at end of file
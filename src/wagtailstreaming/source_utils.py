@@ -0,0 +1,325 @@
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files import File
+from django.db.models import Q
+
+import tempfile
+import shutil
+import errno
+import hashlib
+import logging
+import os
+import re
+
+from .settings import stream_settings
+
+LOGGER = logging.getLogger(__name__)
+
+HASH_DIR = 'by-hash'
+TEMP_DIR = 'incoming'
+FASTSTART_DIR = 'faststart'
+HASH_PATTERN = re.compile(rf'(?:^|/){HASH_DIR}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/([0-9a-f]{{64}})(?:\.[^/]*)?$')
+
+
+def source_name(directory: str, digest: str, extension: str) -> str:
+    return '/'.join(filter(None, (directory, HASH_DIR, digest[:2], digest[2:4], f'{digest}{extension}')))
+
+
+def source_hash_from_name(name: str) -> str:
+    """Reads the SHA-256 of a source from its content addressed file name, empty for other names"""
+    match = HASH_PATTERN.search(name or '')
+    return match.group(1) if match else ''
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every source under the SHA-256 of its contents, hashed in the same pass that writes it.
+    Uploading bytes that are already stored keeps the existing file and hands out its name
+    """
+
+    def get_available_name(self, name, max_length = None):
+        # the final name is only known once the contents have been hashed, identical names are identical files
+        return name
+
+    def adopt(self, path: str, name: str, digest: str) -> str:
+        """
+        Moves a file that has already been written and hashed on the same filesystem into the store.
+        `name` provides the directory and extension, returns the stored name
+        """
+        extension = os.path.splitext(name)[1].lower()
+        final_name = source_name(os.path.dirname(name), digest, extension)
+        final_path = self.path(final_name)
+        if os.path.exists(final_path):
+            os.remove(path)
+            return final_name
+
+        os.makedirs(os.path.dirname(final_path), exist_ok = True)
+        if self.file_permissions_mode is not None:
+            os.chmod(path, self.file_permissions_mode)
+
+        try:
+            os.replace(path, final_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self._copy_across(path, final_path)
+        return final_name
+
+    def _copy_across(self, path: str, final_path: str):
+        """Moves a file from another filesystem, the kernel copies the bytes and the rename keeps readers from seeing half a file"""
+        fd, temp_path = tempfile.mkstemp(dir = self._temp_dir(), suffix = os.path.splitext(final_path)[1])
+        os.close(fd)
+        try:
+            shutil.copyfile(path, temp_path)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            os.replace(temp_path, final_path)
+            os.remove(path)
+
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _temp_dir(self) -> str:
+        temp_dir = self.path(TEMP_DIR)
+        os.makedirs(temp_dir, exist_ok = True)
+        return temp_dir
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1].lower()
+        if hasattr(content, 'temporary_file_path'):
+            # large uploads are already on disk, hash them and move them instead of writing them again
+            hasher = hashlib.sha256()
+            for chunk in content.chunks():
+                hasher.update(chunk)
+            return self.adopt(content.temporary_file_path(), name, hasher.hexdigest())
+
+        temp_dir = self._temp_dir()
+
+        fd, temp_path = tempfile.mkstemp(dir = temp_dir, suffix = extension)
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    f.write(chunk)
+
+            return self.adopt(temp_path, name, hasher.hexdigest())
+
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def get_source_storage():
+    """Storage of the raw videos, content addressed unless `CONTENT_ADDRESSED_SOURCES` is disabled"""
+    if stream_settings.CONTENT_ADDRESSED_SOURCES:
+        return ContentAddressedStorage()
+    return default_storage
+
+
+def faststart_name(name: str) -> str:
+    """
+    Name of a new faststart copy of a source, under a directory uploads never land in.
+    The hash of the source name keeps it from meeting an uploaded file that happens to be called `*.faststart.mp4`
+    """
+    digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+    extension = os.path.splitext(name)[1].lower()
+    return '/'.join((FASTSTART_DIR, digest[:2], digest[2:4], f'{digest}{extension}'))
+
+
+def delete_source(storage, name: str):
+    """Deletes a raw video or a faststart copy, by the name stored on the instance"""
+    if not name:
+        return
+    storage.delete(name)
+
+
+def faststart_source(stream_instance) -> bool:
+    """
+    Remuxes an MP4 whose moov box comes after the media data into a faststart copy,
+    so raw playback can start without fetching the end of the file. The source itself is kept,
+    its name stays the hash of its contents. Returns True if the instance has a faststart copy
+    """
+    from .container_utils import needs_faststart
+    from .conversion_utils import remux_faststart
+
+    if not (stream_settings.FASTSTART_SOURCES and stream_instance.file):
+        return False
+
+    name = stream_instance.file.name
+    storage = stream_instance.file.storage
+    if stream_instance.faststart_name and storage.exists(stream_instance.faststart_name):
+        return True
+
+    try:
+        path = storage.path(name)
+        if not needs_faststart(path):
+            return False
+    except OSError as e:
+        LOGGER.warning(f'Could not read the layout of the source of {stream_instance}: {e}')
+        return False
+
+    target_name = faststart_name(name)
+    target = storage.path(target_name)
+    os.makedirs(os.path.dirname(target), exist_ok = True)
+    if not remux_faststart(path, target):
+        return False
+
+    # instances of the same source share the copy
+    type(stream_instance).objects.filter(file = name).update(faststart_name = target_name)
+    stream_instance.faststart_name = target_name
+    LOGGER.info(f'Created a faststart copy of the source of {stream_instance}')
+    return True
+
+
+def store_source(stream_instance, path: str, filename: str, digest: str = '') -> str:
+    """
+    Puts a finished file into the source storage and returns its name.
+    With the hash from the pass that wrote it the file is renamed into the content addressed store,
+    otherwise the storage reads it once
+    """
+    field = stream_instance.file.field
+    storage = field.storage
+    name = field.generate_filename(stream_instance, filename)
+    if digest and isinstance(storage, ContentAddressedStorage):
+        return storage.adopt(path, name, digest)
+
+    with open(path, 'rb') as f:
+        stored_name = storage.save(name, File(f, name = filename))
+    os.remove(path)
+    return stored_name
+
+
+def rendition_key(source_hash: str) -> str:
+    """Directory key of the renditions of a source, the source hash combined with the encoder parameters"""
+    from .conversion_utils import encoder_signature
+    return hashlib.sha256(f'{source_hash}:{encoder_signature()}'.encode('utf-8')).hexdigest()[:32]
+
+
+def effective_rendition_key(stream_instance) -> str:
+    return stream_instance.rendition_key or stream_instance.hashed_id
+
+
+def rendition_sharers(stream_instance):
+    """Other instances whose streams live in the same rendition directories"""
+    return type(stream_instance).objects.filter(
+        rendition_key = effective_rendition_key(stream_instance)
+    ).exclude(pk = stream_instance.pk)
+
+
+def source_referenced(model, name: str) -> bool:
+    """
+    Checks if any stored instance references the raw video file or serves it as its faststart copy.
+    Cleanups run after the row is deleted or pointed at its new file, so the instance itself is not counted then
+    """
+    return bool(name) and model.objects.filter(Q(file = name) | Q(faststart_name = name)).exists()
+
+
+ADOPTED_FIELDS = (
+    'rendition_version',
+    'rendition_layout',
+    'rendition_health',
+    'health_report',
+    'health_checked_at',
+    'rendition_sizes',
+    'rendition_bytes',
+    'ladder_cap',
+    'dash_evicted',
+    'hls_ready',
+    'dash_ready',
+    'encoded_ladder',
+    'source_duration',
+    'source_width',
+    'source_height',
+    'source_codec',
+    'encode_cost',
+    'date_processed',
+    'date_finished',
+)
+
+
+def find_donor(stream_instance):
+    """An instance of the same source whose streams already match the target ladder"""
+    if not stream_instance.source_hash:
+        return None
+
+    candidates = type(stream_instance).objects.filter(
+        source_hash = stream_instance.source_hash
+    ).filter(
+        Q(hls_ready = True) | Q(dash_ready = True)
+    ).exclude(pk = stream_instance.pk).order_by('created_at', 'id')
+
+    for candidate in candidates:
+        if candidate.ladder_matches():
+            return candidate
+    return None
+
+
+def adopt_renditions(stream_instance) -> bool:
+    """Points a duplicate upload at the streams of an identical source instead of encoding it again"""
+    donor = find_donor(stream_instance)
+    if not donor:
+        return False
+
+    key = effective_rendition_key(donor)
+    if not donor.rendition_key:
+        # make the shared directory explicit so reference counting sees both instances
+        type(donor).objects.filter(pk = donor.pk).update(rendition_key = key)
+
+    changes = {field: getattr(donor, field) for field in ADOPTED_FIELDS}
+    changes.update(rendition_key = key, needs_reencode = False)
+    type(stream_instance).objects.filter(pk = stream_instance.pk).update(**changes)
+    for field, value in changes.items():
+        setattr(stream_instance, field, value)
+
+    LOGGER.info(f'Stream instance {stream_instance} reuses the streams of {donor}')
+    return True
+
+
+def link_source(stream_instance) -> bool:
+    """Records the hash of a newly stored source, then reuses existing streams of the same source if there are any"""
+    digest = source_hash_from_name(stream_instance.file.name if stream_instance.file else '')
+    if not digest or digest == stream_instance.source_hash:
+        return False
+
+    stream_instance.source_hash = digest
+    type(stream_instance).objects.filter(pk = stream_instance.pk).update(source_hash = digest)
+    if stream_instance.hls_ready or stream_instance.dash_ready:
+        return False
+    return adopt_renditions(stream_instance)
+
+
+def share_renditions(stream_instance):
+    """Copies the result of a conversion to the instances that share its rendition directories"""
+    rendition_sharers(stream_instance).update(**{
+        'rendition_version': stream_instance.rendition_version,
+        'rendition_layout': stream_instance.rendition_layout,
+        'rendition_health': stream_instance.rendition_health,
+        'health_report': stream_instance.health_report,
+        'health_checked_at': stream_instance.health_checked_at,
+        'rendition_sizes': stream_instance.rendition_sizes,
+        'rendition_bytes': stream_instance.rendition_bytes,
+        'ladder_cap': stream_instance.ladder_cap,
+        'dash_evicted': stream_instance.dash_evicted,
+        'hls_ready': stream_instance.hls_ready,
+        'dash_ready': stream_instance.dash_ready,
+        'encoded_ladder': stream_instance.encoded_ladder,
+        'needs_reencode': False,
+    })
+
+
+def assign_rendition_key(stream_instance) -> bool:
+    """Gives a source that has no streams yet the content addressed key of its rendition directories"""
+    if any((
+        stream_instance.rendition_key,
+        stream_instance.hls_ready,
+        stream_instance.dash_ready,
+        not stream_instance.source_hash,
+    )):
+        return False
+
+    stream_instance.rendition_key = rendition_key(stream_instance.source_hash)
+    stream_instance.save(update_fields = ['rendition_key'])
+    return True
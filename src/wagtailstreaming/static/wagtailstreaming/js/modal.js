@@ -103,7 +103,6 @@ STREAM_CHOOSER_MODAL_ONLOAD_HANDLERS = {
       e.preventDefault();
 
       const form = this;
-      const formData = new formData(form);
       const titleInput = form.querySelector('#id_stream-chooser-upload-title');
 
       const title = titleInput?.value.trim() || '';
@@ -129,9 +128,14 @@ STREAM_CHOOSER_MODAL_ONLOAD_HANDLERS = {
       }
 
       try {
+        // the modal is loaded after the page, so the chunked upload runs here instead of on submit
+        if (window.StreamChunkedUpload) {
+          await window.StreamChunkedUpload.prepareForm(form);
+        }
+
         const response = await fetch(form.action, {
           method: 'POST', 
-          body: formData, 
+          body: new FormData(form), 
         });
 
         if (!response.ok) {
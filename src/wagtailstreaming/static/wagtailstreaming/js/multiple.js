@@ -0,0 +1,150 @@
+// Uploads every dropped or chosen video as its own stream, a few files at a time.
+// Validation, probing and encoding of each stream run as background jobs on the server.
+(function() {
+  const CONCURRENCY = 3;
+
+  function createMultipleUpload(form) {
+    const input = form.querySelector('[data-multiple-upload-input]');
+    const dropZone = form.querySelector('[data-drop-zone]');
+    const list = document.querySelector('[data-upload-list]');
+    const csrfToken = form.querySelector('[name="csrfmiddlewaretoken"]').value;
+    const collection = form.querySelector('[name="collection"]');
+
+    const chunkedUrl = form.dataset.chunkedUploadUrl;
+    const chunkSize = parseInt(form.dataset.chunkSize, 10);
+    const maxSize = parseInt(form.dataset.maxUploadSize, 10) || 0;
+    const extensions = (form.dataset.allowedExtensions || '').split(',').filter(Boolean);
+
+    const queue = [];
+    let running = 0;
+
+    function createItem(file) {
+      const item = document.createElement('li');
+      const name = document.createElement('span');
+      const status = document.createElement('span');
+      name.textContent = file.name;
+      status.className = 'upload-status';
+      item.append(name, status);
+      list.prepend(item);
+      return { item, name, status };
+    }
+
+    function rejection(file) {
+      const extension = file.name.split('.').pop().toLowerCase();
+      if (extensions.length && !extensions.includes(extension)) {
+        return `Unsupported file extension: ${extension}`;
+      }
+      if (maxSize && file.size > maxSize) {
+        return 'File is larger than the upload limit';
+      }
+      return '';
+    }
+
+    function formData() {
+      const data = new FormData();
+      data.append('csrfmiddlewaretoken', csrfToken);
+      if (collection) data.append('collection', collection.value);
+      return data;
+    }
+
+    function post(data, onProgress) {
+      // XMLHttpRequest reports the progress of direct uploads, fetch does not
+      return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.open('POST', form.action);
+        xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+        xhr.responseType = 'json';
+        if (onProgress) {
+          xhr.upload.addEventListener('progress', (e) => onProgress(e.loaded, e.total, 0));
+        }
+        xhr.addEventListener('load', () => {
+          if (xhr.status === 200 && xhr.response) resolve(xhr.response);
+          else reject(new Error(xhr.statusText || 'Upload failed'));
+        });
+        xhr.addEventListener('error', () => reject(new Error('Network error')));
+        xhr.send(data);
+      });
+    }
+
+    async function upload(file, view) {
+      const progress = (done, total, attempts) => {
+        view.status.textContent = window.StreamChunkedUpload.progressText(done, total, attempts);
+      };
+      const data = formData();
+
+      if (chunkedUrl) {
+        const session = await new window.StreamChunkedUpload(file, {
+          createUrl: chunkedUrl,
+          chunkSize: chunkSize,
+          csrfToken: csrfToken,
+          onProgress: progress,
+        }).start();
+        data.append('upload_session', session);
+        return post(data);
+      }
+
+      data.append('files[]', file);
+      return post(data, progress);
+    }
+
+    async function process(file) {
+      const view = createItem(file);
+      const rejected = rejection(file);
+      if (rejected) {
+        view.item.classList.add('upload-failure');
+        view.status.textContent = rejected;
+        return;
+      }
+
+      try {
+        const result = await upload(file, view);
+        if (!result.success) throw new Error(result.error_message);
+
+        const link = document.createElement('a');
+        link.href = result.stream.edit_url;
+        link.textContent = result.stream.title;
+        view.name.replaceChildren(link);
+        view.item.classList.add('upload-success');
+        view.status.textContent = 'Queued for processing';
+      } catch (error) {
+        view.item.classList.add('upload-failure');
+        view.status.textContent = `Upload failed: ${error.message}`;
+      }
+    }
+
+    async function next() {
+      if (running >= CONCURRENCY || !queue.length) return;
+      running += 1;
+      try {
+        await process(queue.shift());
+      } finally {
+        running -= 1;
+        next();
+      }
+    }
+
+    function add(files) {
+      Array.from(files).forEach((file) => queue.push(file));
+      for (let i = 0; i < CONCURRENCY; i += 1) next();
+    }
+
+    input.addEventListener('change', () => {
+      add(input.files);
+      input.value = '';
+    });
+
+    ['dragenter', 'dragover'].forEach((name) => dropZone.addEventListener(name, (e) => {
+      e.preventDefault();
+      dropZone.classList.add('hovered');
+    }));
+    ['dragleave', 'drop'].forEach((name) => dropZone.addEventListener(name, (e) => {
+      e.preventDefault();
+      dropZone.classList.remove('hovered');
+    }));
+    dropZone.addEventListener('drop', (e) => add(e.dataTransfer.files));
+  }
+
+  document.addEventListener('DOMContentLoaded', () => {
+    document.querySelectorAll('form[data-multiple-upload]').forEach(createMultipleUpload);
+  });
+})();
@@ -0,0 +1,215 @@
+// Uploads the video of a stream form in resumable chunks (tus 1.0.0) before the form is submitted.
+// An interrupted upload continues from the last received byte when the same file is chosen again.
+(function() {
+  const TUS_VERSION = '1.0.0';
+  const MAX_ATTEMPTS = 5;
+  const RETRY_DELAY = 1000;
+
+  const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+  function storageKey(file) {
+    return `wagtailstreaming-upload:${file.name}:${file.size}:${file.lastModified}`;
+  }
+
+  function encodeMetadata(value) {
+    const bytes = new TextEncoder().encode(value);
+    let binary = '';
+    bytes.forEach((b) => { binary += String.fromCharCode(b); });
+    return btoa(binary);
+  }
+
+  // Sends `file` to the tus endpoint at `options.createUrl`, resolves with the id of the complete upload session
+  function ChunkedUpload(file, options) {
+    this.file = file;
+    this.createUrl = options.createUrl;
+    this.chunkSize = options.chunkSize || 8 * 1024 * 1024;
+    this.csrfToken = options.csrfToken || '';
+    this.onProgress = options.onProgress || (() => {});
+  }
+
+  ChunkedUpload.prototype.request = function(url, method, extra, body) {
+    return fetch(url, {
+      method: method,
+      headers: Object.assign({
+        'Tus-Resumable': TUS_VERSION,
+        'X-CSRFToken': this.csrfToken,
+      }, extra),
+      body: body,
+      credentials: 'same-origin',
+    });
+  };
+
+  ChunkedUpload.prototype.resume = async function() {
+    const key = storageKey(this.file);
+    const saved = JSON.parse(localStorage.getItem(key) || 'null');
+    if (!saved) return null;
+
+    const response = await this.request(saved.url, 'HEAD');
+    if (!response.ok) {
+      localStorage.removeItem(key);
+      return null;
+    }
+    saved.offset = parseInt(response.headers.get('Upload-Offset'), 10);
+    return saved;
+  };
+
+  ChunkedUpload.prototype.create = async function() {
+    const response = await this.request(this.createUrl, 'POST', {
+      'Upload-Length': this.file.size,
+      'Upload-Metadata': `filename ${encodeMetadata(this.file.name)}`,
+    });
+    if (response.status !== 201) {
+      throw new Error(await response.text() || response.statusText);
+    }
+
+    const session = {
+      url: response.headers.get('Location'),
+      id: response.headers.get('Upload-Session'),
+      offset: 0,
+    };
+    localStorage.setItem(storageKey(this.file), JSON.stringify({ url: session.url, id: session.id }));
+    return session;
+  };
+
+  ChunkedUpload.prototype.sendChunk = async function(session) {
+    const chunk = this.file.slice(session.offset, session.offset + this.chunkSize);
+    const response = await this.request(session.url, 'PATCH', {
+      'Content-Type': 'application/offset+octet-stream',
+      'Upload-Offset': session.offset,
+    }, chunk);
+
+    if (response.status === 409) { // another attempt already moved the offset
+      const head = await this.request(session.url, 'HEAD');
+      session.offset = parseInt(head.headers.get('Upload-Offset'), 10);
+      return;
+    }
+    if (!response.ok) {
+      throw new Error(await response.text() || response.statusText);
+    }
+    session.offset = parseInt(response.headers.get('Upload-Offset'), 10);
+  };
+
+  ChunkedUpload.prototype.start = async function() {
+    const session = (await this.resume()) || (await this.create());
+    let attempts = 0;
+
+    while (session.offset < this.file.size) {
+      this.onProgress(session.offset, this.file.size, attempts);
+      try {
+        await this.sendChunk(session);
+        attempts = 0;
+      } catch (error) {
+        attempts += 1;
+        if (attempts >= MAX_ATTEMPTS) throw error;
+
+        this.onProgress(session.offset, this.file.size, attempts);
+        await sleep(RETRY_DELAY * 2 ** attempts);
+        const resumed = await this.resume();
+        if (resumed) session.offset = resumed.offset;
+      }
+    }
+
+    localStorage.removeItem(storageKey(this.file));
+    this.onProgress(this.file.size, this.file.size, 0);
+    return session.id;
+  };
+
+  function progressText(done, total, attempts) {
+    if (attempts) return `Upload interrupted, retrying (${attempts}/${MAX_ATTEMPTS - 1})`;
+    if (done >= total) return 'Upload complete';
+    return `Uploading ${Math.floor(done * 100 / total)}%`;
+  }
+
+  const FILE_INPUTS = 'input[type="file"][data-chunked-upload-url]';
+
+  // Uploads the file chosen in `fileInput` once per choice, the hidden session input of its form then names the upload
+  function uploaderFor(fileInput) {
+    if (fileInput.streamUploader) return fileInput.streamUploader;
+
+    const form = fileInput.form;
+    const sessionInput = form && form.querySelector('[data-upload-session]');
+    if (!sessionInput) return null;
+    const csrfInput = form.querySelector('[name="csrfmiddlewaretoken"]');
+
+    const status = document.createElement('p');
+    status.className = 'help';
+    fileInput.insertAdjacentElement('afterend', status);
+
+    fileInput.addEventListener('change', () => {
+      sessionInput.value = '';
+      status.textContent = '';
+    });
+
+    fileInput.streamUploader = {
+      pending: () => Boolean(fileInput.files[0] && !sessionInput.value),
+
+      // resolves once the file is uploaded, right away when there is nothing to upload
+      upload: async () => {
+        const file = fileInput.files[0];
+        if (!file || sessionInput.value) return;
+
+        try {
+          sessionInput.value = await new ChunkedUpload(file, {
+            createUrl: fileInput.dataset.chunkedUploadUrl,
+            chunkSize: parseInt(fileInput.dataset.chunkSize, 10),
+            csrfToken: csrfInput ? csrfInput.value : '',
+            onProgress: (done, total, attempts) => {
+              status.textContent = progressText(done, total, attempts);
+            },
+          }).start();
+        } catch (error) {
+          status.textContent = `Upload failed: ${error.message}`;
+          throw error;
+        }
+        fileInput.value = '';
+      },
+    };
+    return fileInput.streamUploader;
+  }
+
+  // Uploads every chunked file of a form, for forms that are submitted by script like the chooser modal
+  async function prepareForm(form) {
+    if (!window.fetch) return;
+    for (const fileInput of form.querySelectorAll(FILE_INPUTS)) {
+      const uploader = uploaderFor(fileInput);
+      if (uploader) await uploader.upload();
+    }
+  }
+
+  // Forms of full pages are submitted again once their file is uploaded
+  function bindForm(fileInput) {
+    const uploader = uploaderFor(fileInput);
+    if (!uploader || fileInput.dataset.chunkedUploadBound) return;
+    fileInput.dataset.chunkedUploadBound = 'true';
+
+    const form = fileInput.form;
+    let uploading = false;
+    form.addEventListener('submit', async (event) => {
+      if (!uploader.pending()) return;
+
+      event.preventDefault();
+      if (uploading) return;
+      uploading = true;
+
+      try {
+        await uploader.upload();
+        form.submit();
+      } catch (error) {
+        form.querySelectorAll('[data-w-progress-active-value]').forEach((button) => {
+          button.disabled = false;
+        });
+      } finally {
+        uploading = false;
+      }
+    });
+  }
+
+  window.StreamChunkedUpload = ChunkedUpload;
+  window.StreamChunkedUpload.progressText = progressText;
+  window.StreamChunkedUpload.prepareForm = prepareForm;
+
+  document.addEventListener('DOMContentLoaded', () => {
+    if (!window.fetch) return;
+    document.querySelectorAll(FILE_INPUTS).forEach(bindForm);
+  });
+})();
@@ -0,0 +1,290 @@
+from django.db.models import F, Q
+from django.utils import timezone
+
+from collections import Counter
+from datetime import timedelta
+import posixpath
+import logging
+import typing
+import os
+
+from .conversion_utils import _res_str_to_values
+from .models import VideoStream, get_stream_model
+from .rendition_utils import (
+    get_rendition_storage,
+    directory_bytes,
+    rendition_name,
+    rendition_dir,
+    is_version,
+)
+from .source_utils import effective_rendition_key
+from .settings import stream_settings
+
+LOGGER = logging.getLogger(__name__)
+
+PLAY_RECORD_SECONDS = 60 * 60 # plays are only written once an hour, by a task so the embed view stays a read
+QUERY_CHUNK_SIZE = 2000
+
+
+class Eviction(typing.NamedTuple):
+    video: VideoStream
+    drop_dash: bool
+    ladder_cap: int
+    saving: int
+
+
+def rendition_group(stream_instance: VideoStream):
+    """The instance and the instances that serve the same rendition directories"""
+    return type(stream_instance).objects.filter(
+        Q(pk = stream_instance.pk) | Q(rendition_key = effective_rendition_key(stream_instance))
+    )
+
+
+def _reencode_or_rollback(stream_instance: VideoStream, ladder_cap: int, dash_evicted: bool) -> bool:
+    """Queues the conversion that applies changed eviction flags, or puts the previous flags back if it can not be"""
+    from .task_utils import sched_reencode
+
+    if sched_reencode(stream_instance):
+        return True
+
+    stream_instance.ladder_cap = ladder_cap
+    stream_instance.dash_evicted = dash_evicted
+    stream_instance.needs_reencode = False
+    rendition_group(stream_instance).update(ladder_cap = ladder_cap, dash_evicted = dash_evicted, needs_reencode = False)
+    LOGGER.error(f'Could not schedule the conversion of {stream_instance}, its streams are left as they were')
+    return False
+
+
+def restore(stream_instance: VideoStream) -> bool:
+    """Queues the full ladder and every format of an evicted video again, once for all of its group"""
+    ladder_cap, dash_evicted = stream_instance.ladder_cap, stream_instance.dash_evicted
+    restored = rendition_group(stream_instance).filter(
+        Q(ladder_cap__gt = 0) | Q(dash_evicted = True)
+    ).update(ladder_cap = 0, dash_evicted = False)
+    if not restored:
+        return False
+
+    stream_instance.ladder_cap = 0
+    stream_instance.dash_evicted = False
+    if not _reencode_or_rollback(stream_instance, ladder_cap, dash_evicted):
+        return False
+    stream_instance.add_remark('Played again, restoring the evicted streams')
+    return True
+
+
+def needs_restore(stream_instance: VideoStream, mode: str) -> bool:
+    capped = stream_instance.ladder_cap and mode in ('hls', 'dash')
+    return bool(capped or (stream_instance.dash_evicted and mode == 'dash'))
+
+
+def play_due(stream_instance: VideoStream, mode: str) -> bool:
+    """Checks on the loaded row if a play has to be written, so most renders of the player stay reads"""
+    last = stream_instance.last_played_at
+    stale = not last or (timezone.now() - last).total_seconds() >= PLAY_RECORD_SECONDS
+    return stale or needs_restore(stream_instance, mode)
+
+
+def record_play(stream_instance: VideoStream, mode: str):
+    """Records that a player loaded the streams, and rebuilds them if they were evicted. Runs in the worker"""
+    now = timezone.now()
+    rendition_group(stream_instance).filter(
+        Q(last_played_at__isnull = True) | Q(last_played_at__lt = now - timedelta(seconds = PLAY_RECORD_SECONDS))
+    ).update(last_played_at = now)
+    stream_instance.last_played_at = now
+
+    if needs_restore(stream_instance, mode):
+        restore(stream_instance)
+
+
+def _local_bytes(path: str, skip_versions: bool) -> int:
+    # renditions encoded before versioning share their directory with the versions of later encodes
+    size = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks = False):
+                    if not (skip_versions and is_version(entry.name)):
+                        size += directory_bytes(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks = False).st_size
+    except FileNotFoundError:
+        pass
+    return size
+
+
+def _storage_bytes(storage, name: str, skip_versions: bool) -> int:
+    try:
+        directories, files = storage.listdir(name)
+    except (FileNotFoundError, NotADirectoryError):
+        return 0
+
+    size = sum(storage.size(posixpath.join(name, f)) for f in files)
+    for directory in directories:
+        if not (skip_versions and is_version(directory)):
+            size += _storage_bytes(storage, posixpath.join(name, directory), False)
+    return size
+
+
+def measure_renditions(stream_instance: VideoStream) -> typing.Dict[str, int]:
+    """Sizes of the published streams per format, for videos converted before they were recorded"""
+    storage = get_rendition_storage()
+    key = stream_instance.rendition_key or stream_instance.hashed_id
+    unversioned = not stream_instance.rendition_version
+    sizes = {}
+    for fmt, ready in (('hls', stream_instance.hls_ready), ('dash', stream_instance.dash_ready)):
+        if not ready:
+            continue
+        if storage:
+            sizes[fmt] = _storage_bytes(storage, rendition_name(fmt, rendition_dir(key, stream_instance.rendition_version)), unversioned)
+        else:
+            sizes[fmt] = _local_bytes(stream_instance.rendition_path(fmt), unversioned)
+    return sizes
+
+
+def recount(stream_instance: VideoStream) -> int:
+    sizes = measure_renditions(stream_instance)
+    stream_instance.rendition_sizes = sizes
+    stream_instance.rendition_bytes = sum(sizes.values())
+    rendition_group(stream_instance).filter(
+        rendition_version = stream_instance.rendition_version,
+        rendition_layout = stream_instance.rendition_layout,
+    ).update(rendition_sizes = sizes, rendition_bytes = stream_instance.rendition_bytes)
+    return stream_instance.rendition_bytes
+
+
+def storage_totals() -> typing.Tuple[int, typing.Counter]:
+    """
+    Bytes taken by the published streams in total and per collection, from the sizes recorded at publish time.
+    Renditions shared by several instances are counted once, and once per collection they appear in
+    """
+    rows = get_stream_model().objects.filter(rendition_bytes__gt = 0).values_list(
+        'id', 'rendition_key', 'rendition_version', 'collection_id', 'rendition_bytes',
+    ).iterator(chunk_size = QUERY_CHUNK_SIZE)
+
+    counted = set()
+    counted_in = set()
+    total = 0
+    collections = Counter()
+    for pk, key, version, collection, size in rows:
+        # instances without a key never share their directory
+        group = (key or pk, version)
+        if group not in counted:
+            counted.add(group)
+            total += size
+        if (collection, group) not in counted_in:
+            counted_in.add((collection, group))
+            collections[collection] += size
+    return total, collections
+
+
+def cold_videos(idle_days: typing.Optional[int] = None):
+    """Converted videos no player loaded for `idle_days`, never played and the largest ones first"""
+    idle_days = stream_settings.EVICTION_IDLE_DAYS if idle_days is None else idle_days
+    cutoff = timezone.now() - timedelta(days = idle_days)
+    return get_stream_model().objects.filter(
+        Q(last_played_at__isnull = True) | Q(last_played_at__lt = cutoff),
+        Q(hls_ready = True) | Q(dash_ready = True),
+        rendition_bytes__gt = 0,
+        needs_reencode = False,
+    ).order_by(F('last_played_at').asc(nulls_first = True), '-rendition_bytes')
+
+
+def _kbps(bitrate: str) -> int:
+    try:
+        return int(bitrate.lower().rstrip('k'))
+    except ValueError:
+        return 0
+
+
+def _capped_share(rungs: typing.List[typing.Dict[str, str]], cap: int) -> float:
+    """Share of the bitrate of a ladder spent on rungs taller than `cap`, the rest is kept"""
+    rates = [(_res_str_to_values(rung['resolution'])[1], _kbps(rung['bitrate'])) for rung in rungs]
+    total = sum(rate for _, rate in rates)
+    kept = [rate for height, rate in rates if height <= cap]
+    if not total or not kept:
+        # the lowest rung always stays
+        return 0.0
+    return 1 - sum(kept) / total
+
+
+def plan_eviction(
+        budget: typing.Optional[int] = None,
+        idle_days: typing.Optional[int] = None
+    ) -> typing.List[Eviction]:
+    """
+    Picks what to drop from cold videos until the published streams fit in the budget.
+    Whole MPEG-DASH trees of videos that also have HLS streams go first, then the rungs above `EVICTION_LADDER_CAP`
+    """
+    budget = stream_settings.STORAGE_BUDGET if budget is None else budget
+    total, _ = storage_totals()
+    excess = total - budget
+    if budget <= 0 or excess <= 0:
+        return []
+
+    candidates = []
+    seen = set()
+    for video in cold_videos(idle_days).iterator(chunk_size = QUERY_CHUNK_SIZE):
+        group = effective_rendition_key(video)
+        if group not in seen:
+            seen.add(group)
+            candidates.append(video)
+
+    plan: typing.Dict[int, Eviction] = {}
+    for video in candidates:
+        if excess <= 0:
+            break
+        sizes = video.rendition_sizes or {}
+        if video.dash_evicted or not (video.hls_ready and video.dash_ready and sizes.get('dash')):
+            continue
+        plan[video.pk] = Eviction(video, True, video.ladder_cap, sizes['dash'])
+        excess -= sizes['dash']
+
+    cap = stream_settings.EVICTION_LADDER_CAP
+    for video in candidates:
+        if excess <= 0:
+            break
+        if video.ladder_cap and video.ladder_cap <= cap:
+            continue
+
+        eviction = plan.get(video.pk, Eviction(video, False, video.ladder_cap, 0))
+        encoded = video.encoded_ladder or {}
+        sizes = video.rendition_sizes or {}
+        kept = [fmt for fmt in ('hls', 'dash') if not (fmt == 'dash' and (eviction.drop_dash or video.dash_evicted))]
+        saving = sum(int(sizes.get(fmt, 0) * _capped_share(encoded.get(fmt, []), cap)) for fmt in kept)
+        if saving <= 0:
+            continue
+        plan[video.pk] = eviction._replace(ladder_cap = cap, saving = eviction.saving + saving)
+        excess -= saving
+    return list(plan.values())
+
+
+def evict(
+        budget: typing.Optional[int] = None,
+        idle_days: typing.Optional[int] = None,
+        dry_run: bool = False
+    ) -> typing.List[Eviction]:
+    """
+    Drops the streams picked by `plan_eviction` through a conversion with the reduced ladder.
+    The replaced version is deleted once its grace period is over, a play queues the full streams again
+    """
+    evictions = plan_eviction(budget, idle_days)
+    if dry_run:
+        return evictions
+
+    applied = []
+    for eviction in evictions:
+        video = eviction.video
+        ladder_cap, dash_evicted = video.ladder_cap, video.dash_evicted
+        video.ladder_cap = eviction.ladder_cap
+        video.dash_evicted = video.dash_evicted or eviction.drop_dash
+        rendition_group(video).update(ladder_cap = video.ladder_cap, dash_evicted = video.dash_evicted)
+        if not _reencode_or_rollback(video, ladder_cap, dash_evicted):
+            continue
+
+        dropped = ['MPEG-DASH streams'] if eviction.drop_dash else []
+        if eviction.ladder_cap:
+            dropped.append(f'rungs above {eviction.ladder_cap}p')
+        video.add_remark(f'Evicted while cold: {", ".join(dropped)}')
+        LOGGER.info(f'Evicting streams of {video}, about {eviction.saving} bytes')
+        applied.append(eviction)
+    return applied
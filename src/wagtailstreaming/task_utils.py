@@ -1,18 +1,33 @@
 from django.db.models import QuerySet, Q
+from django.db import transaction
 from django.utils import timezone
 from django.apps import apps
 
 from abc import ABC, abstractmethod
+from collections import Counter
 from datetime import timedelta
+from urllib.parse import urlsplit
 import logging
 import typing
 import json
+import time
 
-from .models import VideoStream, get_stream_model
+from .models import VideoStream, CleanupKind, get_stream_model
+from .cleanup_utils import record_cleanup
 from .settings import stream_settings
+from . import metrics
+from .scheduling import (
+    SchedulingPolicy, 
+    FIFOPolicy, 
+    get_scheduling_policy, 
+    estimator, 
+)
 
 LOGGER = logging.getLogger(__name__)
 
+ETA_CACHE_SECONDS = 30
+PROBE_BATCH_SIZE = 20
+
 
 stream_class = get_stream_model()
 
@@ -37,22 +52,40 @@ def create_task(
         name: str, 
         task: str, 
         min: int, 
-        args: typing.List[typing.Any] = []
+        args: typing.List[typing.Any] = [], 
+        reschedule: bool = False
     ):
-    """Creates a clocked PeriodicTask in `django-celery-beat`"""
+    """
+    Creates a clocked PeriodicTask in `django-celery-beat`, or moves the task of the same name to a new clock.
+    Beat only disables one-off tasks once they ran, so names are reused instead of colliding.
+    A task that is still ahead is left alone unless `reschedule` is given, so periodic checks can not keep pushing it back
+    """
     if not celery_beat_installed():
         LOGGER.warning('Skipping create_task(): django_celery_beat is not installed')
         return None
     
-    from django_celery_beat.models import PeriodicTask
-    return PeriodicTask.objects.create(
-        clocked = schedule(min),
+    from django_celery_beat.models import ClockedSchedule, PeriodicTask
+    if not reschedule:
+        ahead = PeriodicTask.objects.filter(name = name, enabled = True, clocked__clocked_time__gt = timezone.now()).first()
+        if ahead:
+            return ahead
+
+    previous = PeriodicTask.objects.filter(name = name).values_list('clocked_id', flat = True).first()
+    periodic_task, _ = PeriodicTask.objects.update_or_create(
         name = name,
-        task = task,
-        args = json.dumps(args),
-        one_off = True,
+        defaults = {
+            'clocked': schedule(min),
+            'task': task,
+            'args': json.dumps(args),
+            'one_off': True,
+            'enabled': True,
+        }
     )
 
+    if previous and previous != periodic_task.clocked_id:
+        ClockedSchedule.objects.filter(pk = previous, periodictask__isnull = True).delete()
+    return periodic_task
+
 
 def cancel_task(name: str) -> bool:
     if celery_beat_installed():
@@ -65,16 +98,19 @@ def cancel_task(name: str) -> bool:
 
 def _create_sched(
         task_name: str, 
-        stream_instance: VideoStream
-    ):
-    """Creates a scheduled task for a certain instance"""
-    label = f'{task_name} {stream_instance.title} {stream_instance.id}'
+        stream_instance: VideoStream, 
+        min: float = 1, 
+        reschedule: bool = False
+    ) -> bool:
+    """Creates or reschedules the task of a certain instance, named by its id so renames do not fork it"""
+    label = f'{task_name} {stream_instance.id}'
 
     try:
-        create_task(label, task_name, 1, args = [stream_instance.id])
+        return create_task(label, task_name, min, args = [stream_instance.id], reschedule = reschedule) is not None
     
     except Exception as e:
         LOGGER.error(f'Failed to create task {label}: {e}')
+        return False
 
 
 def sched_conversion(stream_instance: VideoStream) -> bool:
@@ -82,8 +118,16 @@ def sched_conversion(stream_instance: VideoStream) -> bool:
     if not celery_beat_installed():
         LOGGER.warning('Skipping sched_conversion(): django_celery_beat is not installed')
         return False
-    _create_sched('wagtailstreaming_convert_video', stream_instance)
-    return True
+    return _create_sched('wagtailstreaming_convert_video', stream_instance)
+
+
+def sched_retry(stream_instance: VideoStream, delay: timedelta) -> bool:
+    """Schedules the conversion of a backed off instance for when its backoff is over"""
+    if not celery_beat_installed():
+        LOGGER.warning('Skipping sched_retry(): django_celery_beat is not installed')
+        return False
+    # a conversion scheduled before the failure would only find the instance backed off, it is moved to the end of the backoff
+    return _create_sched('wagtailstreaming_convert_video', stream_instance, delay.total_seconds() / 60, reschedule = True)
 
 
 def sched_thumbnail(stream_instance: VideoStream) -> bool:
@@ -91,24 +135,152 @@ def sched_thumbnail(stream_instance: VideoStream) -> bool:
     if not celery_beat_installed():
         LOGGER.warning('Skipping sched_thumbnail(): django_celery_beat is not installed')
         return False
-    _create_sched('wagtailstreaming_create_thumbnail', stream_instance)
-    return True
+    return _create_sched('wagtailstreaming_create_thumbnail', stream_instance)
+
+
+def sched_preparation(stream_instance: VideoStream) -> bool:
+    """Schedules the validation and probe of a new upload"""
+    if not celery_beat_installed():
+        LOGGER.warning('Skipping sched_preparation(): django_celery_beat is not installed')
+        return False
+    return _create_sched('wagtailstreaming_prepare_upload', stream_instance)
+
+
+def sched_faststart(stream_instance: VideoStream) -> bool:
+    """Schedules the faststart remux of a new source"""
+    if not celery_beat_installed():
+        LOGGER.warning('Skipping sched_faststart(): django_celery_beat is not installed')
+        return False
+    return _create_sched('wagtailstreaming_faststart_source', stream_instance)
+
+
+def sched_retirement(key: str, version: str, layout: int = 0) -> bool:
+    """Records the deletion of a replaced rendition version, it runs once the grace period is over"""
+    try:
+        record_cleanup(CleanupKind.RENDITIONS, key, version, layout, delay = stream_settings.RENDITION_GRACE_PERIOD)
+        return True
+
+    except Exception as e:
+        LOGGER.error(f'Failed to record the retirement of {key} {version or "unversioned"}: {e}')
+        return False
+
+
+def sched_cleanup() -> bool:
+    """Schedules a background run of the due cleanup jobs"""
+    if not celery_beat_installed():
+        LOGGER.warning('Skipping sched_cleanup(): django_celery_beat is not installed')
+        return False
+
+    # one task serves every cleanup, a run that is still ahead picks up the new jobs as well
+    label = 'wagtailstreaming_run_cleanup'
+    try:
+        create_task(label, 'wagtailstreaming_run_cleanup', 1)
+        return True
+
+    except Exception as e:
+        LOGGER.error(f'Failed to create task {label}: {e}')
+        return False
 
 
-def sched_download(stream_instance: VideoStream) -> bool:
-    """Schedules a download task"""
+def sched_download(stream_instance: VideoStream, delay: typing.Optional[timedelta] = None) -> bool:
+    """Schedules a download task, after `delay` when the previous download failed"""
     if not celery_beat_installed():
         LOGGER.warning('Skipping sched_download(): django_celery_beat is not installed')
         return False
-    _create_sched('wagtailstreaming_download_video', stream_instance)
-    return True
+    if delay:
+        return _create_sched('wagtailstreaming_download_video', stream_instance, delay.total_seconds() / 60, reschedule = True)
+    return _create_sched('wagtailstreaming_download_video', stream_instance)
+
+
+def backoff_delay(attempt: int) -> timedelta:
+    """Exponential backoff for the given attempt, capped at `RETRY_BACKOFF_MAX` seconds"""
+    seconds = stream_settings.RETRY_BACKOFF * (2 ** max(attempt - 1, 0))
+    return timedelta(seconds = min(seconds, stream_settings.RETRY_BACKOFF_MAX))
+
+
+def max_retries(kind: str) -> int:
+    return int(stream_settings.MAX_RETRIES.get(kind, 0))
+
+
+def record_failure(
+        stream_instance: VideoStream, 
+        kind: str, 
+        err_message: str = ''
+    ) -> bool:
+    """
+    Records a failed conversion of the given kind. 
+    Returns True if the instance is retried later, False if it has been dead lettered
+    """
+    # attempts are counted across kinds, a video alternating between failures is still dead lettered
+    stream_instance.last_failure = kind
+    stream_instance.retry_count += 1
+
+    stream_instance.process_id = None
+    retried = stream_instance.retry_count <= max_retries(kind)
+    if retried:
+        delay = backoff_delay(stream_instance.retry_count)
+        stream_instance.next_attempt_at = timezone.now() + delay
+        stream_instance.queued_at = stream_instance.next_attempt_at
+        statement = f'Conversion failed ({kind}), retry {stream_instance.retry_count} in {int(delay.total_seconds())}s'
+
+    else:
+        stream_instance.next_attempt_at = None
+        stream_instance.dead_lettered = True
+        statement = f'Conversion failed ({kind}) after {stream_instance.retry_count} attempts, video has been dead lettered'
+
+    if err_message:
+        statement = f'{statement}: {err_message}'
+
+    stream_instance.save(update_fields = [
+        'retry_count', 
+        'last_failure', 
+        'next_attempt_at', 
+        'queued_at', 
+        'dead_lettered', 
+        'process_id', 
+    ])
+    stream_instance.add_remark(statement)
+    metrics.inc('failures_total', kind = kind)
+    LOGGER.warning(f'{stream_instance}: {statement}')
+    if retried and not sched_retry(stream_instance, delay):
+        LOGGER.warning(f'{stream_instance}: the retry could not be scheduled, it waits for the next queue check')
+    return retried
+
+
+def clear_failures(stream_instance: VideoStream):
+    """Resets the retry state of an instance after a successful conversion"""
+    stream_instance.retry_count = 0
+    stream_instance.last_failure = ''
+    stream_instance.next_attempt_at = None
+    stream_instance.dead_lettered = False
+    stream_instance.process_id = None
+
+
+def requeue(stream_instance: VideoStream) -> bool:
+    """Puts a dead lettered or backed off instance back into the conversion queue"""
+    clear_failures(stream_instance)
+    stream_instance.queued_at = timezone.now()
+    stream_instance.save(update_fields = [
+        'retry_count', 
+        'last_failure', 
+        'next_attempt_at', 
+        'queued_at', 
+        'dead_lettered', 
+        'process_id', 
+    ])
+    stream_instance.add_remark('Requeued for conversion')
+    return sched_conversion(stream_instance)
 
 
 class QueueManager(ABC):
+    @property
+    def policy(self) -> SchedulingPolicy:
+        return FIFOPolicy()
+
     @property
     def stream_instances(self) -> QuerySet[VideoStream]:
         """Provides the ordered version of the video stream instances"""
-        return self.get_stream_instances().order_by('created_at', 'id')
+        return self.policy.order(self.get_stream_instances())
 
     @abstractmethod
     def get_stream_instances(self) -> QuerySet[VideoStream]:
@@ -122,16 +294,20 @@ class QueueManager(ABC):
     
     def next(self, instance: VideoStream) -> typing.Optional[VideoStream]:
         """Provides the next instance"""
-        next_instance = self.stream_instances.filter(
-            Q(created_at__gt = instance.created_at) |
-            Q(created_at = instance.created_at, id__gt = instance.id)
-        ).order_by('created_at', 'id').first()
+        next_instance = self.policy.next(self.get_stream_instances(), instance)
 
         if not next_instance: # circles back
             next_instance = self.front
         return next_instance
 
 
+DOWNLOADING = '[DOWNLOADING] '
+
+
+def url_host(url: str) -> str:
+    return urlsplit((url or '').replace(DOWNLOADING, '')).netloc.lower()
+
+
 class DownloadQueueManager(QueueManager):
     def get_stream_instances(self):
         return super().get_stream_instances().filter(
@@ -139,40 +315,199 @@ class DownloadQueueManager(QueueManager):
             file_url__isnull = False
         )
 
+    @property
+    def ongoing_instances(self) -> QuerySet[VideoStream]:
+        return self.stream_instances.filter(file_url__startswith = DOWNLOADING)
+
     @property
     def ongoing(self) -> typing.Optional[VideoStream]:
-        return self.stream_instances.filter(file_url__icontains = '[DOWNLOADING]').first()
+        return self.ongoing_instances.first()
+
+    @property
+    def pending(self) -> QuerySet[VideoStream]:
+        return self.stream_instances.exclude(file_url__startswith = DOWNLOADING).exclude(
+            download_retry_at__gt = timezone.now()
+        )
+
+    @property
+    def stale_instances(self) -> QuerySet[VideoStream]:
+        """Claimed downloads whose worker stopped reporting, most likely because it crashed"""
+        cutoff = timezone.now() - timedelta(seconds = stream_settings.DOWNLOAD_STALE_SECONDS)
+        return self.ongoing_instances.filter(
+            Q(download_heartbeat__isnull = True) | Q(download_heartbeat__lt = cutoff)
+        )
+
+    def release_stale(self) -> int:
+        """
+        Puts stale downloads back in the queue so their partial download is resumed.
+        The update is conditional on the heartbeat, a worker that reported in the meantime keeps its claim
+        """
+        released = 0
+        for pk, file_url, heartbeat in self.stale_instances.values_list('id', 'file_url', 'download_heartbeat'):
+            released += stream_class.objects.filter(
+                id = pk, 
+                file_url = file_url, 
+                download_heartbeat = heartbeat
+            ).update(file_url = file_url.replace(DOWNLOADING, ''))
+        if released:
+            LOGGER.warning(f'Released {released} download(s) whose worker stopped reporting')
+        return released
+
+    def host_counts(self) -> typing.Counter[str]:
+        """Number of ongoing downloads per source host"""
+        return Counter(url_host(url) for url in self.ongoing_instances.values_list('file_url', flat = True))
+
+    def can_start(self, instance: VideoStream) -> bool:
+        """Checks if a download slot and a connection to the source host are free for the instance"""
+        counts = self.host_counts()
+        return all((
+            sum(counts.values()) < stream_settings.MAX_CONCURRENT_DOWNLOADS, 
+            counts[url_host(instance.file_url)] < stream_settings.DOWNLOAD_HOST_CONNECTIONS, 
+        ))
+
+    def connections_for(self, instance: VideoStream) -> int:
+        """Splits the connections allowed per host between the ongoing downloads from the same host"""
+        sharing = max(self.host_counts()[url_host(instance.file_url)], 1)
+        return max(1, min(
+            stream_settings.DOWNLOAD_CONNECTIONS, 
+            stream_settings.DOWNLOAD_HOST_CONNECTIONS // sharing
+        ))
+
+    def bandwidth_share(self) -> float:
+        """Bytes per second each ongoing download may use, 0 when the bandwidth is not limited"""
+        limit = stream_settings.DOWNLOAD_BANDWIDTH_LIMIT
+        if not limit:
+            return 0.0
+        return limit / max(self.ongoing_instances.count(), 1)
+
+    def available(self) -> typing.List[VideoStream]:
+        """
+        Pending instances that can start downloading now without exceeding the slot and host limits.
+        Inside a transaction the rows are locked, another fill running at the same time skips them
+        """
+        counts = self.host_counts()
+        slots = stream_settings.MAX_CONCURRENT_DOWNLOADS - sum(counts.values())
+        chosen = []
+        if slots <= 0:
+            return chosen
+
+        for instance in self.pending.select_for_update(skip_locked = True).iterator():
+            host = url_host(instance.file_url)
+            if counts[host] >= stream_settings.DOWNLOAD_HOST_CONNECTIONS:
+                continue
+
+            counts[host] += 1
+            chosen.append(instance)
+            if len(chosen) >= slots:
+                break
+        return chosen
 
 
 class UploadQueueManager(QueueManager):
     def get_stream_instances(self):
-        qset = super().get_stream_instances()
+        qset = super().get_stream_instances().filter(dead_lettered = False).exclude(
+            next_attempt_at__gt = timezone.now()
+        )
 
+        # cold videos whose MPEG-DASH streams were evicted are not missing them
         if stream_settings.ALLOW_HLS and stream_settings.ALLOW_DASH:
-            qset = qset.filter(Q(hls_ready = False) | Q(dash_ready = False))
+            qset = qset.filter(Q(hls_ready = False) | Q(dash_ready = False, dash_evicted = False) | Q(needs_reencode = True))
 
         elif stream_settings.ALLOW_HLS:
-            qset = qset.filter(hls_ready = False)
+            qset = qset.filter(Q(hls_ready = False) | Q(needs_reencode = True))
 
         elif stream_settings.ALLOW_DASH:
-            qset = qset.filter(dash_ready = False)
+            qset = qset.filter(Q(dash_ready = False, dash_evicted = False) | Q(needs_reencode = True))
 
         else: # invalid
             return stream_class.objects.none()
         return qset
     
+    @property
+    def policy(self) -> SchedulingPolicy:
+        return get_scheduling_policy()
+
     @property
     def ongoing(self) -> typing.Optional[VideoStream]:
         return self.stream_instances.filter(process_id__isnull = False).first()
 
+    @property
+    def unprobed(self) -> QuerySet[VideoStream]:
+        return self.get_stream_instances().filter(
+            file__isnull = False, 
+            source_height__isnull = True
+        ).exclude(file = '')
+
+    def etas(self) -> typing.Dict[int, float]:
+        """Predicted seconds until each queued instance is converted, cached for a short while"""
+        computed_at, cached = getattr(self, '_etas', (0.0, {}))
+        if time.monotonic() - computed_at < ETA_CACHE_SECONDS:
+            return cached
+
+        etas = {}
+        offset = 0.0
+        queued = self.stream_instances
+        ongoing = self.ongoing
+        if ongoing:
+            offset = estimator.remaining(ongoing)
+            etas[ongoing.id] = offset
+            queued = queued.exclude(id = ongoing.id)
+
+        for id, cost, duration in queued.values_list('id', 'encode_cost', 'source_duration'):
+            offset += estimator.seconds(cost, duration)
+            etas[id] = round(offset, 2)
+
+        self._etas = (time.monotonic(), etas)
+        return etas
+
+    def eta(self, instance: VideoStream) -> typing.Optional[float]:
+        return self.etas().get(instance.id)
+
 
 download_queue = DownloadQueueManager()
 upload_queue = UploadQueueManager()
 
 
-def go_next(queue: QueueManager, instance: VideoStream, scheduler: typing.Callable[[VideoStream], None]):
-    next = queue.next(instance)
+def sched_reencode(stream_instance: VideoStream) -> bool:
+    """Queues an already converted instance for conversion with the current ladder"""
+    clear_failures(stream_instance)
+    stream_instance.needs_reencode = True
+    stream_instance.queued_at = timezone.now()
+    stream_instance.save(update_fields = [
+        'needs_reencode', 
+        'queued_at', 
+        'retry_count', 
+        'last_failure', 
+        'next_attempt_at', 
+        'dead_lettered', 
+        'process_id', 
+    ])
+    return sched_conversion(stream_instance)
+
+
+def probe_pending(limit: int = PROBE_BATCH_SIZE) -> int:
+    """Probes queued instances so the scheduler can predict their encode cost"""
+    count = 0
+    for instance in upload_queue.unprobed[:limit]:
+        if instance.probe():
+            count += 1
+    return count
+
+
+def fill_download_slots() -> int:
+    """Schedules as many pending downloads as there are free download slots, after freeing the stale ones"""
+    download_queue.release_stale()
+    scheduled = 0
+    with transaction.atomic():
+        for instance in download_queue.available():
+            if sched_download(instance):
+                scheduled += 1
+    return scheduled
+
+
+def go_next(queue: QueueManager, instance: typing.Optional[VideoStream], scheduler: typing.Callable[[VideoStream], None]):
+    next = queue.next(instance) if instance else queue.front
     if next:
-        scheduler(instance)
+        scheduler(next)
     else:
         LOGGER.info('There are no more videos left to be processed')
\ No newline at end of file
@@ -1,23 +1,36 @@
 from django.utils import timezone
+from celery.signals import task_postrun
 from celery import shared_task
 import logging 
+import os
+
+from . import metrics
 
 LOGGER = logging.getLogger(__name__)
 
+# prefork children leave through os._exit, the measurements of a task are written before the worker idles
+task_postrun.connect(metrics.flush, weak = False)
+
 
 @shared_task(name = 'wagtailstreaming_check_queue')
 def check_queue():
-    from . import task_utils
+    from . import task_utils, upload_utils, cleanup_utils
 
     if not task_utils.celery_beat_installed():
         LOGGER.warning('Skipping check_queue(): django_celery_beat is not installed')
         return
 
+    upload_utils.expire_sessions()
+    if cleanup_utils.due_jobs().exists():
+        # retries of jobs whose storage was unavailable and retirements whose grace period is over
+        task_utils.sched_cleanup()
+
     ongoing = task_utils.upload_queue.ongoing
     if ongoing:
         LOGGER.info(f'There is currently a stream instance getting processed! id: {ongoing.id}')
         return
 
+    task_utils.probe_pending()
     on_queue = task_utils.upload_queue.front
     if not on_queue:
         LOGGER.info('All uploads have been processed')
@@ -33,16 +46,14 @@ def check_downloads():
         LOGGER.warning('Skipping check_downloads(): django_celery_beat is not installed')
         return
     
-    ongoing = task_utils.download_queue.ongoing
-    if ongoing:
-        LOGGER.info(f'There is currently a stream instance getting processed! id: {ongoing.id}')
-        return
-    
-    on_queue = task_utils.download_queue.front
-    if not on_queue:
+    task_utils.download_queue.release_stale()
+    if not task_utils.download_queue.pending.exists():
         LOGGER.info('All downloads have been processed')
         return
-    task_utils.sched_download(on_queue)
+
+    scheduled = task_utils.fill_download_slots()
+    if not scheduled:
+        LOGGER.info('All download slots are taken')
 
 
 @shared_task(name = 'wagtailstreaming_convert_video')
@@ -54,8 +65,8 @@ def convert_video(stream_id):
         LOGGER.info(f'There is currently a stream instance getting processed! id: {ongoing.id}')
         return
     
-    from .models import get_stream_model
-    from .conversion_utils import get_segmenter
+    from .models import FailureKind, get_stream_model
+    from .conversion_utils import get_segmenter, segmenter_formats
     stream_class = get_stream_model()
 
     video = stream_class.objects.filter(id = stream_id).first()
@@ -73,73 +84,276 @@ def convert_video(stream_id):
         task_utils.sched_download(video)
         task_utils.go_next(task_utils.upload_queue, video, task_utils.sched_conversion)
         return
+
+    if not os.path.isfile(video.raw.path):
+        task_utils.record_failure(
+            video, FailureKind.MISSING_FILE, 
+            f'The video file {video.file.name} could not be found'
+        )
+        task_utils.go_next(task_utils.upload_queue, video, task_utils.sched_conversion)
+        return
     
-    w = video.attrs.streams[0].width or 0 if video.attrs.streams else 0
-    h = video.attrs.streams[0].height or 0 if video.attrs.streams else 0
+    if video.source_height is None:
+        video.probe()
+
+    from .source_utils import adopt_renditions, assign_rendition_key, faststart_source, share_renditions
+    if not video.faststart_name:
+        # sources imported in bulk skip the signal that schedules the remux
+        faststart_source(video)
+
+    if not (video.hls_ready or video.dash_ready) and adopt_renditions(video):
+        task_utils.clear_failures(video)
+        video.save()
+        LOGGER.info(f'Stream instance {video} reuses the streams of an identical upload')
+        task_utils.go_next(task_utils.upload_queue, video, task_utils.sched_conversion)
+        return
+
+    w = video.source_width or 0
+    h = video.source_height or 0
     segment = get_segmenter(w, h, video.supported_resolutions)
 
     if segment is None:
+        kind = FailureKind.MEMORY
         reason = 'Lack of memory in machine'
         if 0 in [w, h]:
+            kind = FailureKind.FFMPEG
             reason = 'Resolution of unprocessed video can not be determined'
 
         err_message = f'Could not determine ideal segmenter for Stream instance {video}: {reason}'
-        video.add_remark(err_message)
-        LOGGER.warning(err_message)
+        task_utils.record_failure(video, kind, err_message)
         task_utils.go_next(task_utils.upload_queue, video, task_utils.sched_conversion)
         return
 
     video.date_processed = timezone.now()
+    video.encode_failure = ''
     video.save()
+    metrics.observe('queue_wait_seconds', (video.date_processed - (video.queued_at or video.created_at)).total_seconds())
 
-    hls_okay, dash_okay = segment(video)
+    from .ladder_utils import can_reconcile, reconcile_ladder
+    from .rendition_utils import RenditionPublisher
+
+    # every encode is written to a new version and published in place of the current one
+    reconcile = can_reconcile(video)
+    if not reconcile:
+        assign_rendition_key(video)
+    # the version is switched once the formats the segmenter produces are published
+    formats = None if reconcile else segmenter_formats(segment, video.ladder_formats)
+    publisher = RenditionPublisher(video, formats = formats, seed = reconcile)
+    publisher.start()
+
+    if reconcile:
+        hls_okay, dash_okay, encoded_ladder = reconcile_ladder(video)
+        hls_okay, dash_okay = publisher.finish(hls_okay, dash_okay)
+    else:
+        hls_okay, dash_okay = publisher.finish(*segment(video))
+        encoded_ladder = {
+            fmt: video.target_ladder
+            for fmt, okay in (('hls', hls_okay), ('dash', dash_okay)) if okay
+        }
+    if not video.__class__.objects.filter(id = video.id).exists():
+        LOGGER.info(f'Stream instance {stream_id} was deleted while being converted')
+        task_utils.go_next(task_utils.upload_queue, None, task_utils.sched_conversion)
+        return
 
     if any([hls_okay, dash_okay]):
         video.hls_ready = hls_okay
         video.dash_ready = dash_okay
         video.date_finished = timezone.now()
+
+        video.encoded_ladder = encoded_ladder
         video.save()
+        share_renditions(video)
 
         if not video.thumbnail:
             if video._populate_thumbnail():
                 LOGGER.info(f'Successfully created thumbnail for stream instance {video}')
+
+    formats = video.ladder_formats
+    complete = all((
+        hls_okay or 'hls' not in formats, 
+        dash_okay or 'dash' not in formats, 
+    ))
+
+    if complete:
+        task_utils.clear_failures(video)
+        video.needs_reencode = False
+        video.save()
         LOGGER.info(f'Successfully converted stream instance {video}')
 
     else:
-        LOGGER.warning(f'Could not convert stream instance {video}')
+        # encoders that were killed for lack of memory record it while the conversion runs
+        kind = stream_class.objects.filter(id = video.id).values_list('encode_failure', flat = True).first() or FailureKind.FFMPEG
+        err_message = f'HLS converted: {hls_okay}, MPEG-DASH converted: {dash_okay}'
+        published = {'hls': hls_okay, 'dash': dash_okay}
+        if publisher.formats and all(published[fmt] for fmt in publisher.formats):
+            # the sequential segmenter ran for lack of memory and skipped MPEG-DASH, the HLS streams are served meanwhile
+            kind = FailureKind.MEMORY
+            err_message = f'{err_message}, MPEG-DASH needs the memory of the bulk segmenter'
+        task_utils.record_failure(video, kind, err_message)
     task_utils.go_next(task_utils.upload_queue, video, task_utils.sched_conversion)
 
 
 @shared_task(name = 'wagtailstreaming_download_video')
 def download_video(stream_id):
     from . import task_utils, download_utils
-
-    ongoing = task_utils.download_queue.ongoing
-    if ongoing:
-        LOGGER.info(f'There is currently a stream instance getting processed! id: {ongoing.id}')
-        return
-
     from .models import get_stream_model
     stream_class = get_stream_model()
 
     video = stream_class.objects.filter(id = stream_id).first()
     if not video:
         LOGGER.warning(f'There is no Strean instance with the id {stream_id}!')
-        task_utils.go_next(task_utils.download_queue, video, task_utils.sched_download)
+        task_utils.fill_download_slots()
         return
 
     if video.file:
-        task_utils.go_next(task_utils.download_queue, video, task_utils.sched_download)
+        task_utils.fill_download_slots()
         return
 
     if not video.file_url:
         LOGGER.error(f'The stream instance {video} has not given a valid google drive link!')
-        task_utils.go_next(task_utils.download_queue, video, task_utils.sched_download)
+        task_utils.fill_download_slots()
+        return
+
+    if video.file_url.startswith(task_utils.DOWNLOADING) and task_utils.download_queue.release_stale():
+        # the worker that claimed it stopped reporting, the partial download is resumed here
+        video.refresh_from_db()
+
+    if video.file_url.startswith(task_utils.DOWNLOADING):
+        LOGGER.info(f'The stream instance {video} is already being downloaded')
+        return
+
+    if not download_utils.claim(video):
+        LOGGER.info(f'No download slot is free for {video}, it stays queued')
         return
 
     if download_utils.download(video):
+        if not video.ladder_matches():
+            task_utils.sched_conversion(video)
+
+        elif not video.thumbnail and video._populate_thumbnail():
+            LOGGER.info(f'Successfully created thumbnail for stream instance {video}')
+    task_utils.fill_download_slots()
+
+
+@shared_task(name = 'wagtailstreaming_prepare_upload')
+def prepare_upload(stream_id):
+    from django.core.exceptions import ValidationError
+    from . import task_utils
+    from .models import FailureKind, get_stream_model
+    from .settings import stream_settings
+    from .validators import VideoFileValidator
+    stream_class = get_stream_model()
+
+    video = stream_class.objects.filter(id = stream_id).first()
+    if not video or not video.file:
+        LOGGER.warning(f'There is no uploaded video for the Stream instance with the id {stream_id}!')
+        return
+
+    try:
+        with video.file.open('rb'):
+            VideoFileValidator(stream_settings.VIDEO_EXTENSIONS)(video.file)
+
+    except (ValidationError, OSError) as e:
+        reason = '; '.join(e.messages) if isinstance(e, ValidationError) else str(e)
+        video.dead_lettered = True
+        video.save(update_fields = ['dead_lettered'])
+        video.add_remark(f'Upload rejected: {reason}')
+        LOGGER.warning(f'Upload of stream instance {video} was rejected: {reason}')
+        return
+
+    if video.source_height is None and not video.probe():
+        task_utils.record_failure(video, FailureKind.FFMPEG, 'The uploaded video could not be probed')
+        return
+
+    if not video.thumbnail:
+        task_utils.sched_thumbnail(video)
+
+    # uploads of one batch are prepared in parallel, only the one at the front starts the idle queue
+    if not task_utils.upload_queue.ongoing and getattr(task_utils.upload_queue.front, 'id', None) == video.id:
         task_utils.sched_conversion(video)
 
-    video.raw_link = video.file_url.replace('DOWNLOADING ', '')
-    video.save()
-    task_utils.go_next(task_utils.download_queue, video, task_utils.sched_download)
\ No newline at end of file
+
+@shared_task(name = 'wagtailstreaming_create_thumbnail')
+def create_thumbnail(stream_id):
+    from .models import get_stream_model
+    stream_class = get_stream_model()
+
+    video = stream_class.objects.filter(id = stream_id).first()
+    if not video or video.thumbnail:
+        return
+
+    if video._populate_thumbnail():
+        LOGGER.info(f'Successfully created thumbnail for stream instance {video}')
+    else:
+        LOGGER.warning(f'Could not create a thumbnail for stream instance {video}')
+
+
+@shared_task(name = 'wagtailstreaming_faststart_source')
+def faststart_source(stream_id):
+    from .models import get_stream_model
+    from .source_utils import faststart_source as remux
+    stream_class = get_stream_model()
+
+    video = stream_class.objects.filter(id = stream_id).first()
+    if not video or not video.file:
+        return
+    remux(video)
+
+
+@shared_task(name = 'wagtailstreaming_retire_version')
+def retire_version(key, version, layout = 0):
+    # retirements scheduled before they were recorded as cleanup jobs
+    from .cleanup_utils import record_cleanup, run_cleanup
+    from .models import CleanupKind
+
+    record_cleanup(CleanupKind.RENDITIONS, key, version, layout)
+    run_cleanup()
+
+
+@shared_task(name = 'wagtailstreaming_run_cleanup')
+def run_cleanup():
+    from . import cleanup_utils, task_utils
+
+    done = cleanup_utils.run_cleanup()
+    LOGGER.info(f'{done} cleanup job(s) finished')
+    if cleanup_utils.due_jobs().exists():
+        task_utils.sched_cleanup()
+
+
+@shared_task(name = 'wagtailstreaming_verify_renditions')
+def verify_renditions():
+    from django.db.models import Q
+    from .models import RenditionHealth, get_stream_model
+    from .settings import stream_settings
+    from .verify_utils import verify_all
+
+    # new versions reset the health, so this picks up every conversion since the last run
+    queryset = get_stream_model().objects.filter(
+        Q(hls_ready = True) | Q(dash_ready = True),
+        rendition_health = RenditionHealth.UNCHECKED,
+    )
+    broken = [video for video, health, _ in verify_all(queryset, reencode = stream_settings.REENCODE_BROKEN) if health == RenditionHealth.BROKEN]
+    if broken:
+        LOGGER.warning(f'{len(broken)} video(s) have broken streams: {", ".join(str(video.id) for video in broken)}')
+
+
+@shared_task(name = 'wagtailstreaming_evict_renditions')
+def evict_renditions():
+    from .settings import stream_settings
+    from .storage_utils import evict
+
+    if not stream_settings.STORAGE_BUDGET:
+        return
+    evictions = evict()
+    if evictions:
+        LOGGER.info(f'Evicting the streams of {len(evictions)} cold video(s), about {sum(e.saving for e in evictions)} bytes')
+
+
+@shared_task(name = 'wagtailstreaming_record_play')
+def record_play(stream_id, mode):
+    from .models import get_stream_model
+    from .storage_utils import record_play
+
+    video = get_stream_model().objects.filter(id = stream_id).first()
+    if video:
+        record_play(video, mode)
@@ -0,0 +1,246 @@
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db.models import Q
+from django.utils import timezone
+
+from datetime import timedelta
+import threading
+import hashlib
+import logging
+import typing
+import time
+import os
+
+from .conversion_utils import check_header_attributes, check_attributes
+from .container_utils import sniff
+from .ingest_utils import MAX_HEADER_BYTES, PROBE_BYTES, SNIFF_BYTES
+from .models import UploadSession, get_stream_model
+from .source_utils import TEMP_DIR, get_source_storage, source_referenced
+from .settings import stream_settings
+
+LOGGER = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+WRITE_LEASE_SECONDS = 60 # renewed while a chunk is written, a request that died releases the session after this long
+
+# running SHA-256 of the sessions this process has received chunks for, keyed by session id.
+# A chunk that lands on another process rebuilds the hash from the bytes already on disk
+_hashers: typing.Dict[str, typing.Tuple[int, typing.Any]] = {}
+_hashers_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def partial_path(session: UploadSession) -> str:
+    return get_source_storage().path(f'{TEMP_DIR}/{session.id}.part')
+
+
+def validate_upload(filename: str, length: int):
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    if extension not in stream_settings.VIDEO_EXTENSIONS:
+        raise UploadError(f'Unsupported file extension: {extension or "none"}', 415)
+
+    max_size = stream_settings.MAX_UPLOAD_SIZE
+    if max_size and length > max_size:
+        raise UploadError(f'Upload of {length} bytes exceeds the limit of {max_size} bytes', 413)
+
+
+def create_session(user, filename: str, length: int) -> UploadSession:
+    filename = os.path.basename(filename.replace('\\', '/'))
+    validate_upload(filename, length)
+
+    session = UploadSession.objects.create(user = user, filename = filename, length = length)
+    path = partial_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    open(path, 'wb').close()
+    return session
+
+
+def _take_hasher(session: UploadSession):
+    with _hashers_lock:
+        entry = _hashers.pop(str(session.id), None)
+
+    if entry and entry[0] == session.offset:
+        return entry[1]
+
+    hasher = hashlib.sha256()
+    with open(partial_path(session), 'rb') as f:
+        remaining = session.offset
+        while remaining:
+            chunk = f.read(min(READ_SIZE, remaining))
+            if not chunk:
+                raise UploadError('Received bytes are missing on disk', 410)
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+
+def _probe_threshold(session: UploadSession) -> int:
+    """Bytes after which the header of the upload is probed, enough for the largest header a streamable file has"""
+    return min(MAX_HEADER_BYTES + PROBE_BYTES, session.length)
+
+
+def _probe_header(session: UploadSession):
+    """Probes the upload from its header, once when the chunk that crosses `_probe_threshold` arrived"""
+    with open(partial_path(session), 'rb') as f:
+        header = f.read(min(session.offset, MAX_HEADER_BYTES + PROBE_BYTES))
+
+    if len(header) < min(SNIFF_BYTES, session.length):
+        return
+
+    info = sniff(header)
+    if not (info.streamable and info.complete):
+        return
+
+    needed = min(info.header_size + PROBE_BYTES, session.length)
+    if len(header) < needed:
+        return
+
+    attrs = check_header_attributes(header[:needed])
+    if attrs and attrs.get('streams'):
+        session.attributes = attrs
+        session.save(update_fields = ['attributes', 'updated_at'])
+
+
+def _complete(session: UploadSession, digest: str):
+    storage = get_source_storage()
+    name = get_stream_model()._meta.get_field('file').generate_filename(None, session.filename)
+    path = partial_path(session)
+
+    if hasattr(storage, 'adopt'):
+        stored_name = storage.adopt(path, name, digest)
+    else:
+        with open(path, 'rb') as f:
+            stored_name = storage.save(name, File(f, name = session.filename))
+        os.remove(path)
+
+    if not session.attributes:
+        session.attributes = check_attributes(storage.path(stored_name)) or {}
+
+    session.stored_name = stored_name
+    session.save(update_fields = ['stored_name', 'attributes', 'updated_at'])
+    LOGGER.info(f'Upload {session} completed as {stored_name}')
+
+
+def _claim(session: UploadSession, offset: int):
+    """Leases the session at `offset` with a conditional update, so only one request writes its bytes"""
+    now = timezone.now()
+    lease = now + timedelta(seconds = WRITE_LEASE_SECONDS)
+    claimed = UploadSession.objects.filter(pk = session.pk, offset = offset).filter(
+        Q(writing_until__isnull = True) | Q(writing_until__lt = now)
+    ).update(writing_until = lease)
+    if not claimed:
+        raise UploadError('Upload offset was changed or is being written by a concurrent request', 409)
+    return lease
+
+
+def _renew(session: UploadSession, lease):
+    renewed = timezone.now() + timedelta(seconds = WRITE_LEASE_SECONDS)
+    if not UploadSession.objects.filter(pk = session.pk, writing_until = lease).update(writing_until = renewed):
+        raise UploadError('Upload was taken over by a concurrent request', 409)
+    return renewed
+
+
+def write_chunk(session: UploadSession, offset: int, stream) -> UploadSession:
+    """
+    Appends the body of a request at `offset`, hashing it while it is written.
+    The session is leased before anything is written, concurrent requests for the same offset get a 409.
+    Bytes received before the client went away are kept, so the upload resumes from there
+    """
+    if session.complete:
+        raise UploadError('Upload is already complete', 403)
+
+    if offset != session.offset:
+        raise UploadError(f'Upload offset is {session.offset}, got {offset}', 409)
+
+    lease = _claim(session, offset)
+    renewed_at = time.monotonic()
+    try:
+        hasher = _take_hasher(session)
+        written = 0
+        remaining = session.length - offset
+        fd = os.open(partial_path(session), os.O_WRONLY)
+        try:
+            while written < remaining:
+                try:
+                    chunk = stream.read(min(READ_SIZE, remaining - written))
+                except OSError as e:
+                    LOGGER.info(f'Upload {session} interrupted after {written} bytes: {e}')
+                    break
+
+                if not chunk:
+                    break
+
+                # a read that blocked may have outlived the lease, it is renewed before the bytes are written
+                if time.monotonic() - renewed_at > WRITE_LEASE_SECONDS / 3:
+                    lease = _renew(session, lease)
+                    renewed_at = time.monotonic()
+
+                os.pwrite(fd, chunk, offset + written)
+                hasher.update(chunk)
+                written += len(chunk)
+        finally:
+            os.close(fd)
+
+        new_offset = offset + written
+        updated = UploadSession.objects.filter(pk = session.pk, offset = offset, writing_until = lease).update(
+            offset = new_offset, writing_until = None, updated_at = timezone.now()
+        )
+        if not updated:
+            raise UploadError('Upload was taken over by a concurrent request', 409)
+        lease = None
+
+    finally:
+        if lease:
+            UploadSession.objects.filter(pk = session.pk, writing_until = lease).update(writing_until = None)
+
+    session.offset = new_offset
+    if new_offset >= session.length:
+        _complete(session, hasher.hexdigest())
+        return session
+
+    with _hashers_lock:
+        _hashers[str(session.id)] = (new_offset, hasher)
+
+    if not session.attributes and offset < _probe_threshold(session) <= new_offset:
+        _probe_header(session)
+    return session
+
+
+def terminate(session: UploadSession):
+    """Removes a session with whatever it received, complete sources stay when an instance uses them"""
+    with _hashers_lock:
+        _hashers.pop(str(session.id), None)
+
+    path = partial_path(session)
+    if os.path.exists(path):
+        os.remove(path)
+
+    if session.complete and not source_referenced(get_stream_model(), session.stored_name):
+        get_source_storage().delete(session.stored_name)
+    session.delete()
+
+
+def claim_session(session_id, user) -> typing.Optional[UploadSession]:
+    try:
+        return UploadSession.objects.filter(pk = session_id, user = user).exclude(stored_name = '').first()
+    except ValidationError: # not a UUID
+        return None
+
+
+def expire_sessions() -> int:
+    """Removes sessions that have not received anything within `UPLOAD_SESSION_TTL` seconds"""
+    ttl = stream_settings.UPLOAD_SESSION_TTL
+    if not ttl:
+        return 0
+
+    expired = UploadSession.objects.filter(updated_at__lt = timezone.now() - timedelta(seconds = ttl))
+    count = 0
+    for session in expired:
+        terminate(session)
+        count += 1
+    return count
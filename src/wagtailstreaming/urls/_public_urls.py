@@ -1,9 +1,10 @@
 from django.urls import path
-from ..views import embed
+from ..views import embed, metrics
 
 
 app_name = 'wagtailstreaming_public'
 
 urlpatterns = [
     path('embed/<int:pk>/', embed.embed, name = 'embed'),
+    path('metrics/', metrics.metrics, name = 'metrics'),
 ]
\ No newline at end of file
@@ -1,23 +1,48 @@
 from django.core.validators import FileExtensionValidator
 from django.core.exceptions import ValidationError
+from django.core.files import File
+import threading
 import magic
 
+MAGIC_BYTES = 2048
 
-class VideoFileValidator(FileExtensionValidator):
-    def __call__(self, value):
-        super().__call__(value)
-        mime = magic.Magic(mime = True).from_buffer(value.read(2048))
-        value.seek(0)
+# libmagic handles load the magic database once, they are not safe to share between threads
+_local = threading.local()
+
+
+def sniff_mime(header: bytes) -> str:
+    """MIME type of a file judged from its first bytes"""
+    if not hasattr(_local, 'magic'):
+        _local.magic = magic.Magic(mime = True)
+    return _local.magic.from_buffer(header[:MAGIC_BYTES])
 
-        if not mime.startswith("video/"):
-            raise ValidationError(f"Unsupported file type: {mime}. Only video are allowed.")
 
+class MimeFileValidator(FileExtensionValidator):
+    mime_prefix = ''
+    label = ''
 
-class PhotoFileValidator(FileExtensionValidator):
     def __call__(self, value):
         super().__call__(value)
-        mime = magic.Magic(mime = True).from_buffer(value.read(2048))
+        header = value.read(MAGIC_BYTES)
         value.seek(0)
+        self.check_mime(header)
+
+    def check_mime(self, header: bytes):
+        mime = sniff_mime(header)
+        if not mime.startswith(self.mime_prefix):
+            raise ValidationError(f"Unsupported file type: {mime}. Only {self.label} are allowed.")
+
+    def validate_header(self, name: str, header: bytes):
+        """Validates a file from its name and the first bytes that were kept while it was written"""
+        super().__call__(File(None, name = name))
+        self.check_mime(header)
+
+
+class VideoFileValidator(MimeFileValidator):
+    mime_prefix = 'video/'
+    label = 'video'
+
 
-        if not mime.startswith("image/"):
-            raise ValidationError(f"Unsupported file type: {mime}. Only photos are allowed.")
\ No newline at end of file
+class PhotoFileValidator(MimeFileValidator):
+    mime_prefix = 'image/'
+    label = 'photos'
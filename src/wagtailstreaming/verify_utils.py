@@ -0,0 +1,432 @@
+from django.utils import timezone
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from xml.etree import ElementTree
+import posixpath
+import logging
+import typing
+import random
+import re
+import os
+
+from .conversion_utils import ENCODER, check_attributes
+from .models import RenditionHealth, VideoStream
+from .rendition_utils import (
+    ENTRY_MANIFESTS,
+    get_rendition_storage,
+    rendition_name,
+    rendition_dir,
+)
+from .ladder_utils import MPD_NS
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+MIN_SEGMENT_BYTES = 188 # one MPEG-TS packet, smaller segments can not hold a frame
+MAX_PROBLEMS = 20
+NUMBER_PATTERN = re.compile(r'\$Number(?:%0(\d+)d)?\$')
+TIME_PATTERN = re.compile(r'\$Time(?:%0(\d+)d)?\$')
+
+
+def _tag(name: str) -> str:
+    return f'{{{MPD_NS}}}{name}'
+
+
+class RenditionFiles:
+    """The published version of a format, read from its local directory or from the rendition storage"""
+
+    def __init__(self, stream_instance: VideoStream, fmt: str):
+        self.storage = get_rendition_storage()
+        self.root = stream_instance.rendition_path(fmt)
+        key = stream_instance.rendition_key or stream_instance.hashed_id
+        self.name = rendition_name(fmt, rendition_dir(key, stream_instance.rendition_version))
+
+    def read(self, relative: str) -> str:
+        if self.storage:
+            with self.storage.open(posixpath.join(self.name, relative), 'rb') as f:
+                return f.read().decode('utf-8')
+        with open(os.path.join(self.root, relative), encoding = 'utf-8') as f:
+            return f.read()
+
+    def size(self, relative: str) -> typing.Optional[int]:
+        """Size of a file, None if it does not exist"""
+        try:
+            if self.storage:
+                return self.storage.size(posixpath.join(self.name, relative))
+            return os.path.getsize(os.path.join(self.root, relative))
+        except (FileNotFoundError, OSError):
+            return None
+
+    def path(self, relative: str) -> str:
+        """Local path of a file for ffprobe, empty when the files live in the rendition storage"""
+        return '' if self.storage else os.path.join(self.root, relative)
+
+
+class Segment(typing.NamedTuple):
+    uri: str
+    duration: float
+    end: int = 0 # the last byte a byte range needs, 0 for whole files
+
+
+class Report:
+    def __init__(self):
+        self.segments = 0
+        self.bytes = 0
+        self.duration = 0.0
+        self.problems: typing.List[str] = []
+        self.files: typing.Set[str] = set()
+
+    def problem(self, statement: str):
+        self.problems.append(statement)
+
+    def as_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'segments': self.segments,
+            'bytes': self.bytes,
+            'duration': round(self.duration, 2),
+            'problems': self.problems[:MAX_PROBLEMS],
+            'problem_count': len(self.problems),
+        }
+
+
+def _resolve(base: str, uri: str) -> str:
+    """Path of a playlist reference relative to the version directory, empty for references outside of it"""
+    if '://' in uri or uri.startswith('/'):
+        return ''
+    path = posixpath.normpath(posixpath.join(posixpath.dirname(base), uri))
+    return '' if path.startswith('..') else path
+
+
+def _check_segments(
+        files: RenditionFiles,
+        report: Report,
+        segments: typing.List[Segment],
+        max_duration: float
+    ):
+    sizes: typing.Dict[str, typing.Optional[int]] = {}
+    for segment in segments:
+        if not segment.uri:
+            report.problem('a segment is referenced outside of the rendition directory')
+            continue
+
+        if segment.uri not in sizes:
+            sizes[segment.uri] = files.size(segment.uri)
+            report.bytes += sizes[segment.uri] or 0
+            report.files.add(segment.uri)
+        size = sizes[segment.uri]
+
+        report.segments += 1
+        report.duration += segment.duration
+        if size is None:
+            report.problem(f'missing segment {segment.uri}')
+        elif segment.end and size < segment.end:
+            report.problem(f'{segment.uri} is truncated, {size} bytes of {segment.end}')
+        elif not segment.end and size < MIN_SEGMENT_BYTES:
+            report.problem(f'{segment.uri} is too small ({size} bytes)')
+
+        if not 0 < segment.duration <= max_duration:
+            report.problem(f'{segment.uri} has an implausible duration of {segment.duration}s')
+
+
+def _media_playlist(text: str, base: str) -> typing.Tuple[float, typing.List[Segment], bool]:
+    """Target duration, segments and ENDLIST of an HLS media playlist, byte ranges continue the previous one"""
+    target = 0.0
+    segments = []
+    duration = 0.0
+    byterange = None
+    offsets: typing.Dict[str, int] = {}
+    for line in (l.strip() for l in text.splitlines()):
+        if line.startswith('#EXT-X-TARGETDURATION:'):
+            target = float(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',', 1)[0])
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            length, _, offset = line.split(':', 1)[1].partition('@')
+            byterange = (int(length), int(offset) if offset else None)
+        elif line.startswith('#EXT-X-MAP:'):
+            match = re.search(r'URI="([^"]+)"', line)
+            if match:
+                segments.append(Segment(_resolve(base, match.group(1)), -1.0))
+        elif line and not line.startswith('#'):
+            uri = _resolve(base, line)
+            end = 0
+            if byterange:
+                length, offset = byterange
+                offset = offsets.get(uri, 0) if offset is None else offset
+                end = offsets[uri] = offset + length
+            segments.append(Segment(uri, duration, end))
+            duration = 0.0
+            byterange = None
+    return target, segments, '#EXT-X-ENDLIST' in text
+
+
+def verify_hls(files: RenditionFiles) -> Report:
+    report = Report()
+    entry = ENTRY_MANIFESTS['hls']
+    try:
+        master = files.read(entry)
+    except (FileNotFoundError, OSError) as e:
+        report.problem(f'missing {entry}: {e}')
+        return report
+
+    variants = [_resolve(entry, line.strip()) for line in master.splitlines() if line.strip() and not line.startswith('#')]
+    if not variants:
+        report.problem(f'{entry} lists no variants')
+
+    durations = []
+    for variant in variants:
+        try:
+            target, segments, ended = _media_playlist(files.read(variant), variant)
+        except (FileNotFoundError, OSError) as e:
+            report.problem(f'missing variant playlist {variant}: {e}')
+            continue
+        except ValueError as e:
+            report.problem(f'could not parse {variant}: {e}')
+            continue
+
+        if not ended:
+            report.problem(f'{variant} has no ENDLIST, it was not finished')
+        if not segments:
+            report.problem(f'{variant} lists no segments')
+
+        # the init segment of fragmented MP4 variants has no duration
+        init = [s for s in segments if s.duration < 0]
+        for segment in init:
+            if files.size(segment.uri) is None:
+                report.problem(f'missing init segment {segment.uri}')
+
+        media = [s for s in segments if s.duration >= 0]
+        before = report.duration
+        _check_segments(files, report, media, (target or float(ENCODER['segment_seconds'])) + 1)
+        durations.append(report.duration - before)
+
+    report.duration = max(durations, default = 0.0)
+    return report
+
+
+def _fill(template: str, rep_id: str, bandwidth: str, number: int, start: int) -> str:
+    name = template.replace('$RepresentationID$', rep_id).replace('$Bandwidth$', bandwidth)
+    name = NUMBER_PATTERN.sub(lambda m: str(number).zfill(int(m.group(1) or 0)), name)
+    return TIME_PATTERN.sub(lambda m: str(start).zfill(int(m.group(1) or 0)), name)
+
+
+def _template_segments(
+        template: ElementTree.Element,
+        representation: ElementTree.Element,
+        base: str
+    ) -> typing.List[Segment]:
+    """Expands the SegmentTimeline of a SegmentTemplate into its segment files"""
+    rep_id = representation.get('id', '')
+    bandwidth = representation.get('bandwidth', '')
+    timescale = int(template.get('timescale', '1'))
+    number = int(template.get('startNumber', '1'))
+    segments = []
+
+    initialization = template.get('initialization')
+    if initialization:
+        segments.append(Segment(_resolve(base, _fill(initialization, rep_id, bandwidth, 0, 0)), -1.0))
+
+    media = template.get('media', '')
+    timeline = template.find(_tag('SegmentTimeline'))
+    if timeline is None:
+        return segments
+
+    time = 0
+    for s in timeline.findall(_tag('S')):
+        time = int(s.get('t', time))
+        duration = int(s.get('d', '0'))
+        for _ in range(max(int(s.get('r', '0')), 0) + 1):
+            segments.append(Segment(_resolve(base, _fill(media, rep_id, bandwidth, number, time)), duration / timescale))
+            number += 1
+            time += duration
+    return segments
+
+
+def _list_segments(
+        segment_list: ElementTree.Element,
+        representation: ElementTree.Element,
+        base: str
+    ) -> typing.List[Segment]:
+    """Segments of a single-file representation, byte ranges of the file its BaseURL names"""
+    base_url = representation.find(_tag('BaseURL'))
+    uri = _resolve(base, (base_url.text or '').strip()) if base_url is not None else ''
+    timescale = int(segment_list.get('timescale', '1'))
+    duration = int(segment_list.get('duration', '0')) / timescale
+
+    segments = []
+    initialization = segment_list.find(_tag('Initialization'))
+    if initialization is not None and initialization.get('range'):
+        segments.append(Segment(uri, -1.0, int(initialization.get('range').split('-')[1]) + 1))
+    for segment_url in segment_list.findall(_tag('SegmentURL')):
+        media_range = segment_url.get('mediaRange', '')
+        end = int(media_range.split('-')[1]) + 1 if '-' in media_range else 0
+        segments.append(Segment(segment_url.get('media') and _resolve(base, segment_url.get('media')) or uri, duration, end))
+    return segments
+
+
+def verify_dash(files: RenditionFiles) -> Report:
+    report = Report()
+    entry = ENTRY_MANIFESTS['dash']
+    try:
+        mpd = ElementTree.fromstring(files.read(entry))
+    except (FileNotFoundError, OSError) as e:
+        report.problem(f'missing {entry}: {e}')
+        return report
+    except ElementTree.ParseError as e:
+        report.problem(f'could not parse {entry}: {e}')
+        return report
+
+    max_duration = float(ENCODER['segment_seconds']) * 2 + 1
+    durations = []
+    for adaptation in mpd.iter(_tag('AdaptationSet')):
+        shared = adaptation.find(_tag('SegmentTemplate'))
+        for representation in adaptation.findall(_tag('Representation')):
+            template = representation.find(_tag('SegmentTemplate'))
+            segment_list = representation.find(_tag('SegmentList'))
+            if template is None:
+                template = shared
+
+            if segment_list is not None:
+                segments = _list_segments(segment_list, representation, entry)
+            elif template is not None:
+                segments = _template_segments(template, representation, entry)
+            else:
+                report.problem(f'representation {representation.get("id")} has no segments')
+                continue
+
+            init = [s for s in segments if s.duration < 0]
+            for segment in init:
+                size = files.size(segment.uri)
+                if size is None or size < segment.end:
+                    report.problem(f'missing or truncated init segment {segment.uri}')
+
+            before = report.duration
+            _check_segments(files, report, [s for s in segments if s.duration >= 0], max_duration)
+            durations.append(report.duration - before)
+
+    if not durations:
+        report.problem(f'{entry} has no representations')
+    report.duration = max(durations, default = 0.0)
+    return report
+
+
+def _probe(files: RenditionFiles, report: Report, sample: int):
+    """Runs ffprobe on a sample of the segment files, only for renditions on the local filesystem"""
+    names = sorted(uri for uri in report.files if files.path(uri))
+    for uri in random.sample(names, min(sample, len(names))):
+        attributes = check_attributes(files.path(uri), timed = False) or {}
+        if not attributes.get('streams'):
+            report.problem(f'ffprobe found no streams in {uri}')
+
+
+VERIFIERS = {
+    'hls': verify_hls,
+    'dash': verify_dash,
+}
+
+
+def verify(stream_instance: VideoStream, sample: int = 0) -> typing.Tuple[bool, typing.Dict[str, typing.Any]]:
+    """
+    Checks every playlist, manifest and segment of the published formats of an instance.
+    Returns if the renditions are healthy and the report per format
+    """
+    reports = {}
+    ready = {'hls': stream_instance.hls_ready, 'dash': stream_instance.dash_ready}
+    for fmt, verifier in VERIFIERS.items():
+        if not ready[fmt]:
+            continue
+
+        files = RenditionFiles(stream_instance, fmt)
+        report = verifier(files)
+        if sample and not report.problems:
+            _probe(files, report, sample)
+
+        tolerance = float(ENCODER['segment_seconds']) * 2
+        if stream_instance.source_duration and abs(report.duration - stream_instance.source_duration) > tolerance:
+            report.problem(f'renditions last {report.duration:.1f}s, the source {stream_instance.source_duration:.1f}s')
+        reports[fmt] = report.as_dict()
+
+    healthy = not any(report['problems'] for report in reports.values())
+    return healthy, reports
+
+
+def readers(stream_instance: VideoStream):
+    """Instances that serve the same rendition version, they share its health"""
+    model = type(stream_instance)
+    queryset = model.objects.filter(pk = stream_instance.pk)
+    if stream_instance.rendition_key:
+        queryset = model.objects.filter(rendition_key = stream_instance.rendition_key)
+    return queryset.filter(
+        rendition_version = stream_instance.rendition_version,
+        rendition_layout = stream_instance.rendition_layout,
+    )
+
+
+def record_health(
+        stream_instance: VideoStream,
+        healthy: bool,
+        reports: typing.Dict[str, typing.Any]
+    ) -> str:
+    health = RenditionHealth.HEALTHY if healthy else RenditionHealth.BROKEN
+    readers(stream_instance).update(
+        rendition_health = health,
+        health_report = reports,
+        health_checked_at = timezone.now(),
+    )
+    metrics.inc('verified_total', health = health)
+    return health
+
+
+def verify_all(
+        queryset,
+        workers: int = 4,
+        sample: int = 0,
+        reencode: bool = False
+    ) -> typing.Iterator[typing.Tuple[VideoStream, str, typing.Dict[str, typing.Any]]]:
+    """
+    Verifies the instances of `queryset` on a pool of threads, every rendition version once.
+    The threads only read files, the results are written from the calling thread.
+    At most `workers * 4` checks are in flight, so large libraries are not loaded into memory at once.
+    Yields every instance that was checked with its health and report
+    """
+    from .task_utils import sched_reencode
+
+    def versions() -> typing.Iterator[VideoStream]:
+        seen = set()
+        for video in queryset.iterator():
+            version = (video.rendition_key or video.hashed_id, video.rendition_version, video.rendition_layout)
+            if version not in seen:
+                seen.add(version)
+                yield video
+
+    pending = versions()
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        in_flight = {}
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < workers * 4:
+                video = next(pending, None)
+                if video is None:
+                    exhausted = True
+                    break
+                in_flight[pool.submit(verify, video, sample)] = video
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when = FIRST_COMPLETED)
+            for future in done:
+                video = in_flight.pop(future)
+                try:
+                    healthy, reports = future.result()
+                except Exception as e:
+                    LOGGER.error(f'Could not verify the renditions of {video}: {e}')
+                    continue
+
+                health = record_health(video, healthy, reports)
+                if not healthy and reencode and not video.needs_reencode:
+                    if sched_reencode(video):
+                        video.add_remark('Published streams failed the integrity check, queued for re-encoding')
+                    else:
+                        LOGGER.warning(f'Could not schedule the re-encoding of {video}, it waits for the next queue check')
+                yield video, health, reports
@@ -99,7 +99,7 @@ def stream_selected(request, pk):
 @perm_checker.require('add')
 def upload(request):
     form = None
-    instance = VideoStream(uploaded_by_user = request.user)
+    instance = VideoStream(uploaded_by = request.user)
     form = utils.init_form(request, instance, prefix = 'stream-chooser-upload')
 
     if all([
@@ -107,8 +107,8 @@ def upload(request):
         perm_policy.user_has_permission(request.user, 'add'), 
         form.is_valid()
     ]):
-        form.save()
-        utils.reindex()
+        instance = form.save()
+        utils.reindex(instance)
 
         return render_modal_workflow(
             request, None, None, None, 
@@ -8,13 +8,20 @@ from typing import Tuple
 import logging
 
 from ..models import VideoStream, get_stream_model
+from ..storage_utils import play_due
+from .. import tasks
 from ..settings import stream_settings
 
 LOGGER = logging.getLogger(__name__)
 stream_model = get_stream_model()
 
 
-def render_stream(request, instance: VideoStream, use_embed_url: bool = False) -> Tuple[str, str]:
+def render_stream(
+        request, 
+        instance: VideoStream, 
+        use_embed_url: bool = False, 
+        count_play: bool = True
+    ) -> Tuple[str, str]:
     if not instance:
         return '', ''
     
@@ -41,6 +48,14 @@ def render_stream(request, instance: VideoStream, use_embed_url: bool = False) -
             context = { 'mode': mode, 'url': url, 'streams': instance.supported_streams } 
         )
 
+    if count_play and play_due(instance, mode):
+        # written by a worker, rendering the player only reads
+        try:
+            tasks.record_play.delay(instance.pk, mode)
+
+        except Exception as e:
+            LOGGER.error(f'Failed to record the play of {instance}: {e}')
+
     embed_html = ''
     try:
         embed_html = render_to_string(
@@ -54,11 +69,16 @@ def render_stream(request, instance: VideoStream, use_embed_url: bool = False) -
     return embed_html, mirrors_html
 
 
-def render_player(request, instance: VideoStream, exclude_mirrors: bool = False) -> str:
+def render_player(
+        request, 
+        instance: VideoStream, 
+        exclude_mirrors: bool = False, 
+        count_play: bool = True
+    ) -> str:
     if not instance:
         return ''
 
-    embed_html, mirrors_html = render_stream(request, instance)
+    embed_html, mirrors_html = render_stream(request, instance, count_play = count_play)
     if exclude_mirrors:
         mirrors_html = ''
 
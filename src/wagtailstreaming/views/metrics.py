@@ -0,0 +1,32 @@
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.cache import never_cache
+
+from ..settings import stream_settings
+from .. import metrics as pipeline_metrics
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _authorized(request) -> bool:
+    token = stream_settings.METRICS_TOKEN
+    if not token:
+        return request.user.is_authenticated and request.user.is_staff
+
+    header = request.headers.get('Authorization', '')
+    scheme, _, given = header.partition(' ')
+    return scheme.lower() == 'bearer' and constant_time_compare(given.strip(), token)
+
+
+@never_cache
+def metrics(request):
+    if not stream_settings.ENABLE_METRICS:
+        return HttpResponse(status = 404)
+
+    if not _authorized(request):
+        return HttpResponse(status = 403)
+
+    return HttpResponse(
+        pipeline_metrics.render_prometheus(), 
+        content_type = CONTENT_TYPE
+    )
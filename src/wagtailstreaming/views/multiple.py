@@ -0,0 +1,136 @@
+from django.db import IntegrityError, transaction
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.shortcuts import render
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.vary import vary_on_headers
+
+from wagtail.admin.auth import PermissionPolicyChecker
+from wagtail.models import Collection
+
+import logging
+import os
+
+from ..dataclasses import VideoAttribute
+from ..models import get_stream_model
+from ..permissions import perm_policy
+from ..settings import stream_settings
+from ..upload_utils import UploadError
+from .. import task_utils, upload_utils
+from . import utils
+
+
+LOGGER = logging.getLogger(__name__)
+TITLE_ATTEMPTS = 3
+perm_checker = PermissionPolicyChecker(perm_policy)
+VideoStream = get_stream_model()
+
+
+def _available_title(filename: str) -> str:
+    """The name of the file without its extension, numbered when another stream already uses it"""
+    base = os.path.splitext(filename)[0][:240] or str(_('Untitled video'))
+    title, n = base, 1
+    while VideoStream.objects.filter(title = title).exists():
+        n += 1
+        title = f'{base} ({n})'
+    return title
+
+
+def _collection(request):
+    collections = perm_policy.collections_user_has_permission_for(request.user, 'add')
+    collection_id = request.POST.get('collection')
+    if collection_id:
+        collection = collections.filter(id = collection_id).first()
+        if collection:
+            return collection
+    return collections.first() or Collection.get_first_root_node()
+
+
+def _create_stream(request) -> VideoStream:
+    """
+    Creates the stream of one uploaded file without reading it.
+    Validation, probing and the thumbnail run as background jobs, see `tasks.prepare_upload`
+    """
+    instance = VideoStream(
+        uploaded_by = request.user,
+        collection = _collection(request),
+    )
+
+    session = None
+    session_id = request.POST.get('upload_session')
+    if session_id:
+        session = upload_utils.claim_session(session_id, request.user)
+        if not session:
+            raise UploadError(str(_('The uploaded file could not be found, please upload it again.')))
+
+        filename = session.filename
+        instance.file = session.stored_name
+
+    else:
+        uploaded = request.FILES.get('files[]')
+        if not uploaded:
+            raise UploadError(str(_('No file was uploaded.')))
+
+        upload_utils.validate_upload(uploaded.name, uploaded.size)
+        filename = uploaded.name
+        instance.file = uploaded
+
+    # files of one batch often share a name, a concurrent request may take the title first
+    for attempt in range(TITLE_ATTEMPTS):
+        instance.title = _available_title(filename)
+        try:
+            with transaction.atomic():
+                instance.save()
+            break
+
+        except IntegrityError:
+            if attempt == TITLE_ATTEMPTS - 1:
+                raise
+
+    if session:
+        if session.attributes:
+            instance.probe(attrs = VideoAttribute(raw = session.attributes))
+        session.delete()
+
+    utils.reindex(instance)
+    task_utils.sched_preparation(instance)
+    return instance
+
+
+@perm_checker.require('add')
+@vary_on_headers('X-Requested-With')
+def add(request):
+    if request.method == 'POST':
+        if request.headers.get('x-requested-with') != 'XMLHttpRequest':
+            return HttpResponseBadRequest('Cannot POST to this view without AJAX')
+
+        try:
+            instance = _create_stream(request)
+
+        except UploadError as e:
+            return JsonResponse({
+                'success': False,
+                'error_message': str(e),
+            })
+
+        return JsonResponse({
+            'success': True,
+            'stream': utils.get_stream_json(instance),
+        })
+
+    collections = utils.acceptable_collections_or_none(
+        perm_policy.collections_user_has_permission_for(request.user, 'add')
+    )
+
+    context = {
+        'collections': collections,
+        'allowed_extensions': stream_settings.VIDEO_EXTENSIONS,
+        'chunked_uploads': stream_settings.CHUNKED_UPLOADS,
+        'chunk_size': stream_settings.UPLOAD_CHUNK_SIZE,
+        'max_upload_size': stream_settings.MAX_UPLOAD_SIZE,
+    }
+
+    return render(
+        request,
+        'wagtailstreaming_templates/instances/multiple/add.html',
+        context
+    )
@@ -15,7 +15,6 @@ import logging
 
 from ..models import get_stream_model
 from ..permissions import perm_policy
-from ..signals import deletion_cleanup
 from . import utils
 
 
@@ -110,8 +109,6 @@ def edit(request, pk):
         return permission_denied(request)
     
     if request.method == 'POST' and form.is_valid():
-        if {'file', 'file_url'} & set(form.changed_data):
-            deletion_cleanup(instance)
         instance = form.save()
         utils.reindex(instance)
         utils.send_message(
@@ -0,0 +1,125 @@
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.decorators.cache import never_cache
+
+from wagtail.admin.auth import PermissionPolicyChecker
+
+import binascii
+import logging
+import base64
+
+from ..models import UploadSession
+from ..permissions import perm_policy
+from ..settings import stream_settings
+from ..upload_utils import UploadError
+from .. import upload_utils
+
+
+LOGGER = logging.getLogger(__name__)
+perm_checker = PermissionPolicyChecker(perm_policy)
+
+TUS_VERSION = '1.0.0'
+TUS_EXTENSIONS = 'creation,termination'
+OFFSET_CONTENT_TYPE = 'application/offset+octet-stream'
+
+
+def _tus_response(status: int = 204, **headers) -> HttpResponse:
+    response = HttpResponse(status = status)
+    response['Tus-Resumable'] = TUS_VERSION
+    response['Cache-Control'] = 'no-store'
+    for key, value in headers.items():
+        response[key.replace('_', '-')] = str(value)
+    return response
+
+
+def _error_response(error: UploadError) -> HttpResponse:
+    response = _tus_response(error.status)
+    response.content = str(error).encode('utf-8')
+    response['Content-Type'] = 'text/plain; charset=utf-8'
+    return response
+
+
+def _parse_metadata(header: str) -> dict:
+    """Decodes the `Upload-Metadata` header, comma separated keys with base64 encoded values"""
+    metadata = {}
+    for pair in filter(None, (p.strip() for p in header.split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode('utf-8') if value else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError(f'Invalid metadata value for {key}')
+    return metadata
+
+
+def _header_int(request, name: str) -> int:
+    try:
+        value = int(request.headers.get(name, ''))
+    except ValueError:
+        raise UploadError(f'Missing or invalid {name} header')
+
+    if value < 0:
+        raise UploadError(f'Invalid {name} header')
+    return value
+
+
+@never_cache
+@perm_checker.require_any('add', 'change')
+def create(request):
+    if request.method == 'OPTIONS':
+        headers = {
+            'Tus_Version': TUS_VERSION,
+            'Tus_Extension': TUS_EXTENSIONS,
+        }
+        if stream_settings.MAX_UPLOAD_SIZE:
+            headers['Tus_Max_Size'] = stream_settings.MAX_UPLOAD_SIZE
+        return _tus_response(**headers)
+
+    if request.method != 'POST':
+        return _tus_response(405, Allow = 'POST, OPTIONS')
+
+    try:
+        length = _header_int(request, 'Upload-Length')
+        metadata = _parse_metadata(request.headers.get('Upload-Metadata', ''))
+        session = upload_utils.create_session(request.user, metadata.get('filename', ''), length)
+
+    except UploadError as e:
+        return _error_response(e)
+
+    return _tus_response(
+        201,
+        Location = reverse('wagtailstreaming:upload_session', args = (session.id, )),
+        Upload_Offset = 0,
+        Upload_Session = session.id
+    )
+
+
+@never_cache
+@perm_checker.require_any('add', 'change')
+def session(request, pk):
+    instance = get_object_or_404(UploadSession, pk = pk, user = request.user)
+
+    try:
+        if request.method == 'HEAD':
+            return _tus_response(
+                200,
+                Upload_Offset = instance.offset,
+                Upload_Length = instance.length
+            )
+
+        if request.method == 'PATCH':
+            if request.content_type != OFFSET_CONTENT_TYPE:
+                return _tus_response(415)
+
+            offset = _header_int(request, 'Upload-Offset')
+            instance = upload_utils.write_chunk(instance, offset, request)
+            return _tus_response(204, Upload_Offset = instance.offset)
+
+        if request.method == 'DELETE':
+            upload_utils.terminate(instance)
+            return _tus_response(204)
+
+    except UploadError as e:
+        return _error_response(e)
+
+    return _tus_response(405, Allow = 'HEAD, PATCH, DELETE')
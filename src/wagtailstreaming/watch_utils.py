@@ -0,0 +1,277 @@
+from dataclasses import dataclass, field
+import ctypes.util
+import logging
+import select
+import struct
+import typing
+import ctypes
+import time
+import os
+
+from .import_utils import is_video_name, scan
+
+LOGGER = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    """Minimal ctypes binding of the Linux inotify API"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths: typing.Dict[int, str] = {}
+
+    @classmethod
+    def available(cls) -> bool:
+        try:
+            cls().close()
+            return True
+        except (OSError, AttributeError):
+            return False
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.paths[wd] = path
+        return wd
+
+    def read(self, timeout: float) -> typing.Iterator[typing.Tuple[int, str]]:
+        """Yields (mask, path) of the events that arrive within `timeout` seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+
+            directory = self.paths.get(wd, '')
+            yield mask, os.path.join(directory, name) if name else directory
+
+    def close(self):
+        os.close(self.fd)
+
+
+@dataclass
+class PendingFile:
+    size: int
+    mtime: float
+    since: float
+    closed: bool = field(default = False) # the writer closed it or moved it in, no need to wait
+
+
+class FolderWatcher:
+    """
+    Watches drop directories and hands every video file to `on_ready` once it stopped changing.
+    A file is ready right after its writer closes it or it is moved in, otherwise once its size and
+    modification time stayed the same for `settle` seconds. Uses inotify on Linux and polls elsewhere.
+    Files whose `on_ready` call raised are handed over again after `retry_delay` seconds
+    """
+
+    def __init__(
+            self,
+            directories: typing.List[str],
+            on_ready: typing.Callable[[typing.List[str]], None],
+            settle: float = 10.0,
+            poll_interval: float = 5.0,
+            recursive: bool = True,
+            use_inotify: typing.Optional[bool] = None,
+            retry_delay: float = 60.0
+        ):
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.on_ready = on_ready
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.recursive = recursive
+        self.retry_delay = retry_delay
+
+        self.pending: typing.Dict[str, PendingFile] = {}
+        # path -> (size, mtime) imported by on_ready, one entry per file that is still there
+        self.handled: typing.Dict[str, typing.Tuple[int, float]] = {}
+        self.inotify = None
+        if use_inotify is None:
+            use_inotify = Inotify.available()
+        if use_inotify:
+            self.inotify = Inotify()
+        self.running = False
+
+    # bookkeeping
+    def observe(self, path: str, closed: bool = False):
+        if not is_video_name(path):
+            return
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.pending.pop(path, None)
+            return
+
+        if self.handled.get(path) == (stat.st_size, stat.st_mtime):
+            return
+
+        previous = self.pending.get(path)
+        if previous and (previous.size, previous.mtime) == (stat.st_size, stat.st_mtime):
+            previous.closed = previous.closed or closed
+            return
+        self.pending[path] = PendingFile(stat.st_size, stat.st_mtime, time.monotonic(), closed)
+
+    def watch_tree(self, directory: str):
+        """Watches `directory` (and its subdirectories) and picks up the files already inside"""
+        if self.inotify:
+            stack = [directory]
+            while stack:
+                current = stack.pop()
+                try:
+                    self.inotify.add_watch(current)
+                    if self.recursive:
+                        with os.scandir(current) as entries:
+                            stack.extend(
+                                e.path for e in entries
+                                if e.is_dir(follow_symlinks = False) and not e.name.startswith('.')
+                            )
+                except OSError as e:
+                    LOGGER.warning(f'Could not watch {current}: {e}')
+
+        for entry in scan(directory, self.recursive):
+            self.observe(entry.path)
+
+    def prune(self):
+        """Forgets handled files that were deleted or replaced since, e.g. when inotify dropped their events"""
+        for path, key in list(self.handled.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.handled[path]
+                continue
+            if (stat.st_size, stat.st_mtime) != key:
+                del self.handled[path]
+
+    def rescan(self):
+        self.prune()
+        for directory in self.directories:
+            self.watch_tree(directory)
+
+    def ready(self) -> typing.Dict[str, typing.Tuple[int, float]]:
+        """Settled files and their (size, mtime), they count as handled once `on_ready` took them"""
+        now = time.monotonic()
+        paths = {}
+        for path, pending in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+
+            if (stat.st_size, stat.st_mtime) != (pending.size, pending.mtime):
+                self.pending[path] = PendingFile(stat.st_size, stat.st_mtime, now)
+                continue
+
+            if pending.closed or now - pending.since >= self.settle:
+                del self.pending[path]
+                paths[path] = (stat.st_size, stat.st_mtime)
+        return paths
+
+    def hand_over(self, paths: typing.Dict[str, typing.Tuple[int, float]]):
+        try:
+            self.on_ready(list(paths))
+
+        except Exception:
+            # the daemon keeps running, the files are tried again once the delay is over
+            LOGGER.exception(f'Could not import {len(paths)} file(s), retrying in {int(self.retry_delay)}s')
+            since = time.monotonic() + self.retry_delay
+            for path, (size, mtime) in paths.items():
+                self.pending.setdefault(path, PendingFile(size, mtime, since))
+            return
+
+        self.handled.update(paths)
+
+    # events
+    def handle_event(self, mask: int, path: str):
+        if mask & IN_Q_OVERFLOW:
+            LOGGER.warning('inotify queue overflowed, rescanning the watched directories')
+            self.rescan()
+            return
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and self.recursive:
+                self.watch_tree(path)
+            return
+
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self.pending.pop(path, None)
+            self.handled.pop(path, None)
+
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.observe(path, closed = True)
+
+        elif mask & (IN_CREATE | IN_MODIFY):
+            self.observe(path)
+
+    def wait(self, timeout: float):
+        if not self.inotify:
+            time.sleep(timeout)
+            self.rescan()
+            return
+
+        for mask, path in self.inotify.read(timeout):
+            self.handle_event(mask, path)
+
+    def run(self):
+        # files that arrived while the daemon was down are found by this first scan
+        self.rescan()
+        self.running = True
+        try:
+            while self.running:
+                timeout = self.poll_interval
+                if self.pending:
+                    timeout = min(timeout, 1.0)
+                self.wait(timeout)
+
+                paths = self.ready()
+                if paths:
+                    self.hand_over(paths)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None